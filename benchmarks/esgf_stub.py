@@ -0,0 +1,298 @@
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+import netCDF4
+import numpy as np
+
+"""
+Local stand-in for an ESGF index and data node, serving a catalogue of synthetic files (see synthetic.py):
+
+- /esg-search/search: Solr-like file search, filtered by facets (multiple values ORed), paged with offset/limit and
+  returning documents with HTTPServer and OPENDAP urls, sizes and checksums;
+- /thredds/fileServer/<path>: whole files, with HTTP range requests;
+- /thredds/dodsC/<path>.dds|.das|.dods: a subset of DAP2 sufficient for netCDF-C's client: numeric arrays, with
+  hyperslab constraints.
+
+Latency (per request) and bandwidth (per connection) may be limited, to emulate a remote node.
+"""
+
+SEARCH_FACETS = [
+    "source_id",
+    "member_id",
+    "experiment_id",
+    "variable_id",
+    "table_id",
+    "grid_label",
+    "frequency",
+    "data_node",
+]
+DEFAULT_PAGE_SIZE = 50
+DAP_TYPES = {
+    np.dtype("float32"): ("Float32", ">f4"),
+    np.dtype("float64"): ("Float64", ">f8"),
+    np.dtype("int32"): ("Int32", ">i4"),
+    np.dtype("int16"): ("Int16", ">i2"),
+    np.dtype("int64"): ("Float64", ">f8"),  # DAP2 has no 64-bit integers
+}
+
+
+def parse_constraint(constraint: str):
+    """Parse a DAP2 projection e.g. "tos[0:1:11][10:1:20][0:1:359],time" into {name: slices or None}."""
+    projections = {}
+    for item in filter(None, unquote(constraint).split(",")):
+        name = item.split("[")[0].split(".")[-1]
+        # each bracket is [index], [start:stop] or [start:step:stop], with inclusive stop
+        slices = []
+        for bracket in re.findall(r"\[([\d:]+)\]", item):
+            bounds = [int(b) for b in bracket.split(":")]
+            start, stop = bounds[0], bounds[-1]
+            step = bounds[1] if len(bounds) == 3 else 1
+            slices.append(slice(start, stop + 1, step))
+        projections[name] = slices or None
+    return projections
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        # emulate bandwidth by writing in timed chunks
+        bandwidth = self.server.stub.bandwidth
+        chunk = 2**16
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start : start + chunk])
+            if bandwidth:
+                time.sleep(min(chunk, len(body) - start) / bandwidth)
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+        parsed = urlparse(self.path)
+        try:
+            if parsed.path.rstrip("/").endswith("/esg-search/search"):
+                return self._search(parse_qs(parsed.query))
+            if parsed.path.startswith("/thredds/fileServer/"):
+                return self._file(parsed.path[len("/thredds/fileServer/") :])
+            if parsed.path.startswith("/thredds/dodsC/"):
+                return self._dap(parsed.path[len("/thredds/dodsC/") :], parsed.query)
+        except FileNotFoundError:
+            pass
+        self._send(404, b"not found")
+
+    def _search(self, query: dict):
+        stub = self.server.stub
+        docs = [
+            doc
+            for doc in stub.docs
+            if all(
+                str(doc.get(facet, [None])[0]) in query[facet]
+                for facet in SEARCH_FACETS
+                if facet in query
+            )
+        ]
+        offset = int(query.get("offset", [0])[0])
+        limit = int(query.get("limit", [stub.page_size])[0])
+        body = {
+            "response": {"numFound": len(docs), "docs": docs[offset : offset + limit]}
+        }
+        self._send(200, json.dumps(body).encode(), {"Content-Type": "application/json"})
+
+    def _file(self, rel_path: str):
+        fp = self.server.stub.root / unquote(rel_path)
+        if not fp.is_file():
+            raise FileNotFoundError(fp)
+        size = fp.stat().st_size
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        with open(fp, "rb") as f:
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or size - 1), size - 1)
+                f.seek(start)
+                return self._send(
+                    206,
+                    f.read(end - start + 1),
+                    {"Content-Range": f"bytes {start}-{end}/{size}"},
+                )
+            self._send(200, f.read())
+
+    def _dap(self, rel_path: str, constraint: str):
+        rel_path = unquote(rel_path)
+        for suffix in [".dds", ".das", ".dods", ".html"]:
+            if rel_path.endswith(suffix):
+                break
+        else:
+            raise FileNotFoundError(rel_path)
+        fp = self.server.stub.root / rel_path[: -len(suffix)]
+        if not fp.is_file():
+            raise FileNotFoundError(fp)
+        with netCDF4.Dataset(fp) as nc:
+            nc.set_auto_maskandscale(False)
+            if suffix == ".das":
+                return self._send(200, das(nc).encode())
+            projections = parse_constraint(constraint) or {
+                name: None for name in nc.variables
+            }
+            if suffix in (".dds", ".html"):
+                return self._send(200, dds(nc, projections, fp.name).encode())
+            self._send(
+                200,
+                dds(nc, projections, fp.name).encode()
+                + b"\nData:\n"
+                + dods_data(nc, projections),
+            )
+
+
+def _dap_type(var):
+    return DAP_TYPES[np.dtype(var.dtype)]
+
+
+def _shape(var, slices):
+    if slices is None:
+        return list(var.shape)
+    return [len(range(*s.indices(n))) for s, n in zip(slices, var.shape)]
+
+
+def dds(nc, projections: dict, name: str):
+    lines = ["Dataset {"]
+    for var_name, slices in projections.items():
+        var = nc.variables[var_name]
+        dims = "".join(
+            f"[{dim} = {n}]" for dim, n in zip(var.dimensions, _shape(var, slices))
+        )
+        lines.append(f"    {_dap_type(var)[0]} {var_name}{dims};")
+    lines.append(f"}} {name};")
+    return "\n".join(lines)
+
+
+def _das_value(value):
+    if isinstance(value, str):
+        return "String", '"' + value.replace('"', '\\"') + '"'
+    value = np.atleast_1d(value)
+    dap_type = DAP_TYPES.get(value.dtype, ("Float64", None))[0]
+    return dap_type, ", ".join(str(v) for v in value)
+
+
+def das(nc):
+    lines = ["Attributes {"]
+    for var_name, var in nc.variables.items():
+        lines.append(f"    {var_name} {{")
+        for attr in var.ncattrs():
+            if attr == "_FillValue":
+                continue
+            dap_type, value = _das_value(var.getncattr(attr))
+            lines.append(f"        {dap_type} {attr} {value};")
+        lines.append("    }")
+    lines.append("    NC_GLOBAL {")
+    for attr in nc.ncattrs():
+        dap_type, value = _das_value(nc.getncattr(attr))
+        lines.append(f"        {dap_type} {attr} {value};")
+    lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def dods_data(nc, projections: dict):
+    """XDR-encoded values of each projected array: its length (twice), then big-endian values."""
+    parts = []
+    for var_name, slices in projections.items():
+        var = nc.variables[var_name]
+        values = var[tuple(slices)] if slices else var[...]
+        values = np.ascontiguousarray(values, dtype=_dap_type(var)[1])
+        n = np.array([values.size, values.size], dtype=">u4")
+        parts += [n.tobytes(), values.tobytes()]
+    return b"".join(parts)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ESGFStub:
+    """Serves a catalogue of files (see synthetic.generate_dataset) under root, as data node `host`."""
+
+    def __init__(
+        self,
+        root: str | Path,
+        catalogue: list[dict],
+        host: str = "localhost",
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: float = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ):
+        """
+        Args:
+            root (str | Path): directory containing the catalogue's files
+            catalogue (list[dict]): files, as returned by synthetic.generate_dataset
+            host (str, optional): hostname in urls, and data_node of documents. Defaults to "localhost".
+            port (int, optional): port to listen on. Defaults to 0 (any free port).
+            latency (float, optional): delay (s) before responding to each request. Defaults to 0.
+            bandwidth (float, optional): bytes/s per connection. Defaults to None (unlimited).
+            page_size (int, optional): search results per page. Defaults to DEFAULT_PAGE_SIZE.
+        """
+        self.root = Path(root)
+        self.host = host
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_size = page_size
+        self.requests = 0
+        self.server = _Server(("127.0.0.1", port), StubHandler)
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.docs = [self._doc(entry) for entry in catalogue]
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def search_url(self):
+        return f"{self.base_url}/esg-search/search"
+
+    def _doc(self, entry: dict):
+        doc = {facet: [entry[facet]] for facet in SEARCH_FACETS if facet in entry}
+        doc.update(
+            id=f"{entry['path']}|{self.host}",
+            data_node=[self.host],
+            size=entry["size"],
+            checksum=[entry["checksum"]],
+            checksum_type=["SHA256"],
+            url=[
+                f"{self.base_url}/thredds/fileServer/{entry['path']}|application/netcdf|HTTPServer",
+                f"{self.base_url}/thredds/dodsC/{entry['path']}.html|application/opendap-html|OPENDAP",
+            ],
+        )
+        return doc
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,140 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmarks.run_benchmarks import REPO_DIR
+
+"""
+Import-time budget: each of cmipper's entry points (the command line interface, the pipeline, and the modules
+unpickled by newly-spawned worker processes) is imported in a fresh interpreter, and must load within a budget and
+without importing any heavy dependency, which should only be loaded by the stage using it (see cmipper.lazy). The time
+for a newly-spawned worker process to run its first task is also checked.
+
+    python -m benchmarks.import_time --budget_ms 300
+
+Exits with a non-zero status if any budget is exceeded, so may be run as a check.
+"""
+
+MODULES = [
+    "cmipper.cli",
+    "cmipper.main",
+    "cmipper.parallelised_download_and_process",
+    "cmipper.functions_creche",
+    "cmipper.planner",
+]
+HEAVY_MODULES = [
+    "cdo",
+    "dask",
+    "netCDF4",
+    "numpy",
+    "pandas",
+    "requests",
+    "scipy",
+    "xarray",
+    "zarr",
+]
+DEFAULT_BUDGET_MS = 300
+DEFAULT_WORKER_BUDGET_MS = 1000
+
+_PROBE = """
+import json, sys, time
+tic = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "ms": (time.perf_counter() - tic) * 1e3,
+    "heavy": [name for name in {heavy} if name in sys.modules],
+}}))
+"""
+
+
+def import_time(module: str, repeats: int = 5):
+    """Best of repeats of importing module in a fresh interpreter.
+
+    Returns:
+        tuple[float, list[str]]: import time (ms), and any heavy modules imported with it
+    """
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(result["ms"] for result in results), results[0]["heavy"]
+
+
+def worker_start_time(repeats: int = 5):
+    """Best of repeats of starting a spawned worker process (as the scheduler does) and running a first task from
+    the pipeline module, which the worker must import to unpickle.
+
+    Returns:
+        float: time (ms) from submitting the task to its result
+    """
+    sys.path.insert(0, str(REPO_DIR))
+    from cmipper import parallelised_download_and_process as pdp
+
+    durations = []
+    for _ in range(repeats):
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=get_context("spawn")
+        ) as pool:
+            tic = time.perf_counter()
+            pool.submit(pdp.file_date_range, "tos_195001-195012.nc").result()
+            durations.append((time.perf_counter() - tic) * 1e3)
+    return min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check cmipper's import time, and that heavy dependencies are imported lazily"
+    )
+    parser.add_argument(
+        "--budget_ms",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help="maximum import time of each module",
+    )
+    parser.add_argument(
+        "--worker_budget_ms",
+        type=float,
+        default=DEFAULT_WORKER_BUDGET_MS,
+        help="maximum time for a spawned worker to run its first task (including interpreter startup)",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"\n{'module':<45}{'import (ms)':>12}  heavy modules imported", flush=True)
+    for module in MODULES:
+        ms, heavy = import_time(module, args.repeats)
+        over_budget = ms > args.budget_ms or bool(heavy)
+        failed = failed or over_budget
+        print(
+            f"{module:<45}{ms:>12.0f}  {', '.join(heavy) or '-'}"
+            + ("  OVER BUDGET" if over_budget else ""),
+            flush=True,
+        )
+    worker_ms = worker_start_time(args.repeats)
+    failed = failed or worker_ms > args.worker_budget_ms
+    print(
+        f"{'spawned worker, first task':<45}{worker_ms:>12.0f}"
+        + ("  OVER BUDGET" if worker_ms > args.worker_budget_ms else ""),
+        flush=True,
+    )
+    print(
+        f"\nbudget: {args.budget_ms:.0f} ms per module (no heavy modules), "
+        f"{args.worker_budget_ms:.0f} ms per worker",
+        flush=True,
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from benchmarks import esgf_stub, synthetic
+
+"""
+Offline end-to-end benchmark: generates a synthetic dataset, serves it from a local ESGF stand-in, and times
+download_cmip_variable_data, concat_cmip_files_by_time and merge_cmip_data_by_variables against it, both end to end and
+per stage (from cmipper.metrics). Results are saved as JSON, named by time and commit, for comparison across commits:
+
+    python -m benchmarks.run_benchmarks --nj 180 --ni 360 --years 4
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+
+SOURCE_ID = "BENCH-TRIPOLAR"
+MEMBER_ID = "r1i1p1f1"
+EXPERIMENT_ID = "hist-1950"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def git_commit():
+    """Current commit (suffixed with -dirty if there are uncommitted changes), or "unknown" outside git."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def write_configs(work_dir: Path, args, search_url: str):
+    """Write model_info.yaml and download_config.yaml for the synthetic source, based on the repo's download config."""
+    variable_dict = {
+        variable_id: {
+            "include": True,
+            "table_id": "Omon",
+            # level variables are extracted at the seafloor, as in the repo's configuration
+            "plevels": [-1] if variable_id in synthetic.LEVEL_VARIABLES else [None],
+        }
+        for variable_id in args.variables
+    }
+    model_info = {
+        SOURCE_ID: {
+            "resolution": args.resolution,
+            "experiment_ids": [EXPERIMENT_ID],
+            "member_ids": [MEMBER_ID],
+            "data_nodes": ["localhost"],
+            "frequency": "mon",
+            "variable_dict": variable_dict,
+        }
+    }
+    with open(REPO_DIR / "download_config.yaml") as f:
+        download_config = yaml.safe_load(f)
+    download_config.update(
+        variable_ids=list(args.variables),
+        member_ids=[MEMBER_ID],
+        experiment_ids={EXPERIMENT_ID: [args.start_year, args.start_year + args.years]},
+        lats=args.lats,
+        lons=args.lons,
+        levs=[0, args.nlev],
+    )
+    download_config["processing"]["regrid_backend"] = args.regrid_backend
+    download_config["search"] = dict(
+        download_config.get("search", {}), server=search_url, cache=False
+    )
+    download_config["transfer"] = dict(
+        download_config.get("transfer", {}), engine=args.engine
+    )
+    download_config["metrics"] = {"enabled": True}
+    # a single node serves everything
+    download_config["replicas"] = {"enabled": False}
+
+    model_info_fp = work_dir / "model_info.yaml"
+    download_config_fp = work_dir / "download_config.yaml"
+    model_info_fp.write_text(yaml.safe_dump(model_info))
+    download_config_fp.write_text(yaml.safe_dump(download_config))
+    return model_info_fp, download_config_fp
+
+
+def timed(timings: dict, name: str, func, *args):
+    tic = time.perf_counter()
+    result = func(*args)
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - tic
+    return result
+
+
+def run(args):
+    work_dir = Path(tempfile.mkdtemp(prefix="cmipper_benchmark_"))
+    print(f"benchmarking in {work_dir}", flush=True)
+    timings = {}
+    try:
+        catalogue = timed(
+            timings,
+            "generate",
+            synthetic.generate_dataset,
+            work_dir / "served",
+            SOURCE_ID,
+            MEMBER_ID,
+            {EXPERIMENT_ID: [args.start_year, args.start_year + args.years]},
+            args.variables,
+            args.nj,
+            args.ni,
+            args.nlev,
+        )
+        served_bytes = sum(entry["size"] for entry in catalogue)
+        print(
+            f"generated {len(catalogue)} files ({served_bytes / 1e6:.1f} MB) in {timings['generate']:.1f}s",
+            flush=True,
+        )
+
+        stub = esgf_stub.ESGFStub(
+            work_dir / "served",
+            catalogue,
+            latency=args.latency,
+            bandwidth=args.bandwidth_mb * 1e6 if args.bandwidth_mb else None,
+        ).start()
+        model_info_fp, download_config_fp = write_configs(
+            work_dir, args, stub.search_url
+        )
+        # cmipper's paths are fixed on import, and inherited by its worker processes, from these
+        os.environ.update(
+            CMIPPER_DATA_DIR=str(work_dir / "data"),
+            CMIPPER_LOGGING_DIR=str(work_dir / "logs"),
+            CMIPPER_MODEL_INFO=str(model_info_fp),
+            CMIPPER_DOWNLOAD_CONFIG=str(download_config_fp),
+        )
+        from cmipper import metrics
+        from cmipper import parallelised_download_and_process as pdp
+
+        metrics.run_id()
+        tic = time.perf_counter()
+        for variable_id in args.variables:
+            timed(
+                timings,
+                "download",
+                pdp.download_cmip_variable_data,
+                SOURCE_ID,
+                MEMBER_ID,
+                variable_id,
+            )
+        for variable_id in args.variables:
+            timed(
+                timings,
+                "concat",
+                pdp.concat_cmip_files_by_time,
+                SOURCE_ID,
+                EXPERIMENT_ID,
+                MEMBER_ID,
+                variable_id,
+            )
+        timed(
+            timings,
+            "merge",
+            pdp.merge_cmip_data_by_variables,
+            SOURCE_ID,
+            EXPERIMENT_ID,
+            MEMBER_ID,
+        )
+        timings["end_to_end"] = time.perf_counter() - tic
+        stub.stop()
+
+        results = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {
+                key: value
+                for key, value in vars(args).items()
+                if key not in ("compare", "results_dir", "keep", "label")
+            },
+            "served_files": len(catalogue),
+            "served_bytes": served_bytes,
+            "stub_requests": stub.requests,
+            "timings": timings,
+            "stages": metrics.summarise(),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_dir = Path(args.results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    results_fp = (
+        results_dir
+        / f"{time.strftime('%Y%m%d-%H%M%S')}_{results['commit']}_{args.label}.json"
+    )
+    results_fp.write_text(json.dumps(results, indent=2))
+    print_results(results)
+    print(f"\nresults saved to {results_fp}", flush=True)
+    return results
+
+
+def print_results(results: dict):
+    print(f"\ncommit {results['commit']}: {results['params']}", flush=True)
+    for name, dur in results["timings"].items():
+        print(f"{name:<12}{dur:>9.2f}s", flush=True)
+    print(
+        f"\n{'stage':<10}{'units':>7}{'wall (s)':>10}{'cpu (s)':>9}{'MB in':>9}{'MB out':>9}"
+    )
+    for stage, totals in results["stages"].items():
+        print(
+            f"{stage:<10}{totals['done']:>7}{totals['wall_s']:>10.2f}{totals['cpu_s']:>9.2f}"
+            f"{totals['bytes_in'] / 1e6:>9.1f}{totals['bytes_out'] / 1e6:>9.1f}",
+            flush=True,
+        )
+
+
+def compare(baseline_fp: str, candidate_fp: str):
+    """Print timings of two results files side by side, with the ratio of candidate to baseline."""
+    baseline = json.loads(Path(baseline_fp).read_text())
+    candidate = json.loads(Path(candidate_fp).read_text())
+    if baseline["params"] != candidate["params"]:
+        print("WARNING: results were run with different parameters", flush=True)
+    print(
+        f"\n{'':<20}{baseline['commit']:>14}{candidate['commit']:>14}{'ratio':>8}",
+        flush=True,
+    )
+    rows = [
+        (name, baseline["timings"].get(name), candidate["timings"].get(name))
+        for name in baseline["timings"]
+    ] + [
+        (
+            f"{stage} (wall)",
+            baseline["stages"].get(stage, {}).get("wall_s"),
+            candidate["stages"].get(stage, {}).get("wall_s"),
+        )
+        for stage in baseline["stages"]
+    ]
+    for name, before, after in rows:
+        if before is None or after is None:
+            continue
+        print(
+            f"{name:<20}{before:>13.2f}s{after:>13.2f}s{after / max(before, 1e-9):>8.2f}",
+            flush=True,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark cmipper against a local ESGF stand-in serving synthetic data"
+    )
+    parser.add_argument("--nj", type=int, default=180, help="grid rows")
+    parser.add_argument("--ni", type=int, default=360, help="grid columns")
+    parser.add_argument("--nlev", type=int, default=25, help="levels of 3D variables")
+    parser.add_argument("--years", type=int, default=3, help="years (one file each)")
+    parser.add_argument("--start_year", type=int, default=1950)
+    parser.add_argument("--variables", nargs="+", default=["tos", "thetao"])
+    parser.add_argument("--resolution", type=float, default=1.0)
+    parser.add_argument("--lats", type=float, nargs=2, default=[-32, 0])
+    parser.add_argument("--lons", type=float, nargs=2, default=[130, 170])
+    parser.add_argument("--engine", default="opendap", choices=["opendap", "https"])
+    parser.add_argument(
+        "--regrid_backend",
+        default="sparse-linear",
+        choices=["sparse-linear", "cdo"],
+        help="cdo (bilinear) requires the cdo binary",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="per-request delay (s) of the stub"
+    )
+    parser.add_argument(
+        "--bandwidth_mb", type=float, default=None, help="per-connection MB/s of stub"
+    )
+    parser.add_argument("--label", default="default", help="name of results file")
+    parser.add_argument("--results_dir", default=str(RESULTS_DIR))
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the working directory"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="compare two results files rather than running",
+    )
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
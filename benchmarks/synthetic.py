@@ -0,0 +1,186 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xa
+
+"""
+Synthetic CMIP6-like ocean files on a tripolar (ORCA-like) grid, for offline benchmarks.
+
+Below the northern fold latitude the grid is regular in longitude and latitude. North of it, rows bend towards two poles
+placed over land (as on NEMO's ORCA grids), so the 2D latitude and longitude coordinates are curvilinear, as in real
+EC-Earth3P-HR output. Bathymetry is a smooth random field, with land (and cells below the seafloor) set to NaN.
+"""
+
+FOLD_LATITUDE = 20.0
+SURFACE_VARIABLES = {"tos": ("Omon", 288.0, 10.0), "mlotst": ("Omon", 50.0, 40.0)}
+LEVEL_VARIABLES = {"thetao": ("Omon", 283.0, 8.0), "so": ("Omon", 35.0, 1.0)}
+
+
+def tripolar_grid(nj: int, ni: int):
+    """2D latitude and longitude of a tripolar grid with nj rows and ni columns."""
+    lons_1d = np.linspace(0, 360, ni, endpoint=False)
+    lats_1d = np.linspace(-78, 89.5, nj)
+    lon, lat = np.meshgrid(lons_1d, lats_1d)
+    north = lats_1d > FOLD_LATITUDE
+    # fraction of the way from the fold to the top row
+    frac = (lats_1d[north] - FOLD_LATITUDE) / (lats_1d[-1] - FOLD_LATITUDE)
+    # bend rows towards poles at 80E and 260E: latitude falls away from the poles, increasingly with distance north
+    bend = np.cos(np.deg2rad(2 * (lons_1d - 80)))[None, :]
+    lat[north] = lats_1d[north][:, None] - 10 * frac[:, None] ** 2 * (1 - bend)
+    lon[north] = lons_1d[None, :] + 5 * frac[:, None] * np.sin(
+        np.deg2rad(2 * (lons_1d - 80))
+    )
+    return lat.astype("float64"), (lon % 360).astype("float64")
+
+
+def smooth_field(rng: np.random.Generator, nj: int, ni: int, scale: int = 8):
+    """Smooth random field in [0, 1], from coarse noise interpolated onto the grid."""
+    coarse = rng.random((nj // scale + 2, ni // scale + 2))
+    j = np.linspace(0, coarse.shape[0] - 1, nj)
+    i = np.linspace(0, coarse.shape[1] - 1, ni)
+    rows = np.array([np.interp(i, np.arange(coarse.shape[1]), row) for row in coarse])
+    field = np.array(
+        [np.interp(j, np.arange(coarse.shape[0]), col) for col in rows.T]
+    ).T
+    return (field - field.min()) / (field.max() - field.min())
+
+
+def bathymetry(nj: int, ni: int, nlev: int, land_fraction: float = 0.3, seed: int = 0):
+    """Index of the deepest wet level of each cell, or -1 for land."""
+    field = smooth_field(np.random.default_rng(seed), nj, ni)
+    deepest = np.floor((field - land_fraction) / (1 - land_fraction) * nlev).astype(int)
+    return np.where(field < land_fraction, -1, np.clip(deepest, 0, nlev - 1))
+
+
+def cmip_fname(
+    variable_id: str,
+    table_id: str,
+    source_id: str,
+    experiment_id: str,
+    member_id: str,
+    grid_label: str,
+    year: int,
+):
+    return f"{variable_id}_{table_id}_{source_id}_{experiment_id}_{member_id}_{grid_label}_{year}01-{year}12.nc"
+
+
+def make_file(
+    fp: str | Path,
+    variable_id: str,
+    year: int,
+    nj: int,
+    ni: int,
+    nlev: int = 0,
+    seed: int = 0,
+):
+    """Write a year of monthly values of variable_id to fp. Level variables (nlev > 0) have a lev dimension."""
+    lat, lon = tripolar_grid(nj, ni)
+    deepest = bathymetry(nj, ni, max(nlev, 1), seed=seed)
+    rng = np.random.default_rng(seed + year)
+    # mid-month, as CMIP6 monthly means
+    times = pd.date_range(f"{year}-01-01", periods=12, freq="MS") + pd.Timedelta(
+        days=15
+    )
+    if nlev:
+        _, mean, spread = LEVEL_VARIABLES.get(variable_id, ("Omon", 0.0, 1.0))
+        lev = np.geomspace(5, 5500, nlev)
+        values = mean + spread * rng.standard_normal((12, nlev, nj, ni))
+        # NaN on land and below the seafloor
+        dry = np.arange(nlev)[:, None, None] > deepest[None]
+        values[:, dry] = np.nan
+        data = (("time", "lev", "j", "i"), values.astype("float32"))
+    else:
+        _, mean, spread = SURFACE_VARIABLES.get(variable_id, ("Omon", 0.0, 1.0))
+        values = mean + spread * rng.standard_normal((12, nj, ni))
+        values[:, deepest < 0] = np.nan
+        data = (("time", "j", "i"), values.astype("float32"))
+
+    coords = {
+        "time": times,
+        "latitude": (("j", "i"), lat, {"units": "degrees_north"}),
+        "longitude": (("j", "i"), lon, {"units": "degrees_east"}),
+    }
+    if nlev:
+        coords["lev"] = ("lev", lev, {"units": "m", "positive": "down"})
+    ds = xa.Dataset({variable_id: data}, coords=coords)
+    ds[variable_id].attrs = {"units": "1", "long_name": f"synthetic {variable_id}"}
+    ds.attrs = {"title": "synthetic CMIP6-like data for cmipper benchmarks"}
+    ds.to_netcdf(
+        fp, encoding={"time": {"units": "days since 1850-01-01", "dtype": "float64"}}
+    )
+    return Path(fp)
+
+
+def file_checksum(fp: str | Path):
+    sha = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def generate_dataset(
+    out_dir: str | Path,
+    source_id: str,
+    member_id: str,
+    experiment_years: dict,
+    variables: list[str],
+    nj: int = 180,
+    ni: int = 360,
+    nlev: int = 25,
+):
+    """Write a year-per-file synthetic dataset, returning a catalogue of the files written.
+
+    Args:
+        out_dir (str | Path): directory to write files to (laid out as source/experiment/member/variable)
+        experiment_years (dict): mapping experiment_id to [first year, last year)
+        variables (list[str]): variable ids. Those in LEVEL_VARIABLES have nlev levels, others are surface fields.
+        nj, ni (int): grid size (rows, columns)
+        nlev (int): number of levels of level variables
+
+    Returns:
+        list[dict]: one entry per file with its facets, relative path, size and sha256 checksum
+    """
+    catalogue = []
+    for experiment_id, (start, end) in experiment_years.items():
+        for variable_id in variables:
+            table_id = (
+                LEVEL_VARIABLES.get(variable_id) or SURFACE_VARIABLES.get(variable_id)
+            )[0]
+            rel_dir = Path(source_id) / experiment_id / member_id / variable_id
+            (Path(out_dir) / rel_dir).mkdir(parents=True, exist_ok=True)
+            for year in range(start, end):
+                fname = cmip_fname(
+                    variable_id,
+                    table_id,
+                    source_id,
+                    experiment_id,
+                    member_id,
+                    "gn",
+                    year,
+                )
+                fp = make_file(
+                    Path(out_dir) / rel_dir / fname,
+                    variable_id,
+                    year,
+                    nj,
+                    ni,
+                    nlev if variable_id in LEVEL_VARIABLES else 0,
+                )
+                catalogue.append(
+                    {
+                        "source_id": source_id,
+                        "member_id": member_id,
+                        "experiment_id": experiment_id,
+                        "variable_id": variable_id,
+                        "table_id": table_id,
+                        "grid_label": "gn",
+                        "frequency": "mon",
+                        "path": str(rel_dir / fname),
+                        "size": fp.stat().st_size,
+                        "checksum": file_checksum(fp),
+                    }
+                )
+    return catalogue
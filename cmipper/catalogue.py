@@ -0,0 +1,332 @@
+import argparse
+import sqlite3
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from cmipper import config, utils
+
+"""
+Catalogue of local holdings: every netcdf file written by the pipeline, with the variables, plevel, grid type, region,
+years and levels parsed from its name (see utils.FileName.from_fname), in SQLite with an R-tree over
+(latitude, longitude, year) so that queries like "which files cover this region and these years, for these
+variables" don't walk or parse the data directory.
+
+Files are recorded as the pipeline writes them. Files written before the catalogue existed are added by scanning a
+directory once (which is incremental: only new or changed files are parsed, and vanished ones are dropped).
+"""
+
+# extent recorded for uncropped files and files without a date range, which cover any region or years queried
+GLOBAL_LATS = [-90.0, 90.0]
+GLOBAL_LONS = [-180.0, 360.0]
+ALL_YEARS = [-1e6, 1e6]
+
+
+class HoldingsCatalogue:
+    """Persistent SQLite catalogue of local files, indexed by region and years."""
+
+    def __init__(self, catalogue_fp: str | Path = config.catalogue_fp):
+        """
+        Args:
+            catalogue_fp (str | Path, optional): path to SQLite database. Defaults to config.catalogue_fp.
+        """
+        self.catalogue_fp = Path(catalogue_fp)
+        if not self.catalogue_fp.parent.exists():
+            self.catalogue_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, source_id TEXT, member_id TEXT, "
+                "variable_id TEXT NOT NULL, plevel TEXT, grid_type TEXT NOT NULL, fname_type TEXT NOT NULL, "
+                "date_range TEXT, lev_min INTEGER, lev_max INTEGER, size INTEGER, mtime_ns INTEGER);"
+                "CREATE VIRTUAL TABLE IF NOT EXISTS files_index USING rtree("
+                "id, min_lat, max_lat, min_lon, max_lon, start_year, end_year);"
+                "CREATE TABLE IF NOT EXISTS file_variables ("
+                "file_id INTEGER NOT NULL, variable_id TEXT NOT NULL, PRIMARY KEY (file_id, variable_id));"
+                "CREATE INDEX IF NOT EXISTS file_variables_by_variable ON file_variables (variable_id);"
+                "CREATE TABLE IF NOT EXISTS scanned_dirs (dir TEXT PRIMARY KEY, scanned REAL);"
+            )
+
+    def _connect(self):
+        # a connection per call keeps the catalogue usable from multiple threads
+        conn = sqlite3.connect(self.catalogue_fp, timeout=30)
+        return utils.CommittingConnection(conn)
+
+    @staticmethod
+    def _delete(conn, path: str):
+        row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM files WHERE id = ?", row)
+            conn.execute("DELETE FROM files_index WHERE id = ?", row)
+            conn.execute("DELETE FROM file_variables WHERE file_id = ?", row)
+
+    def add(self, fp: str | Path, source_id: str = None, member_id: str = None):
+        """Record (or update) a file. Files whose names weren't constructed by utils.FileName are ignored.
+
+        Args:
+            fp (str | Path): path to file
+            source_id, member_id (str, optional): taken from fp's location in config.cmip6_data_dir if not given
+
+        Returns:
+            bool: whether the file was recorded
+        """
+        fp = Path(fp).resolve()
+        if utils.is_tmp_fp(fp) or not fp.exists():
+            return False
+        with self._connect() as conn:
+            return self._insert(conn, fp, source_id, member_id)
+
+    def _insert(self, conn, fp: Path, source_id: str = None, member_id: str = None):
+        """Parse and record fp within the transaction of conn."""
+        # files concatenated by time can't be told from individual files by name alone
+        fname_type = (
+            "time_concatted" if fp.parent.name.startswith("concatted_vars") else None
+        )
+        try:
+            fname = utils.FileName.from_fname(fp.name, fname_type=fname_type)
+        except ValueError:
+            return False
+        if source_id is None or member_id is None:
+            try:
+                source_id, member_id = fp.relative_to(
+                    config.cmip6_data_dir.resolve()
+                ).parts[:2]
+            except ValueError:  # outside the data directory
+                pass
+
+        variable_ids = (
+            fname.variable_id
+            if isinstance(fname.variable_id, list)
+            else [fname.variable_id]
+        )
+        lats = sorted(fname.lats) if fname.lats else GLOBAL_LATS
+        lons = sorted(fname.lons) if fname.lons else GLOBAL_LONS
+        years = fname.get_year_range() or ALL_YEARS
+        levs = sorted(fname.levs) if fname.levs else [None, None]
+        stat = fp.stat()
+        self._delete(conn, str(fp))
+        file_id = conn.execute(
+            "INSERT INTO files (path, source_id, member_id, variable_id, plevel, grid_type, fname_type, "
+            "date_range, lev_min, lev_max, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(fp),
+                source_id,
+                member_id,
+                fname.get_var_str(),
+                fname.get_plevels(),
+                fname.grid_type,
+                fname.fname_type,
+                fname.get_date_range(),
+                *levs,
+                stat.st_size,
+                stat.st_mtime_ns,
+            ),
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO files_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (file_id, *lats, *lons, *years),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO file_variables VALUES (?, ?)",
+            [(file_id, variable_id) for variable_id in variable_ids],
+        )
+        return True
+
+    def remove(self, fp: str | Path):
+        with self._connect() as conn:
+            self._delete(conn, str(Path(fp).resolve()))
+
+    def scan(self, root: str | Path = config.cmip6_data_dir):
+        """Bring the catalogue up to date with the netcdf files under root.
+
+        Only new or changed (by size or modification time) files are parsed, and files no longer present are removed.
+
+        Returns:
+            dict: numbers of files "added" and "removed"
+        """
+        root = Path(root).resolve()
+        with self._connect() as conn:
+            recorded = dict(
+                conn.execute(
+                    "SELECT path, size || ':' || mtime_ns FROM files WHERE path LIKE ?",
+                    (f"{root}/%",),
+                ).fetchall()
+            )
+        added = 0
+        present = set()
+        # a single transaction, so that the scan is fast and is never seen half-done
+        with self._connect() as conn:
+            for fp in root.rglob("*.nc") if root.exists() else []:
+                if utils.is_tmp_fp(fp):
+                    continue
+                present.add(str(fp))
+                stat = fp.stat()
+                if recorded.get(str(fp)) != f"{stat.st_size}:{stat.st_mtime_ns}":
+                    added += self._insert(conn, fp)
+            vanished = set(recorded) - present
+            for path in vanished:
+                self._delete(conn, path)
+            conn.execute(
+                "INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?)",
+                (str(root), time.time()),
+            )
+        return {"added": added, "removed": len(vanished)}
+
+    def has_scanned(self, root: str | Path):
+        """Whether root (or a directory containing it) has been scanned."""
+        root = Path(root).resolve()
+        with self._connect() as conn:
+            scanned = [
+                Path(row[0]) for row in conn.execute("SELECT dir FROM scanned_dirs")
+            ]
+        return any(
+            root == scanned_dir or scanned_dir in root.parents
+            for scanned_dir in scanned
+        )
+
+    def find(
+        self,
+        variables: list[str] = (),
+        lats: list[float, float] = None,
+        lons: list[float, float] = None,
+        year_range: list[int, int] = None,
+        levs: list[int, int] = None,
+        source_id: str = None,
+        member_id: str = None,
+        grid_type: str = None,
+        plevel: str = None,
+        fname_types: list[str] = None,
+    ):
+        """Files containing all of variables, and covering a region, years and levels.
+
+        Args:
+            variables (list[str], optional): variable ids the file must contain. Defaults to () (any).
+            lats, lons (list[float, float], optional): region the file must cover. Defaults to None (any).
+            year_range (list[int, int], optional): [first year, year after last] the file must cover. Defaults to None.
+            levs (list[int, int], optional): level range the file must cover, if it records one. Defaults to None.
+            source_id, member_id, grid_type (str, optional): required values. Defaults to None (any).
+            plevel (str, optional): required plevel, as in filenames (see utils.FileName.get_plevels) e.g. "sfc".
+                Defaults to None (any).
+            fname_types (list[str], optional): types of file to include e.g. ["individual", "time_concatted"].
+                Defaults to None (all).
+
+        Returns:
+            list[Path]: matching files, smallest region first
+        """
+        conditions, params = [], []
+        if lats:
+            conditions.append("r.min_lat <= ? AND r.max_lat >= ?")
+            params += [min(lats), max(lats)]
+        if lons:
+            conditions.append("r.min_lon <= ? AND r.max_lon >= ?")
+            params += [min(lons), max(lons)]
+        if year_range:
+            conditions.append("r.start_year <= ? AND r.end_year >= ?")
+            params += [min(year_range), max(year_range) - 1]
+        if levs:
+            conditions.append(
+                "(f.lev_min IS NULL OR (f.lev_min <= ? AND f.lev_max >= ?))"
+            )
+            params += [min(levs), max(levs)]
+        for column, value in [
+            ("source_id", source_id),
+            ("member_id", member_id),
+            ("grid_type", grid_type),
+            ("plevel", plevel),
+        ]:
+            if value is not None:
+                conditions.append(f"f.{column} = ?")
+                params.append(value)
+        if fname_types:
+            conditions.append(f"f.fname_type IN ({', '.join('?' * len(fname_types))})")
+            params += list(fname_types)
+        variables = sorted(set(variables))
+        if variables:
+            conditions.append(
+                "(SELECT COUNT(*) FROM file_variables v WHERE v.file_id = f.id AND v.variable_id IN "
+                f"({', '.join('?' * len(variables))})) = ?"
+            )
+            params += variables + [len(variables)]
+
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT f.path FROM files_index r JOIN files f ON f.id = r.id "
+                f"WHERE {' AND '.join(conditions) or '1'} "
+                "ORDER BY (r.max_lat - r.min_lat) * (r.max_lon - r.min_lon), f.path",
+                params,
+            ).fetchall()
+        fps = [Path(row[0]) for row in rows]
+        # files deleted outside of the pipeline are dropped when found
+        for fp in [fp for fp in fps if not fp.exists()]:
+            self.remove(fp)
+            fps.remove(fp)
+        return fps
+
+
+@lru_cache(maxsize=None)
+def _get_catalogue(catalogue_fp: str):
+    return HoldingsCatalogue(catalogue_fp=catalogue_fp)
+
+
+def get_catalogue(download_config_dict: dict):
+    """Return the (process-wide) holdings catalogue, or None if disabled in the download config."""
+    if not download_config_dict.get("catalogue", {}).get("enabled", True):
+        return None
+    return _get_catalogue(str(config.catalogue_fp))
+
+
+def record(holdings: HoldingsCatalogue, fp: str | Path):
+    if holdings is not None:
+        holdings.add(fp)
+
+
+def forget(holdings: HoldingsCatalogue, fp: str | Path):
+    if holdings is not None:
+        holdings.remove(fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query (or update) the catalogue of local holdings"
+    )
+    parser.add_argument(
+        "--scan",
+        type=str,
+        nargs="?",
+        const=str(config.cmip6_data_dir),
+        default=None,
+        help="directory to scan for files first (the data directory if none given)",
+    )
+    parser.add_argument("--variables", type=str, nargs="*", default=[])
+    parser.add_argument("--lats", type=float, nargs=2, default=None)
+    parser.add_argument("--lons", type=float, nargs=2, default=None)
+    parser.add_argument("--year_range", type=int, nargs=2, default=None)
+    parser.add_argument("--levs", type=int, nargs=2, default=None)
+    parser.add_argument("--source_id", type=str, default=None)
+    parser.add_argument("--member_id", type=str, default=None)
+    parser.add_argument("--grid_type", type=str, default=None)
+    commandline_args = parser.parse_args()
+
+    holdings = HoldingsCatalogue()
+    if commandline_args.scan:
+        print(
+            f"scanned {commandline_args.scan}: {holdings.scan(commandline_args.scan)}"
+        )
+    tic = time.perf_counter()
+    fps = holdings.find(
+        commandline_args.variables,
+        lats=commandline_args.lats,
+        lons=commandline_args.lons,
+        year_range=commandline_args.year_range,
+        levs=commandline_args.levs,
+        source_id=commandline_args.source_id,
+        member_id=commandline_args.member_id,
+        grid_type=commandline_args.grid_type,
+    )
+    for fp in fps:
+        print(fp)
+    print(f"{len(fps)} file(s) found in {(time.perf_counter() - tic) * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
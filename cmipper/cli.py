@@ -0,0 +1,98 @@
+import argparse
+import time
+
+from cmipper import config, planner, utils
+
+"""
+Command line interface, installed as `cmipper` (see setup.py):
+
+- `cmipper plan`: dry run of a download. Each unit is planned against local holdings (see planner), the files still
+to be fetched found by a (cached) search and listed, and the bytes to transfer and wall time estimated from the search
+index's file sizes and previous runs. Nothing is downloaded or opened, so this takes seconds.
+"""
+
+
+def plan(commandline_args: argparse.Namespace):
+    model_info_dict = utils.read_yaml(config.model_info)
+    download_config_dict = utils.read_yaml(config.download_config)
+    source_ids = commandline_args.source_ids or list(model_info_dict)
+
+    experiment_years = None
+    if commandline_args.year_range:
+        experiment_years = dict(
+            download_config_dict["experiment_ids"],
+            **{
+                experiment_id: commandline_args.year_range
+                for experiment_id in commandline_args.experiment_ids
+                or download_config_dict["experiment_ids"]
+            },
+        )
+    tic = time.perf_counter()
+    with planner.request_download_config(
+        lats=commandline_args.lats,
+        lons=commandline_args.lons,
+        levs=commandline_args.levs,
+        experiment_ids=experiment_years,
+    ):
+        for source_id in source_ids:
+            for member_id in (
+                commandline_args.member_ids or model_info_dict[source_id]["member_ids"]
+            ):
+                print(f"\n{source_id} {member_id}", flush=True)
+                units = planner.plan(
+                    source_id,
+                    member_id,
+                    commandline_args.variable_ids,
+                    commandline_args.experiment_ids,
+                )
+                planner.print_plan(units)
+                work = planner.fetch_work(units, source_id, member_id)
+                print("", flush=True)
+                planner.print_work(units, work)
+                planner.print_estimate(planner.estimate(units, work, source_id))
+    print(f"\nplanned in {time.perf_counter() - tic:.1f}s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="cmipper", description="Download and process CMIP6 data"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    plan_parser = subparsers.add_parser(
+        "plan",
+        help="list the work a download would do, with estimates of bytes and time, without downloading anything",
+    )
+    plan_parser.add_argument(
+        "--source_ids",
+        type=str,
+        nargs="*",
+        default=None,
+        help="defaults to all in model_info.yaml",
+    )
+    plan_parser.add_argument("--member_ids", type=str, nargs="*", default=None)
+    plan_parser.add_argument(
+        "--variable_ids",
+        type=str,
+        nargs="*",
+        default=None,
+        help="defaults to those in download_config.yaml",
+    )
+    plan_parser.add_argument("--experiment_ids", type=str, nargs="*", default=None)
+    plan_parser.add_argument(
+        "--year_range",
+        type=int,
+        nargs=2,
+        default=None,
+        help="[first year, year after last] of each experiment",
+    )
+    plan_parser.add_argument("--lats", type=float, nargs=2, default=None)
+    plan_parser.add_argument("--lons", type=float, nargs=2, default=None)
+    plan_parser.add_argument("--levs", type=int, nargs=2, default=None)
+    commandline_args = parser.parse_args()
+
+    if commandline_args.command == "plan":
+        plan(commandline_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -13,12 +14,21 @@ def get_repo_dir():
 ################################################################################
 
 repo_dir = get_repo_dir()
-data_dir = repo_dir / "data"
-logging_dir = repo_dir / "logs"
-model_info = repo_dir / "model_info.yaml"
-download_config = repo_dir / "download_config.yaml"
+# each may be overridden by an environment variable (inherited by worker processes) e.g. to run the benchmarks
+data_dir = Path(os.environ.get("CMIPPER_DATA_DIR", repo_dir / "data"))
+logging_dir = Path(os.environ.get("CMIPPER_LOGGING_DIR", repo_dir / "logs"))
+model_info = Path(os.environ.get("CMIPPER_MODEL_INFO", repo_dir / "model_info.yaml"))
+download_config = Path(
+    os.environ.get("CMIPPER_DOWNLOAD_CONFIG", repo_dir / "download_config.yaml")
+)
 
 cmip6_data_dir = data_dir / "env_vars" / "cmip6"
+esgf_search_cache_fp = data_dir / "esgf_search_cache.sqlite"
+manifest_fp = data_dir / "job_manifest.sqlite"
+catalogue_fp = data_dir / "holdings_catalogue.sqlite"
+host_state_fp = logging_dir / "host_state.json"
+metrics_dir = logging_dir / "metrics"
+prometheus_fp = logging_dir / "cmipper.prom"
 
 # TODO: automate creation of example figures and videos from downloads. But who has the time?
 # figure_folder = "figures"
@@ -1,20 +1,94 @@
-import requests
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
 
+from cmipper import config, lazy, metrics, throttle, utils
 
-# Below taken from https://hub.binder.pangeo.io/user/pangeo-data-pan--cmip6-examples-ro965nih/lab
-def esgf_search(
+requests = lazy.import_module("requests")
+requests_adapters = lazy.import_module("requests.adapters")
+urllib3_retry = lazy.import_module("urllib3.util.retry")
+
+# connection pooling and retry behaviour shared by all searches
+SEARCH_POOL_SIZE = 16
+SEARCH_MAX_RETRIES = 5
+SEARCH_BACKOFF_FACTOR = 1  # sleeps of 0s, 2s, 4s, 8s... between retries
+SEARCH_TIMEOUT = (10, 120)  # (connect, read) seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide requests session, creating it on first use.
+
+    The session keeps connections to each search server alive between calls and retries (with exponential backoff)
+    on connection errors, timeouts and 5xx responses.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retries = urllib3_retry.Retry(
+                total=SEARCH_MAX_RETRIES,
+                backoff_factor=SEARCH_BACKOFF_FACTOR,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=["GET"],
+                raise_on_status=False,
+            )
+            adapter = requests_adapters.HTTPAdapter(
+                pool_connections=SEARCH_POOL_SIZE,
+                pool_maxsize=SEARCH_POOL_SIZE,
+                max_retries=retries,
+            )
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+
+def _fetch_search_page(client, server, payload, offset, verbose=False):
+    page_payload = dict(payload, offset=offset)
+    url_keys = []
+    for k in page_payload:
+        # multi-valued facets are ORed by the search api
+        values = (
+            page_payload[k] if isinstance(page_payload[k], list) else [page_payload[k]]
+        )
+        url_keys += ["{}={}".format(k, v) for v in values]
+
+    url = "{}/?{}".format(server, "&".join(url_keys))
+    if verbose:
+        print(url)
+    with throttle.request(server, latency_signal=False):
+        r = client.get(url, timeout=SEARCH_TIMEOUT)
+        r.raise_for_status()
+    # retries made by the session's adapter are recorded on the underlying response
+    retries = getattr(getattr(r.raw, "retries", None), "history", ())
+    metrics.add(bytes_in=len(r.content), retries=len(retries))
+    return r.json()["response"]
+
+
+# Below adapted from https://hub.binder.pangeo.io/user/pangeo-data-pan--cmip6-examples-ro965nih/lab
+def esgf_search_docs(
     server="https://esgf-node.llnl.gov/esg-search/search",
-    files_type="OPENDAP",
     local_node=False,
     latest=True,
     project="CMIP6",
     verbose1=False,
-    verbose2=False,
     format="application%2Fsolr%2Bjson",
     use_csrf=False,
+    max_workers=8,
     **search,
 ):
-    client = requests.session()
+    """Return all Solr documents (one per file) matching the search.
+
+    The first page is fetched to find the total number of documents, after which the remaining pages are fetched
+    concurrently by up to max_workers threads. Documents are returned in result order, without duplicates.
+    """
+    client = get_session()
     payload = search
     payload["project"] = project
     payload["type"] = "File"
@@ -23,7 +97,7 @@ def esgf_search(
     if local_node:
         payload["distrib"] = "false"
     if use_csrf:
-        client.get(server)
+        client.get(server, timeout=SEARCH_TIMEOUT)
         if "csrftoken" in client.cookies:
             # Django 1.6 and up
             csrftoken = client.cookies["csrftoken"]
@@ -34,32 +108,313 @@ def esgf_search(
 
     payload["format"] = format
 
-    offset = 0
-    numFound = 10000
+    first_page = _fetch_search_page(client, server, payload, 0, verbose=verbose1)
+    numFound = int(first_page["numFound"])
+    pages = [first_page["docs"]]
+    page_size = len(first_page["docs"])
+
+    if page_size and page_size < numFound:
+        offsets = range(page_size, numFound, page_size)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(offsets)))
+        ) as executor:
+            # map preserves the order of offsets
+            pages.extend(
+                page["docs"]
+                for page in executor.map(
+                    lambda offset: _fetch_search_page(
+                        client, server, payload, offset, verbose=verbose1
+                    ),
+                    offsets,
+                )
+            )
+
+    docs, seen_ids = [], set()
+    for page in pages:
+        for d in page:
+            doc_id = d.get("id", tuple(d.get("url", [])))
+            if doc_id not in seen_ids:
+                seen_ids.add(doc_id)
+                docs.append(d)
+    return docs
+
+
+def urls_from_docs(docs, files_type="OPENDAP", verbose=False):
+    """Extract the urls of the requested type (e.g. OPENDAP, HTTPServer) from Solr documents."""
     all_files = []
     files_type = files_type.upper()
-    while offset < numFound:
-        payload["offset"] = offset
-        url_keys = []
-        for k in payload:
-            url_keys += ["{}={}".format(k, payload[k])]
-
-        url = "{}/?{}".format(server, "&".join(url_keys))
-        if verbose1:
-            print(url)
-        r = client.get(url)
-        r.raise_for_status()
-        resp = r.json()["response"]
-        numFound = int(resp["numFound"])
-        resp = resp["docs"]
-        offset += len(resp)
-        for d in resp:
-            if verbose2:
-                for k in d:
-                    print("{}: {}".format(k, d[k]))
-            url = d["url"]
-            for f in d["url"]:
-                sp = f.split("|")
-                if sp[-1] == files_type:
-                    all_files.append(sp[0].split(".html")[0])
-    return sorted(all_files)
+    for d in docs:
+        if verbose:
+            for k in d:
+                print("{}: {}".format(k, d[k]))
+        for f in d["url"]:
+            sp = f.split("|")
+            if sp[-1].upper() == files_type:
+                all_files.append(sp[0].split(".html")[0])
+    return sorted(set(all_files))
+
+
+def _first(value):
+    # Solr returns some fields as single-item lists
+    return value[0] if isinstance(value, list) and value else value
+
+
+def file_records_from_docs(docs, files_type="HTTPServer"):
+    """Extract urls of the requested type from Solr documents, along with each file's size and checksum.
+
+    Returns:
+        list[dict]: records with keys url, size, checksum and checksum_type, sorted by url
+    """
+    records = {}
+    files_type = files_type.upper()
+    for d in docs:
+        for f in d["url"]:
+            sp = f.split("|")
+            if sp[-1].upper() == files_type:
+                url = sp[0].split(".html")[0]
+                records[url] = {
+                    "url": url,
+                    "size": _first(d.get("size")),
+                    "checksum": _first(d.get("checksum")),
+                    "checksum_type": _first(d.get("checksum_type")),
+                }
+    return [records[url] for url in sorted(records)]
+
+
+def esgf_search(
+    server="https://esgf-node.llnl.gov/esg-search/search",
+    files_type="OPENDAP",
+    verbose2=False,
+    records=False,
+    **search,
+):
+    """Return sorted file urls of files_type matching the search, or file records (see file_records_from_docs) if
+    records is True."""
+    docs = esgf_search_docs(server=server, **search)
+    if records:
+        return file_records_from_docs(docs, files_type=files_type)
+    return urls_from_docs(docs, files_type=files_type, verbose=verbose2)
+
+
+BATCH_SPLIT_FACETS = ("variable_id", "table_id", "grid_label", "experiment_id")
+
+
+def batch_key(variable_id, table_id, grid_label, experiment_id):
+    return "|".join([variable_id, table_id, grid_label, experiment_id])
+
+
+def split_docs_by_facets(docs, files_type="OPENDAP", records=False):
+    """Split Solr documents from a multi-valued search into file url lists per (variable, table, grid, experiment).
+
+    Returns:
+        dict: mapping batch_key(variable_id, table_id, grid_label, experiment_id) to sorted list of file urls (or
+            file records if records is True)
+    """
+    grouped = {}
+    for d in docs:
+        # facet values are returned as single-item lists
+        facets = [
+            d[facet][0] if isinstance(d[facet], list) else d[facet]
+            for facet in BATCH_SPLIT_FACETS
+        ]
+        grouped.setdefault(batch_key(*facets), []).append(d)
+    return {
+        key: (
+            file_records_from_docs(key_docs, files_type=files_type)
+            if records
+            else urls_from_docs(key_docs, files_type=files_type)
+        )
+        for key, key_docs in grouped.items()
+    }
+
+
+def esgf_search_batched(cache=None, files_type="OPENDAP", records=False, **search):
+    """Search ESGF once for multiple variables/experiments/tables by passing lists as facet values.
+
+    Args:
+        cache (ESGFSearchCache, optional): cache to read from and write to. If None, always query ESGF.
+        files_type (str, optional): type of url to return. Defaults to "OPENDAP".
+        records (bool, optional): return file records (see file_records_from_docs) rather than urls. Defaults to
+            False.
+        **search: keyword arguments passed to esgf_search_docs. Values may be lists (ORed together).
+
+    Returns:
+        dict: mapping batch_key(variable_id, table_id, grid_label, experiment_id) to sorted list of file urls
+    """
+    cache_query = dict(search, files_type=files_type, search_mode="batched")
+    if records:
+        cache_query["records"] = True
+    if cache is not None:
+        results = cache.get(cache_query)
+        if results is not None:
+            return results
+
+    results = split_docs_by_facets(
+        esgf_search_docs(**dict(search)), files_type=files_type, records=records
+    )
+    if cache is not None:
+        cache.set(cache_query, results)
+    return results
+
+
+# Search caching
+################################################################################
+
+# facets which identify a search. Any others passed to esgf_search are also included in the key
+CACHE_KEY_FACETS = (
+    "source_id",
+    "member_id",
+    "variable_id",
+    "table_id",
+    "grid_label",
+    "experiment_id",
+    "data_node",
+    "latest",
+)
+
+
+def normalise_query(query: dict) -> str:
+    """Normalise a search query to a string suitable for use as a cache key.
+
+    Args:
+        query (dict): keyword arguments as passed to esgf_search
+
+    Returns:
+        str: JSON string of the query with sorted keys, stringified values and any list values sorted
+    """
+    normalised = {"latest": True}  # esgf_search default
+    for k, v in query.items():
+        if v is None:
+            continue
+        if isinstance(v, (list, tuple, set)):
+            normalised[k] = sorted(str(val) for val in v)
+        else:
+            normalised[k] = str(v).lower() if isinstance(v, bool) else str(v)
+    normalised["latest"] = str(normalised["latest"]).lower()
+    # check all identifying facets are present, even if empty, so keys are consistent
+    for facet in CACHE_KEY_FACETS:
+        normalised.setdefault(facet, None)
+    return json.dumps(normalised, sort_keys=True)
+
+
+class ESGFSearchCache:
+    """Persistent SQLite cache of esgf_search results, keyed on the normalised query."""
+
+    def __init__(
+        self,
+        cache_fp: str | Path = config.esgf_search_cache_fp,
+        ttl_hours: float = 168,
+        refresh: bool = False,
+    ):
+        """
+        Args:
+            cache_fp (str | Path, optional): path to SQLite database. Defaults to config.esgf_search_cache_fp.
+            ttl_hours (float, optional): age (hours) after which cached results are ignored. None for no expiry.
+                Defaults to 168 (one week).
+            refresh (bool, optional): ignore (and overwrite) any cached results. Defaults to False.
+        """
+        self.cache_fp = Path(cache_fp)
+        self.ttl = None if ttl_hours is None else ttl_hours * 3600
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if not self.cache_fp.parent.exists():
+            self.cache_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS searches "
+                "(key TEXT PRIMARY KEY, results TEXT NOT NULL, created REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # a connection per call keeps the cache usable from multiple threads
+        conn = sqlite3.connect(self.cache_fp, timeout=30)
+        return utils.CommittingConnection(conn)
+
+    def get(self, query: dict):
+        """Return cached results for query, or None if absent, expired or refreshing."""
+        result = None
+        if not self.refresh:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT results, created FROM searches WHERE key = ?",
+                    (normalise_query(query),),
+                ).fetchone()
+            if row and (self.ttl is None or time.time() - row[1] <= self.ttl):
+                result = json.loads(row[0])
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def set(self, query: dict, results):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO searches (key, results, created) VALUES (?, ?, ?)",
+                (normalise_query(query), json.dumps(results), time.time()),
+            )
+
+    def invalidate(self, query: dict = None):
+        """Remove cached results for query, or all cached results if query is None."""
+        with self._connect() as conn:
+            if query is None:
+                conn.execute("DELETE FROM searches")
+            else:
+                conn.execute(
+                    "DELETE FROM searches WHERE key = ?", (normalise_query(query),)
+                )
+
+    def purge_expired(self):
+        if self.ttl is None:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM searches WHERE created < ?", (time.time() - self.ttl,)
+            )
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+@lru_cache(maxsize=None)
+def _get_search_cache(cache_fp: str, ttl_hours: float, refresh: bool):
+    return ESGFSearchCache(cache_fp=cache_fp, ttl_hours=ttl_hours, refresh=refresh)
+
+
+def get_search_cache(download_config_dict: dict):
+    """Return the (process-wide) search cache specified by the download config, or None if disabled.
+
+    Sharing a single instance means hit/miss counters accumulate across calls.
+    """
+    search_config = download_config_dict.get("search", {})
+    if not search_config.get("cache", False):
+        return None
+    return _get_search_cache(
+        str(config.esgf_search_cache_fp),
+        search_config.get("cache_ttl_hours", 168),
+        search_config.get("refresh_cache", False),
+    )
+
+
+def cached_esgf_search(cache: ESGFSearchCache = None, **search):
+    """Run esgf_search, returning cached results where available.
+
+    Args:
+        cache (ESGFSearchCache, optional): cache to read from and write to. If None, always query ESGF.
+        **search: keyword arguments passed to esgf_search
+
+    Returns:
+        list: sorted list of file urls (or file records, if search includes records=True)
+    """
+    if cache is None:
+        return esgf_search(**search)
+
+    results = cache.get(search)
+    if results is None:
+        results = esgf_search(**dict(search))
+        cache.set(search, results)
+    return results
@@ -1,7 +1,11 @@
+from __future__ import annotations
+
 from pathlib import Path
 import re
 
-from cmipper import utils, config
+from cmipper import catalogue, lazy, utils, config
+
+xa = lazy.import_module("xarray")
 
 
 def find_files_for_time(filepaths, year_range):
@@ -55,7 +59,7 @@ def extract_lat_lon_ranges_from_fp(file_path):
         return [-9999, -9999], [-9999, -9999]
 
 
-# NEEDS WORK
+# Local holdings
 ################################################################################
 
 
@@ -68,26 +72,38 @@ def find_intersecting_cmip(
     year_range: list[int, int] = [1950, 2014],
     levs: list[int, int] = [0, 20],
 ):
+    """Find a local (lat/lon gridded) file containing all variables, covering the region, years and levels.
 
-    # check whether intersecting cropped file already exists
+    Returns:
+        tuple[xa.Dataset, Path] | tuple[None, None]: the file cropped to the region, and its path
+    """
+    download_config_dict = utils.read_yaml(config.download_config)
+    holdings = catalogue.get_catalogue(download_config_dict)
     cmip6_dir_fp = config.cmip6_data_dir / source_id / member_id
-    # TODO: include levs check
-    correct_area_fps = list(
-        find_files_for_area(cmip6_dir_fp.rglob("*.nc"), lat_range=lats, lon_range=lons),
-    )
-    correct_fps = find_files_for_time(
-        cmip6_dir_fp.rglob("*.nc"), year_range=sorted(year_range)
+    if holdings is None:
+        # without the pipeline recording files as they're written, holdings must be rescanned each time
+        holdings = catalogue.HoldingsCatalogue()
+        holdings.scan(cmip6_dir_fp)
+    elif not holdings.has_scanned(cmip6_dir_fp):
+        # files written before the catalogue existed
+        holdings.scan(cmip6_dir_fp)
+
+    fps = holdings.find(
+        variables,
+        lats=lats,
+        lons=lons,
+        year_range=sorted(year_range),
+        levs=levs,
+        source_id=source_id,
+        member_id=member_id,
+        grid_type="latlon",
     )
-    # TODO: check that also spans full year range
-    if len(correct_fps) > 0:
-        # check that file includes all variables in variables list
-        for fp in correct_area_fps:
-            if all(variable in str(fp) for variable in variables):
-                return (
-                    utils.process_xa_d(xa.open_dataset(fp)).sel(
-                        latitude=slice(min(lats), max(lats)),
-                        longitude=slice(min(lons), max(lons)),
-                    ),
-                    fp,
-                )
+    if fps:
+        return (
+            utils.process_xa_d(xa.open_dataset(fps[0])).sel(
+                latitude=slice(min(lats), max(lats)),
+                longitude=slice(min(lons), max(lons)),
+            ),
+            fps[0],
+        )
     return None, None
@@ -1,52 +1,85 @@
 # file handling
 from pathlib import Path
-import requests
-import xarray as xa
-import re
-import numpy as np
-
-
-# download
-from concurrent.futures import ThreadPoolExecutor
-import subprocess
-
-# from cdo import Cdo
 
 # custom
-from cmipper import config, utils
+from cmipper import config, file_ops, planner, scheduler, utils
 
 
-# TODO: get this checking as a gateway to the main downloading script. But not urgent
 def ensure_cmip6_downloaded(
     variables: list[str],
     source_id: str = "EC-Earth3P-HR",
     member_id: str = "r1i1p2f1",
+    lats: list[float, float] = None,
+    lons: list[float, float] = None,
+    levs: list[int, int] = None,
+    year_range: list[int, int] = None,
+    experiment_id: str = None,
     logging_dir: str = config.logging_dir,
+    dry_run: bool = False,
 ):
+    """Gateway to the download pipeline: download and process only what local holdings are missing.
+
+    Region, levels and years default to those of download_config.yaml. If a single local file already covers the
+    request, nothing is done. Otherwise each (variable, experiment, year, plevel) unit is planned against local
+    holdings (see planner): units already held are skipped, those covered by a wider-region or time-concatenated
+    local product are cropped from it, and only the rest are fetched.
+
+    Args:
+        variables (list[str]): variable ids
+        year_range (list[int, int], optional): [first year, year after last] of experiment_id. Defaults to None.
+        experiment_id (str, optional): experiment to download. Defaults to None (all of the source's experiments).
+        dry_run (bool, optional): only print the plan. Defaults to False.
+
+    Returns:
+        list[dict]: planned units (see planner.plan_variable), empty if a single file already covers the request
+    """
     if not config.cmip6_data_dir.exists():
         config.cmip6_data_dir.mkdir(parents=True, exist_ok=True)
 
-    potential_ds, potential_ds_fp = find_intersecting_cmip(
-        variables=variables,
-        source_id=source_id,
-        member_id=member_id,
-        lats=lats,
-        lons=lons,
-        year_range=year_range,
-        levs=levs,
-    )
-    # if some files are missing, initialise download    TODO: be more circumspect about which downloads
-    if potential_ds is None:
+    download_config_dict = utils.read_yaml(config.download_config)
+    experiment_years = None
+    if experiment_id and year_range:
+        experiment_years = dict(
+            download_config_dict["experiment_ids"], **{experiment_id: year_range}
+        )
+    with planner.request_download_config(
+        lats=lats, lons=lons, levs=levs, experiment_ids=experiment_years
+    ) as request_config_dict:
+        lats = sorted(request_config_dict["lats"])
+        lons = sorted(request_config_dict["lons"])
+        experiment_ids = (
+            [experiment_id]
+            if experiment_id
+            else utils.read_yaml(config.model_info)[source_id]["experiment_ids"]
+        )
+        if len(experiment_ids) == 1:
+            potential_ds, potential_ds_fp = file_ops.find_intersecting_cmip(
+                variables=variables,
+                source_id=source_id,
+                member_id=member_id,
+                lats=lats,
+                lons=lons,
+                year_range=request_config_dict["experiment_ids"][experiment_ids[0]],
+                levs=request_config_dict["levs"],
+            )
+            if potential_ds is not None:
+                print(
+                    f"CMIP6 file with necessary variables spanning latitudes {lats} and longitudes {lons} already exists at: \n{potential_ds_fp}"  # noqa
+                )
+                return []
+
+        units = planner.plan(source_id, member_id, variables, experiment_ids)
+        planner.print_plan(units)
+        if dry_run or all(unit["action"] == "held" for unit in units):
+            return units
+
         if not Path(logging_dir).exists():
             Path(logging_dir).mkdir(parents=True, exist_ok=True)
-
         print("Creating/downloading necessary file(s)...")
-        # TODO: add in other sources/members
-
-    else:
-        print(
-            f"CMIP6 file with necessary variables spanning latitudes {lats} and longitudes {lons} already exists at: \n{potential_ds_fp}"  # noqa
-        )
+        crop_summary, fetch_summary = planner.execute(units, source_id, member_id)
+        scheduler.print_summary(crop_summary)
+        scheduler.print_summary(fetch_summary)
+    return units
 
 
 # DEPRECATED
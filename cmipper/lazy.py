@@ -0,0 +1,38 @@
+import importlib
+
+"""
+Deferred imports of heavy dependencies (xarray, numpy, dask, scipy, requests...), so that importing cmipper (e.g. to
+run the command line interface, or to unpickle a task in a newly-spawned worker process) takes a fraction of a second,
+and each dependency is only loaded by the stage which first uses it.
+
+    xa = lazy.import_module("xarray")
+
+binds a stand-in for the module, imported on first attribute access. Annotations using such modules must therefore
+not be evaluated at definition (`from __future__ import annotations`). The import-time budget is checked by
+benchmarks/import_time.py.
+"""
+
+
+class LazyModule:
+    """Stand-in for a module, imported (thread-safely, by importlib) on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not yet loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def import_module(name: str):
+    """Return a stand-in for module name (e.g. "xarray", "scipy.sparse"), imported on first use."""
+    return LazyModule(name)
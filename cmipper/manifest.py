@@ -0,0 +1,285 @@
+import argparse
+import hashlib
+import sqlite3
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from cmipper import config, utils
+
+"""
+Job manifest: a record, for each (source, member, variable, experiment, plevel, date_range) unit, of the state of each
+stage of the pipeline along with the size and checksum of the file it wrote.
+
+Files are only recorded as done once fully written (and renamed into place), so a file left behind by a killed worker
+is never mistaken for a complete one, and restarts resume where they stopped without re-opening files to check them.
+"""
+
+STAGES = ["og", "regridded", "cropped", "zarr"]
+STATES = ["in_progress", "done", "failed"]
+CHECKSUM_BLOCK_SIZE = 2**20
+
+
+def file_checksum(fp: str | Path):
+    """sha256 hex digest of a file, read in blocks."""
+    sha = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def is_readable(fp: str | Path):
+    """Whether a (netcdf) file opens, as a check on files written before the manifest, which may be incomplete."""
+    import netCDF4
+
+    try:
+        with netCDF4.Dataset(fp):
+            return True
+    except OSError:
+        return False
+
+
+def unit(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    plevel,
+    date_range: str,
+):
+    """Key identifying a unit of work. plevel (None for surface, -1 for seafloor, or a pressure) is stored as text."""
+    return (source_id, member_id, variable_id, experiment_id, str(plevel), date_range)
+
+
+class JobManifest:
+    """Persistent SQLite record of the state of each stage of each unit of work."""
+
+    UNIT_COLUMNS = [
+        "source_id",
+        "member_id",
+        "variable_id",
+        "experiment_id",
+        "plevel",
+        "date_range",
+    ]
+
+    def __init__(
+        self,
+        manifest_fp: str | Path = config.manifest_fp,
+        checksum: bool = False,
+        adopt_existing: bool = False,
+    ):
+        """
+        Args:
+            manifest_fp (str | Path, optional): path to SQLite database. Defaults to config.manifest_fp.
+            checksum (bool, optional): record sha256 of each file written. Defaults to False.
+            adopt_existing (bool, optional): record files written before the manifest existed as done, rather than
+                rewriting them, once opened to check they're readable. Defaults to False.
+        """
+        self.manifest_fp = Path(manifest_fp)
+        self.checksum = checksum
+        self.adopt_existing = adopt_existing
+
+        if not self.manifest_fp.parent.exists():
+            self.manifest_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                + ", ".join(f"{col} TEXT NOT NULL" for col in self.UNIT_COLUMNS)
+                + ", stage TEXT NOT NULL, state TEXT NOT NULL, fp TEXT, size INTEGER, checksum TEXT, "
+                "started REAL, finished REAL, error TEXT, "
+                f"PRIMARY KEY ({', '.join(self.UNIT_COLUMNS)}, stage))"
+            )
+
+    def _connect(self):
+        # a connection per call keeps the manifest usable from multiple threads
+        conn = sqlite3.connect(self.manifest_fp, timeout=30)
+        return utils.CommittingConnection(conn)
+
+    def _where(self, unit_key: tuple, stage: str):
+        return (
+            " AND ".join(f"{col} = ?" for col in self.UNIT_COLUMNS + ["stage"]),
+            unit_key + (stage,),
+        )
+
+    def get(self, unit_key: tuple, stage: str):
+        """Return the record of a stage of a unit as a dict, or None if absent."""
+        where, params = self._where(unit_key, stage)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(f"SELECT * FROM stages WHERE {where}", params).fetchone()
+        return dict(row) if row else None
+
+    def start(self, unit_key: tuple, stage: str, fp: str | Path = None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stages "
+                f"({', '.join(self.UNIT_COLUMNS)}, stage, state, fp, started) "
+                f"VALUES ({', '.join('?' * (len(self.UNIT_COLUMNS) + 4))})",
+                unit_key + (stage, "in_progress", str(fp) if fp else None, time.time()),
+            )
+
+    def complete(self, unit_key: tuple, stage: str, fp: str | Path = None):
+        """Record a stage as done, with the size and (optionally) checksum of the file it wrote."""
+        size = checksum = None
+        if fp is not None:
+            size = Path(fp).stat().st_size
+            checksum = file_checksum(fp) if self.checksum else None
+        record = self.get(unit_key, stage)
+        started = record["started"] if record else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stages "
+                f"({', '.join(self.UNIT_COLUMNS)}, stage, state, fp, size, checksum, started, finished) "
+                f"VALUES ({', '.join('?' * (len(self.UNIT_COLUMNS) + 7))})",
+                unit_key
+                + (
+                    stage,
+                    "done",
+                    str(fp) if fp else None,
+                    size,
+                    checksum,
+                    started,
+                    time.time(),
+                ),
+            )
+
+    def fail(self, unit_key: tuple, stage: str, error: str = None):
+        where, params = self._where(unit_key, stage)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE stages SET state = 'failed', finished = ?, error = ? WHERE {where}",
+                (time.time(), str(error)) + params,
+            )
+
+    def is_done(self, unit_key: tuple, stage: str, fp: str | Path = None):
+        """Whether a stage of a unit is complete, and its file (fp, if given) is the one recorded and still in place
+        with the recorded size.
+
+        The file is not opened: its size is compared against that recorded when it was written. Unit keys don't
+        include the region, so a record of another region's file doesn't count for fp.
+        """
+        record = self.get(unit_key, stage)
+        if record is None or record["state"] != "done":
+            if (
+                record is None
+                and self.adopt_existing
+                and fp is not None
+                and Path(fp).exists()
+                and is_readable(fp)
+            ):
+                self.complete(unit_key, stage, fp)
+                return True
+            return False
+        if fp is None:
+            return True
+        fp = Path(fp)
+        if record["fp"] is not None and Path(record["fp"]) != fp:
+            return False
+        if record["size"] is None:
+            return True
+        return fp.exists() and fp.stat().st_size == record["size"]
+
+    def verify(self, unit_key: tuple, stage: str):
+        """Whether the file recorded for a stage still matches its recorded checksum (reads the whole file)."""
+        record = self.get(unit_key, stage)
+        if record is None or record["checksum"] is None:
+            return False
+        return (
+            Path(record["fp"]).exists()
+            and file_checksum(record["fp"]) == record["checksum"]
+        )
+
+    def progress(self, **filters):
+        """Count units in each state of each stage, optionally filtered by unit columns e.g. variable_id="tos".
+
+        Returns:
+            dict: mapping stage to {state: count}, and to total bytes written ("bytes")
+        """
+        where = " AND ".join(f"{col} = ?" for col in filters) or "1"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT stage, state, COUNT(*), SUM(size) FROM stages WHERE {where} "
+                "GROUP BY stage, state",
+                tuple(str(val) for val in filters.values()),
+            ).fetchall()
+        progress = {}
+        for stage, state, count, nbytes in rows:
+            progress.setdefault(stage, {"bytes": 0})[state] = count
+            progress[stage]["bytes"] += nbytes or 0
+        return progress
+
+
+@lru_cache(maxsize=None)
+def _get_manifest(manifest_fp: str, checksum: bool, adopt_existing: bool):
+    return JobManifest(
+        manifest_fp=manifest_fp, checksum=checksum, adopt_existing=adopt_existing
+    )
+
+
+def get_manifest(download_config_dict: dict):
+    """Return the (process-wide) job manifest specified by the download config, or None if disabled."""
+    manifest_config = download_config_dict.get("manifest", {})
+    if not manifest_config.get("enabled", False):
+        return None
+    return _get_manifest(
+        str(config.manifest_fp),
+        manifest_config.get("checksum", False),
+        manifest_config.get("adopt_existing", False),
+    )
+
+
+def is_done(
+    job_manifest: JobManifest, unit_key: tuple, stage: str, fp: str | Path = None
+):
+    """Whether a stage of a unit is complete. Without a manifest, falls back to checking that fp exists."""
+    if job_manifest is None:
+        return Path(fp).exists()
+    return job_manifest.is_done(unit_key, stage, fp)
+
+
+def start(job_manifest: JobManifest, unit_key: tuple, stage: str, fp=None):
+    if job_manifest is not None:
+        job_manifest.start(unit_key, stage, fp)
+
+
+def complete(job_manifest: JobManifest, unit_key: tuple, stage: str, fp=None):
+    if job_manifest is not None:
+        job_manifest.complete(unit_key, stage, fp)
+
+
+def fail(job_manifest: JobManifest, unit_key: tuple, stage: str, error=None):
+    if job_manifest is not None:
+        job_manifest.fail(unit_key, stage, error)
+
+
+def print_progress(progress: dict):
+    print(f"{'stage':<12}{'done':>8}{'in_progress':>13}{'failed':>8}{'GB':>10}")
+    for stage in STAGES:
+        if stage not in progress:
+            continue
+        counts = progress[stage]
+        print(
+            f"{stage:<12}{counts.get('done', 0):>8}{counts.get('in_progress', 0):>13}"
+            f"{counts.get('failed', 0):>8}{counts['bytes'] / 1e9:>10.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report progress from the job manifest"
+    )
+    for col in JobManifest.UNIT_COLUMNS:
+        parser.add_argument(f"--{col}", type=str, default=None)
+    commandline_args = parser.parse_args()
+    filters = {
+        col: getattr(commandline_args, col)
+        for col in JobManifest.UNIT_COLUMNS
+        if getattr(commandline_args, col) is not None
+    }
+    print_progress(JobManifest(config.manifest_fp).progress(**filters))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+import functools
+import inspect
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import yaml
+
+from cmipper import config
+
+"""
+Per-stage performance metrics: each unit of work of each stage (search, fetch, seafloor, regrid, crop, store, concat,
+merge) records its bytes in and out, wall and CPU time, retries, the peak RSS of its process and outcome.
+
+Records are appended as JSON lines to a file per run (config.metrics_dir / {run_id}.jsonl), shared by all threads and
+worker processes, and aggregated per stage into a Prometheus textfile (config.prometheus_fp), suitable for
+node_exporter's textfile collector, and a summary table.
+
+Stages nest: seafloor extraction is part of fetch, so its time is also counted there. CPU time of units run in threads
+(rather than worker processes) is that of the calling thread only, so excludes e.g. dask's threads. Peak RSS is that
+of the whole process over its lifetime so far (as getrusage reports it), not of the unit alone.
+"""
+
+STAGES = ["search", "fetch", "seafloor", "regrid", "crop", "store", "concat", "merge"]
+COUNTS = ["bytes_in", "bytes_out", "retries"]
+# arguments of measured functions recorded as labels of each unit
+LABELS = [
+    "source_id",
+    "member_id",
+    "variable_id",
+    "experiment_id",
+    "date_range",
+    "plevel",
+]
+# inherited by worker processes, so they write to the same run
+RUN_ID_ENV = "CMIPPER_RUN_ID"
+# seconds between rewrites of the Prometheus textfile while running
+PROMETHEUS_INTERVAL = 30
+
+_local = threading.local()
+_write_lock = threading.Lock()
+_last_prometheus_write = 0.0
+
+
+@functools.lru_cache(maxsize=None)
+def enabled():
+    # read directly (rather than with utils.read_yaml), since utils itself records metrics
+    with open(config.download_config) as f:
+        return (yaml.safe_load(f) or {}).get("metrics", {}).get("enabled", True)
+
+
+def run_id():
+    """Identifier of this run, shared with worker processes. Set on first use."""
+    if RUN_ID_ENV not in os.environ:
+        os.environ[RUN_ID_ENV] = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+    return os.environ[RUN_ID_ENV]
+
+
+def run_fp(run: str = None):
+    return config.metrics_dir / f"{run or run_id()}.jsonl"
+
+
+def peak_rss_mb():
+    """Peak resident set size (MB) of this process so far, which may have been reached by an earlier unit or another
+    thread."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _in_worker_process():
+    return multiprocessing.parent_process() is not None
+
+
+class Measurement:
+    """Counts and timings of a unit of work of a stage."""
+
+    def __init__(self, stage: str, labels: dict):
+        self.stage = stage
+        self.labels = {k: str(v) for k, v in labels.items() if v is not None}
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.status = "done"
+        self.error = None
+        self._lock = threading.Lock()
+        # worker processes run one unit at a time, so process CPU time (including any dask threads) is attributable
+        # to the unit. Threads share their process, so only the calling thread's CPU time is
+        self._cpu_scope = "process" if _in_worker_process() else "thread"
+        self._cpu_clock = (
+            time.process_time if self._cpu_scope == "process" else time.thread_time
+        )
+        self._wall_start = time.perf_counter()
+        self._cpu_start = self._cpu_clock()
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.counts[key] += value or 0
+
+    def finish(self):
+        return {
+            "run_id": run_id(),
+            "time": time.time(),
+            "stage": self.stage,
+            **self.labels,
+            **self.counts,
+            "wall_s": time.perf_counter() - self._wall_start,
+            "cpu_s": self._cpu_clock() - self._cpu_start,
+            "cpu_scope": self._cpu_scope,
+            "peak_rss_mb": peak_rss_mb(),
+            "status": self.status,
+            "error": self.error,
+            "pid": os.getpid(),
+        }
+
+
+def current():
+    """Innermost measurement in progress in this thread, or None."""
+    stack = getattr(_local, "stack", [])
+    return stack[-1] if stack else None
+
+
+def add(measurement: Measurement = None, **counts):
+    """Add counts (e.g. bytes_in, retries) to measurement, or to the innermost one in progress in this thread.
+
+    Does nothing if there is none, so may be called from code run outside of any measured stage.
+    """
+    measurement = measurement or current()
+    if measurement is not None:
+        measurement.add(**counts)
+
+
+@contextmanager
+def measure(stage: str, **labels):
+    """Measure a unit of work of stage, identified by labels (e.g. variable_id, date_range).
+
+    Yields the Measurement, to which counts may also be added from other threads with add(measurement, ...).
+    """
+    measurement = Measurement(stage, labels)
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    _local.stack.append(measurement)
+    try:
+        yield measurement
+    except Exception as e:
+        measurement.status = "failed"
+        measurement.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _local.stack.pop()
+        if enabled():
+            _write(measurement.finish())
+
+
+def measured(stage: str):
+    """Decorator measuring each call of a function as a unit of stage, labelled by its arguments named in LABELS."""
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            with measure(
+                stage, **{key: arguments[key] for key in LABELS if key in arguments}
+            ):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def label(**labels):
+    """Add labels to the innermost measurement in progress in this thread, if any."""
+    measurement = current()
+    if measurement is not None:
+        measurement.labels.update(
+            {k: str(v) for k, v in labels.items() if v is not None}
+        )
+
+
+def record(stage: str, wall_s: float, cpu_s: float = 0.0, **labels_and_counts):
+    """Record a unit of work timed separately (e.g. computed lazily as part of another stage's write)."""
+    if not enabled():
+        return
+    measurement = Measurement(
+        stage, {k: v for k, v in labels_and_counts.items() if k not in COUNTS}
+    )
+    measurement.add(**{k: v for k, v in labels_and_counts.items() if k in COUNTS})
+    entry = measurement.finish()
+    entry.update(wall_s=wall_s, cpu_s=cpu_s)
+    _write(entry)
+
+
+def _write(entry: dict):
+    fp = run_fp()
+    with _write_lock:
+        if not fp.parent.exists():
+            fp.parent.mkdir(parents=True, exist_ok=True)
+        # a single (short) append per record, so lines from concurrent processes don't interleave
+        with open(fp, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    global _last_prometheus_write
+    if (
+        not _in_worker_process()
+        and time.time() - _last_prometheus_write > PROMETHEUS_INTERVAL
+    ):
+        _last_prometheus_write = time.time()
+        try:
+            write_prometheus()
+        except OSError:
+            # metrics are informational: never interrupt processing over them
+            pass
+
+
+def read_records(run: str = None):
+    fp = run_fp(run)
+    if not fp.exists():
+        return []
+    with open(fp) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_history(stages: list[str] = None):
+    """Records of all runs so far (optionally only of stages), e.g. to estimate the duration of a download."""
+    if not config.metrics_dir.exists():
+        return []
+    return [
+        record
+        for fp in sorted(config.metrics_dir.glob("*.jsonl"))
+        for record in read_records(fp.stem)
+        if stages is None or record["stage"] in stages
+    ]
+
+
+def node_throughput(records: list[dict]):
+    """Mean throughput (bytes/s) of a single file transfer from each data node, from completed fetch records.
+
+    Returns:
+        dict: mapping data node to bytes per second
+    """
+    totals = {}
+    for record in records:
+        # fetches skipped due to existing files transfer nothing, and aren't labelled with a node
+        if (
+            record["stage"] != "fetch"
+            or record["status"] != "done"
+            or not record.get("data_node")
+            or not record["bytes_in"]
+        ):
+            continue
+        nbytes, wall_s = totals.get(record["data_node"], (0, 0.0))
+        totals[record["data_node"]] = (
+            nbytes + record["bytes_in"],
+            wall_s + record["wall_s"],
+        )
+    return {
+        data_node: nbytes / wall_s
+        for data_node, (nbytes, wall_s) in totals.items()
+        if wall_s > 0
+    }
+
+
+def unit_durations(records: list[dict]):
+    """Mean wall time (s) of a completed unit of each stage.
+
+    Returns:
+        dict: mapping stage to seconds
+    """
+    totals = {}
+    for record in records:
+        # units skipped due to existing files (or answered from the search cache) read nothing
+        if record["status"] != "done" or not record["bytes_in"]:
+            continue
+        units, wall_s = totals.get(record["stage"], (0, 0.0))
+        totals[record["stage"]] = (units + 1, wall_s + record["wall_s"])
+    return {stage: wall_s / units for stage, (units, wall_s) in totals.items()}
+
+
+def summarise(records: list[dict] = None):
+    """Aggregate records (those of this run by default) per stage.
+
+    Returns:
+        dict: mapping stage to totals of units (by status), counts, wall and CPU time, maximum process peak RSS, and
+            whether any CPU time was of the calling thread only ("thread_cpu")
+    """
+    records = read_records() if records is None else records
+    summary = {}
+    for record in records:
+        stage = summary.setdefault(
+            record["stage"],
+            {
+                "done": 0,
+                "failed": 0,
+                **dict.fromkeys(COUNTS, 0),
+                "wall_s": 0.0,
+                "cpu_s": 0.0,
+                "peak_rss_mb": 0.0,
+                "thread_cpu": False,
+            },
+        )
+        stage[record["status"]] = stage.get(record["status"], 0) + 1
+        for key in COUNTS + ["wall_s", "cpu_s"]:
+            stage[key] += record[key]
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["peak_rss_mb"])
+        # records written before cpu_scope was recorded were timed in the same way
+        stage["thread_cpu"] |= record.get("cpu_scope", "thread") == "thread"
+    return summary
+
+
+def write_prometheus(fp: str | Path = None, summary: dict = None):
+    """Write per-stage totals as a Prometheus textfile (atomically, as the textfile collector requires)."""
+    fp = Path(fp or config.prometheus_fp)
+    summary = summarise() if summary is None else summary
+    metrics = [
+        ("units_total", "counter", "Units of work completed", None),
+        ("bytes_in_total", "counter", "Bytes read", "bytes_in"),
+        ("bytes_out_total", "counter", "Bytes written", "bytes_out"),
+        ("wall_seconds_total", "counter", "Wall time of units", "wall_s"),
+        ("cpu_seconds_total", "counter", "CPU time of units", "cpu_s"),
+        ("retries_total", "counter", "Retried requests and failovers", "retries"),
+        (
+            "peak_rss_bytes",
+            "gauge",
+            "Lifetime peak resident set size of the processes running units (not per unit)",
+            None,
+        ),
+    ]
+    lines = []
+    for name, metric_type, description, key in metrics:
+        lines += [
+            f"# HELP cmipper_stage_{name} {description}",
+            f"# TYPE cmipper_stage_{name} {metric_type}",
+        ]
+        for stage, totals in summary.items():
+            if name == "units_total":
+                for status in ["done", "failed"]:
+                    lines.append(
+                        f'cmipper_stage_{name}{{stage="{stage}",status="{status}"}} {totals[status]}'
+                    )
+            elif name == "peak_rss_bytes":
+                lines.append(
+                    f'cmipper_stage_{name}{{stage="{stage}"}} {totals["peak_rss_mb"] * 2**20:.0f}'
+                )
+            else:
+                lines.append(f'cmipper_stage_{name}{{stage="{stage}"}} {totals[key]}')
+    if not fp.parent.exists():
+        fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+    tmp_fp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp_fp, fp)
+
+
+def print_summary(summary: dict = None):
+    summary = summarise() if summary is None else summary
+    if not summary:
+        return
+    print(
+        f"\n{'stage':<10}{'units':>7}{'failed':>8}{'GB in':>9}{'GB out':>9}{'wall (h)':>10}{'cpu (h)':>9}"
+        f"{'retries':>9}{'process peak RSS (MB)':>23}",
+        flush=True,
+    )
+    for stage in STAGES + sorted(set(summary) - set(STAGES)):
+        if stage not in summary:
+            continue
+        totals = summary[stage]
+        print(
+            f"{stage:<10}{totals['done']:>7}{totals['failed']:>8}{totals['bytes_in'] / 1e9:>9.2f}"
+            f"{totals['bytes_out'] / 1e9:>9.2f}{totals['wall_s'] / 3600:>10.2f}{totals['cpu_s'] / 3600:>8.2f}"
+            f"{'*' if totals['thread_cpu'] else ' '}{totals['retries']:>9}{totals['peak_rss_mb']:>23.0f}",
+            flush=True,
+        )
+    if any(totals["thread_cpu"] for totals in summary.values()):
+        print(
+            "* run in threads: cpu time of the calling thread only, excluding dask's (and other) threads",
+            flush=True,
+        )
+    print(
+        "process peak RSS: maximum over the processes running each stage, of their lifetime peak (not per unit)",
+        flush=True,
+    )
@@ -1,17 +1,33 @@
-import os
-import numpy as np
+from __future__ import annotations
 
+import os
 import time
 import warnings
-import xarray as xa
 import argparse
 
 from pathlib import Path
 import re
-
-from cdo import Cdo
-
-from cmipper import config, utils, downloading, file_ops
+import threading
+
+from cmipper import (
+    catalogue,
+    config,
+    lazy,
+    utils,
+    downloading,
+    file_ops,
+    manifest,
+    metrics,
+    regridding,
+    replicas,
+    throttle,
+    transfer,
+    zarr_store,
+)
+
+dask = lazy.import_module("dask")
+np = lazy.import_module("numpy")
+xa = lazy.import_module("xarray")
 
 """
 Script to download monthly-averaged CMIP6 climate simulation runs from the Earth
@@ -42,54 +58,15 @@ simulations in parallel using this script.
 # Ignore "Missing CF-netCDF variable" warnings from download
 warnings.simplefilter("ignore", UserWarning)
 
+SOURCE_CHUNK_MB = 499  # ceiling on each chunk read from a source file (other than for seafloor extraction)
+
 
-# Download function
+# Search functions
 ################################################################################
 
 
-def download_cmip_variable_data(
-    source_id: str,
-    member_id: str,
-    variable_id: str,
-):
-    """
-    This downloads a single variable, for however many experiments are specified in the source_id_dict.
-    """
-    # read download values
-    source_id_dict = utils.read_yaml(config.model_info)[source_id]
-    download_config_dict = utils.read_yaml(config.download_config)
-
-    # TODO: parallelise by source_id and member_id
+def build_query(source_id_dict: dict, source_id: str, member_id: str, variable_id: str):
     variable_id_dict = source_id_dict["variable_dict"][variable_id]
-
-    # spatial values
-    LATS = sorted(download_config_dict["lats"])
-    LONS = sorted(download_config_dict["lons"])
-    INT_LATS = [int(lat) for lat in LATS]
-    INT_LONS = [int(lon) for lon in LONS]
-    LEVS = sorted([abs(val) for val in download_config_dict["levs"]])
-    RESOLUTION = source_id_dict["resolution"]
-    # processing values
-    do_regrid = download_config_dict["processing"]["do_regrid"]
-    do_delete_og = download_config_dict["processing"]["do_delete_og"]
-    do_crop = download_config_dict["processing"]["do_crop"]
-
-    if do_crop and not do_regrid:
-        print("WARNING: cropping without regridding may lead to unexpected results")
-
-    # file setting
-    download_dir = (
-        config.cmip6_data_dir / source_id / member_id / "newtest"
-    )  # TODO: remove testing folder
-    if not download_dir.exists():
-        download_dir.mkdir(parents=True, exist_ok=True)
-
-    tic = time.time()
-
-    print(f"TIME CREATED: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tic))}")
-    print(f"\nProcessing data for {source_id}, {member_id}, {variable_id}\n")
-
-    # BUILD QUERY
     query = {
         "source_id": source_id,
         "member_id": member_id,
@@ -105,254 +82,1006 @@ def download_cmip_variable_data(
         query["grid_label"] = "gr"
     else:
         query["grid_label"] = "gn"
+    return query
+
+
+@metrics.measured("search")
+def search_variables_batched(source_id: str, member_id: str, variable_ids: list[str]):
+    """Search for all variables and experiments of a source/member with one query per data node.
+
+    Data nodes are tried in order: each (variable, experiment) pair takes its files from the first node on which
+    any are found, as in download_cmip_variable_data. If replicas are enabled, files are gathered from all nodes (and,
+    if distributed, from a search of the whole federation), to be grouped into replicas by search_variable_files.
+
+    Returns:
+        dict: mapping variable_id to a dict of experiment_id: (data_node, file urls), suitable for passing as
+            download_cmip_variable_data's search_results. If transferring over https, file records (with sizes and
+            checksums) replace urls.
+    """
+    source_id_dict = utils.read_yaml(config.model_info)[source_id]
+    download_config_dict = utils.read_yaml(config.download_config)
+    search_cache = downloading.get_search_cache(download_config_dict)
+    https_transfer = (
+        download_config_dict.get("transfer", {}).get("engine", "opendap") == "https"
+    )
+
+    queries = {
+        variable_id: build_query(source_id_dict, source_id, member_id, variable_id)
+        for variable_id in variable_ids
+    }
+    batched_query = {
+        "source_id": source_id,
+        "member_id": member_id,
+        "frequency": source_id_dict["frequency"],
+        "experiment_id": list(source_id_dict["experiment_ids"]),
+    }
+    for facet in ["variable_id", "table_id", "grid_label"]:
+        batched_query[facet] = sorted({query[facet] for query in queries.values()})
+    if download_config_dict.get("search", {}).get("server"):
+        # e.g. another index node, or a local stand-in (see benchmarks)
+        batched_query["server"] = download_config_dict["search"]["server"]
+
+    replicas_config = download_config_dict.get("replicas", {})
+    all_replicas = replicas_config.get("enabled", False)
+    search_nodes = list(source_id_dict["data_nodes"])
+    if all_replicas and replicas_config.get("distributed", False):
+        search_nodes.append(None)  # any node in the federation
+
+    search_results = {variable_id: {} for variable_id in variable_ids}
+    for data_node in search_nodes:
+        missing = [
+            (variable_id, experiment_id)
+            for variable_id in variable_ids
+            for experiment_id in source_id_dict["experiment_ids"]
+            if all_replicas or experiment_id not in search_results[variable_id]
+        ]
+        if not missing:
+            break
+        print(
+            f"searching {data_node or 'all nodes'} for {len(missing)} variable/experiment combinations...",
+            flush=True,
+        )
+        node_query = (
+            dict(batched_query, data_node=data_node) if data_node else batched_query
+        )
+        node_results = downloading.esgf_search_batched(
+            cache=search_cache,
+            # https transfers require urls of whole files, with their sizes and checksums
+            files_type="HTTPServer" if https_transfer else "OPENDAP",
+            records=https_transfer,
+            **node_query,
+        )
+        for variable_id, experiment_id in missing:
+            key = downloading.batch_key(
+                variable_id,
+                queries[variable_id]["table_id"],
+                queries[variable_id]["grid_label"],
+                experiment_id,
+            )
+            if node_results.get(key):
+                found_nodes, found_results = search_results[variable_id].get(
+                    experiment_id, (None, [])
+                )
+                search_results[variable_id][experiment_id] = (
+                    ", ".join(filter(None, [found_nodes, data_node or "all nodes"])),
+                    found_results + node_results[key],
+                )
+    return search_results
+
+
+# Download functions
+################################################################################
+
+
+def fetch_plevels(
+    result: str,
+    variable_id: str,
+    save_fps: dict,
+    levs: list[int, int],
+    lats: list[float, float] = None,
+    lons: list[float, float] = None,
+    year_range: list[int, int] = None,
+    subset_margin: int = 2,
+    seafloor_indices: np.ndarray = None,
+    seafloor_max_memory_mb: float = 1024,
+    seafloor_indices_fp: Path = None,
+    encoding_profile: dict = None,
+):
+    """Open a remote file once, writing each requested pressure level to its own file.
+
+    Args:
+        result (str): url of remote (OPeNDAP) file
+        variable_id (str): variable name
+        save_fps (dict): mapping of plevel to output filepath. A plevel of None denotes a surface variable, -1 the
+            seafloor, and any other value a pressure level
+        levs (list[int, int]): range of level indices to consider for seafloor/pressure levels
+        lats (list[float, float], optional): latitude range to request from server. Defaults to None (global).
+        lons (list[float, float], optional): longitude range to request from server. Defaults to None (global).
+        year_range (list[int, int], optional): years to request from server if subsetting. Defaults to None.
+        subset_margin (int, optional): extra native grid cells around region. Defaults to 2.
+        seafloor_indices (np.ndarray, optional): 2D seafloor level indices, calculated if None and required.
+        seafloor_max_memory_mb (float, optional): memory ceiling for seafloor extraction. Defaults to 1024.
+        seafloor_indices_fp (Path, optional): cache of seafloor indices for the full native grid. Defaults to None.
+        encoding_profile (dict, optional): encoding profile (see utils.netcdf_encoding) of files. Defaults to None.
+
+    Returns:
+        np.ndarray | None: seafloor indices, for reuse with further files on the same grid
+    """
+    level_plevels = [plevel for plevel in save_fps if plevel]
+    # chunked by time, whole in other dimensions (so that seafloor values may be gathered from each chunk). Seafloor
+    # extraction's chunks, one per dask worker, fit within its memory ceiling together
+    ds = transfer.open_dataset(
+        result,
+        chunk_mb=(
+            seafloor_max_memory_mb / utils.dask_workers()
+            if -1 in save_fps
+            else SOURCE_CHUNK_MB
+        ),
+        decode_times=True,  # not all times easily decoded
+    )
+    box = None
+    if lats and lons:
+        box = utils.native_index_box(ds, lats, lons, margin=subset_margin)
+
+    seafloor_tic = time.time()
+    if -1 in save_fps and seafloor_indices is None:
+        # indices are cached for the full native grid, and cut to the region as required
+        print("\tdetermining seafloor indices... ", flush=True)
+        seafloor_indices = utils.load_or_generate_seafloor_indices(
+            ds.isel(lev=slice(min(levs), max(levs))),
+            var=variable_id,
+            indices_fp=seafloor_indices_fp,
+        )
+        if box is not None:
+            seafloor_indices = seafloor_indices[tuple(box.values())]
+    seafloor_index_dur = time.time() - seafloor_tic
+
+    if box is not None:
+        # request only region of interest and required times from server
+        ds = utils.subset_native_grid(ds, lats, lons, year_range, box=box)
+
+    if level_plevels:
+        levels_ds = ds.isel(lev=slice(min(levs), max(levs)))
+
+    # outputs are built lazily and written in a single pass, so that source chunks are read only once
+    outs = {}
+    for plevel, save_fp in save_fps.items():
+        if not plevel:  # if surface variable
+            outs[plevel] = ds[variable_id]
+        elif plevel == -1:  # if seafloor
+            print("\textracting seafloor values...\n", flush=True)
+            out = levels_ds.drop_dims("lev")
+            out[variable_id] = utils.extract_seafloor_vals_lazy(
+                levels_ds[variable_id],
+                seafloor_indices,
+                max_memory_mb=seafloor_max_memory_mb,
+            )
+            outs[plevel] = out
+        else:  # if specified pressure
+            print(
+                f"extracting {plevel / 100:.03f} hPa",
+                flush=True,
+            )
+            outs[plevel] = levels_ds.sel(lev=plevel)[variable_id]
+
+    for plevel, save_fp in save_fps.items():
+        print(
+            f"\tsaving {save_fp.name} file: {save_fp}",
+            flush=True,
+        )
+    tic = time.time()
+    writes = []
+    # write to temporary files, renamed once complete, so that an interrupted transfer leaves no partial files
+    tmp_fps = {plevel: utils.tmp_fp(save_fp) for plevel, save_fp in save_fps.items()}
+    for plevel, out in outs.items():
+        out, encoding = utils.prepare_for_write(out, encoding_profile)
+        writes.append(out.to_netcdf(tmp_fps[plevel], encoding=encoding, compute=False))
+    dask.compute(*writes)
+    for plevel, save_fp in save_fps.items():
+        os.replace(tmp_fps[plevel], save_fp)
+    # includes time taken to transfer data from the server
+    utils.report_write(list(save_fps.values()), time.time() - tic)
+    if -1 in outs:
+        dur = time.time() - tic
+        nbytes = levels_ds[variable_id].nbytes
+        print(
+            f"\tseafloor extraction processed {nbytes / 1e6:.0f} MB in {dur:.1f}s "
+            f"({nbytes / 1e6 / max(dur, 1e-6):.1f} MB/s)",
+            flush=True,
+        )
+        # computed lazily in the same pass as the writes, so timed from index determination to the end of writing
+        metrics.record(
+            "seafloor",
+            wall_s=seafloor_index_dur + dur,
+            variable_id=variable_id,
+            date_range=file_date_range(str(result)),
+            bytes_in=nbytes,
+            bytes_out=save_fps[-1].stat().st_size,
+        )
+
+    return seafloor_indices
+
+
+def get_download_dir(source_id: str, member_id: str):
+    return (
+        config.cmip6_data_dir / source_id / member_id / "newtest"
+    )  # TODO: remove testing folder
+
+
+def processing_settings(source_id: str):
+    """Values from model_info.yaml and download_config.yaml used by each stage of processing a file.
+
+    Returns:
+        dict: settings, keyed by (lowercase) name
+    """
+    source_id_dict = utils.read_yaml(config.model_info)[source_id]
+    download_config_dict = utils.read_yaml(config.download_config)
+    processing = download_config_dict["processing"]
+
+    lats = sorted(download_config_dict["lats"])
+    lons = sorted(download_config_dict["lons"])
+    do_regrid = processing["do_regrid"]
+    do_crop = processing["do_crop"]
+    transfer_config = download_config_dict.get("transfer", {})
+    settings = {
+        "source_id_dict": source_id_dict,
+        "download_config_dict": download_config_dict,
+        # spatial values
+        "lats": lats,
+        "lons": lons,
+        "int_lats": [int(lat) for lat in lats],
+        "int_lons": [int(lon) for lon in lons],
+        "levs": sorted([abs(val) for val in download_config_dict["levs"]]),
+        "resolution": source_id_dict["resolution"],
+        # processing values
+        "do_regrid": do_regrid,
+        "do_delete_og": processing["do_delete_og"],
+        "do_crop": do_crop,
+        "do_subset_remote": processing.get("do_subset_remote", False),
+        "subset_margin": processing.get("subset_margin", 2),
+        "seafloor_max_memory_mb": processing.get("seafloor_max_memory_mb", 1024),
+        "regrid_backend": processing.get("regrid_backend", "cdo"),
+        # regrid and crop in a single operation, without writing the regridded file
+        "chain_crop": do_regrid
+        and do_crop
+        and not processing.get("keep_intermediates", True),
+        # cut native grid to region before regridding onto a regional template
+        "do_crop_native": do_regrid
+        and do_crop
+        and processing.get("do_crop_native", False),
+        "output_backend": download_config_dict.get("output", {}).get(
+            "backend", "netcdf"
+        ),
+        "zarr_chunking": download_config_dict.get("output", {}).get(
+            "zarr_chunking", "time"
+        ),
+        "transfer_config": transfer_config,
+        "transfer_engine": transfer_config.get("engine", "opendap"),
+        "replicas_config": download_config_dict.get("replicas", {}),
+        # records completed stages of each file, so that partially-written files are never treated as complete
+        "job_manifest": manifest.get_manifest(download_config_dict),
+        # catalogue of local files, recorded as they're written (see file_ops.find_intersecting_cmip)
+        "holdings": catalogue.get_catalogue(download_config_dict),
+        "final_stage": "cropped" if do_crop else "regridded" if do_regrid else "og",
+    }
+    if settings["transfer_engine"] not in transfer.TRANSFER_ENGINES:
+        raise ValueError(
+            f"transfer engine must be one of {transfer.TRANSFER_ENGINES}. Instead received '{settings['transfer_engine']}'"
+        )
+    return settings
+
+
+def get_plevels(source_id_dict: dict, variable_id: str):
+    plevels = source_id_dict["variable_dict"][variable_id]["plevels"]
+    return list(plevels) if not isinstance(plevels, list) else plevels
+
+
+def file_paths(
+    settings: dict,
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    date_range: str,
+    plevel,
+):
+    """Filepaths of a file (at a single plevel) at each stage of processing: "og", "regridded" and "cropped"."""
+    download_dir = get_download_dir(source_id, member_id)
+    region = {"lats": settings["int_lats"], "lons": settings["int_lons"]}
+    fpaths = {
+        "og": download_dir
+        / "og_grid"
+        / variable_id
+        / utils.FileName(
+            variable_id=variable_id,
+            grid_type="tripolar",  # TODO: get this info from the associated dataset
+            fname_type="individual",
+            levs=settings["levs"],
+            date_range=date_range,
+            plevels=plevel,
+            # remotely-subset files only cover the region (plus margin)
+            **(region if settings["do_subset_remote"] else {}),
+        ).construct_fname(),
+        "regridded": download_dir
+        / "regridded"
+        / variable_id
+        / utils.FileName(
+            variable_id=variable_id,
+            grid_type="latlon",
+            fname_type="individual",
+            plevels=plevel,
+            levs=settings["levs"],
+            date_range=date_range,
+            # regridded onto regional template
+            **(region if settings["do_crop_native"] else {}),
+        ).construct_fname(),
+        "cropped": download_dir
+        / "regridded"
+        / f"cropped_{utils.lat_lon_string_from_tuples(settings['int_lats'], settings['int_lons']).upper()}"
+        / variable_id
+        / utils.FileName(
+            variable_id=variable_id,
+            grid_type="latlon",
+            fname_type="individual",
+            levs=settings["levs"],
+            plevels=plevel,
+            date_range=date_range,
+            **region,
+        ).construct_fname(),
+    }
+    if settings["chain_crop"]:
+        # regridded and cropped in a single operation
+        fpaths["regridded"] = fpaths["cropped"]
+    return fpaths
+
+
+def remap_template_fps(settings: dict, source_id: str):
+    """(global, regridding) remap templates. The regridding template is regional if cutting the native grid."""
+    # describes the global target grid, so is shared by all variables, members and runs
+    global_template_fp = (
+        config.cmip6_data_dir / source_id / f"{source_id}_remap_template.txt"
+    )
+    if not settings["do_crop_native"]:
+        return global_template_fp, global_template_fp
+    return global_template_fp, global_template_fp.with_name(
+        f"{global_template_fp.stem}_{utils.lat_lon_string_from_tuples(settings['int_lats'], settings['int_lons']).upper()}.txt"
+    )
+
+
+def file_date_range(result: str):
+    return result.split("_")[-1].split(".")[0]
+
+
+_template_lock = threading.Lock()
+
+
+@metrics.measured("search")
+def search_variable_files(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    search_results: dict = None,
+    records: bool = False,
+):
+    """Search for a variable's files within each experiment's date range.
+
+    search_results (optional) maps experiment_id to (data_node, file urls) as returned by search_variables_batched,
+    in which case no searches are made. If records is True, file records (with sizes) are returned whatever the
+    transfer engine, e.g. to estimate the size of a download (see planner).
+
+    If replicas are enabled, all data nodes (and optionally the whole federation) are searched, and each file's
+    copies grouped. Otherwise files are taken from the first data node on which any are found.
+
+    Returns:
+        dict: mapping experiment_id to a list, for each file, of (url, record) of each of its replicas. Records (with
+            sizes and checksums) are only returned for https transfers (or if records is True), and are otherwise
+            None.
+    """
+    settings = processing_settings(source_id)
+    source_id_dict = settings["source_id_dict"]
+    download_config_dict = settings["download_config_dict"]
+
+    query = build_query(source_id_dict, source_id, member_id, variable_id)
+    if settings["transfer_engine"] == "https" or records:
+        # whole files, with their sizes and checksums
+        query.update({"files_type": "HTTPServer", "records": True})
+    if download_config_dict.get("search", {}).get("server"):
+        query["server"] = download_config_dict["search"]["server"]
 
     print("\n\n{}: ".format(variable_id), end="", flush=True)
     print("searching ESGF servers... \n", end="", flush=True)
-    results = []
+    search_cache = downloading.get_search_cache(download_config_dict)
+    all_replicas = settings["replicas_config"].get("enabled", False)
+    search_nodes = list(source_id_dict["data_nodes"])
+    if all_replicas and settings["replicas_config"].get("distributed", False):
+        search_nodes.append(None)  # any node in the federation
 
+    files = {}
     for experiment_id in source_id_dict["experiment_ids"]:
         query["experiment_id"] = experiment_id
 
-        experiment_id_results = []
-        for data_node in source_id_dict["data_nodes"]:
-            query["data_node"] = data_node
-            # EXECUTE QUERY
-            experiment_id_results.extend(downloading.esgf_search(**query))
-
-            # Keep looping over possible data nodes until the experiment data is found
-            if len(experiment_id_results) > 0:
-                print("\nfound {}, ".format(experiment_id), end="", flush=True)
-                results.extend(experiment_id_results)
-                break  # Break out of the loop over data nodes when data found
-
-        results = list(set(results))  # remove any duplicate values
+        if search_results is not None:
+            # already found by batched search
+            data_node, experiment_id_results = search_results.get(
+                experiment_id, ("any", [])
+            )
+        else:
+            experiment_id_results = []
+            found_nodes = []
+            for data_node in search_nodes:
+                node_query = dict(query, data_node=data_node) if data_node else query
+                # EXECUTE QUERY
+                node_results = downloading.cached_esgf_search(
+                    cache=search_cache, **node_query
+                )
+                experiment_id_results.extend(node_results)
+                if node_results:
+                    found_nodes.append(data_node or "all nodes")
+
+                # Keep looping over possible data nodes until the experiment data is found (or over all nodes, to
+                # find every replica)
+                if len(experiment_id_results) > 0 and not all_replicas:
+                    break  # Break out of the loop over data nodes when data found
+            data_node = ", ".join(found_nodes)
+
+        if len(experiment_id_results) > 0:
+            print("\nfound {}, ".format(experiment_id), end="", flush=True)
+        results, records = transfer.split_records(experiment_id_results)
+        file_replicas = replicas.group_replicas(
+            results, records, data_nodes=source_id_dict["data_nodes"]
+        )
 
         YEAR_RANGE = sorted(download_config_dict["experiment_ids"][experiment_id])
         # skip any unrequired dates
-        relevant_results = file_ops.find_files_for_time(results, year_range=YEAR_RANGE)
+        relevant_fnames = file_ops.find_files_for_time(
+            list(file_replicas), year_range=YEAR_RANGE
+        )
         print(
-            f"""found {len(results)} files on {data_node} node of which {len(relevant_results)}
-            fall(s) within required date range.""".format(
-                end="", flush=True
-            )
+            f"""found {len(file_replicas)} files on {data_node} node(s) of which {len(relevant_fnames)}
+            fall(s) within required date range.""",
+            flush=True,
+        )
+        files[experiment_id] = [file_replicas[fname] for fname in relevant_fnames]
+
+    if search_cache is not None:
+        print(
+            f"ESGF search cache: {search_cache.hits} hits, {search_cache.misses} misses",
+            flush=True,
         )
+    return files
+
+
+def fetch_from_replica(
+    settings: dict,
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    url: str,
+    record: dict,
+    save_fps: dict,
+    needs_template: bool,
+):
+    """Fetch a file from one replica, generating the global remapping template if required and writing each
+    plevel in save_fps to its file on the native grid.
 
-        # SET UP FILE PATHS REFERENCING
-        fpaths_og = {}
-        fpaths_regridded = {}
-
-        plevels = (
-            list(variable_id_dict["plevels"])
-            if not isinstance(variable_id_dict["plevels"], list)
-            else variable_id_dict["plevels"]
-        )
-        for plevel in plevels:
-            # reset indices for each level
-            seafloor_indices = None
-            failed_regrids = []
-
-            print("downloading individual files... ", flush=True)
-            ind_download_dir = download_dir / "og_grid" / variable_id
-            if not ind_download_dir.exists():
-                ind_download_dir.mkdir(parents=True, exist_ok=True)
-
-            for i, result in enumerate(relevant_results):
-                date_range = result.split("_")[-1].split(".")[0]
-
-                fname_og = utils.FileName(
-                    variable_id=variable_id,
-                    grid_type="tripolar",  # TODO: get this info from the associated dataset
-                    fname_type="individual",
-                    levs=LEVS,
-                    date_range=date_range,
-                    plevels=plevel,
-                ).construct_fname()
-
-                print(
-                    f"\n{i}: handling {fname_og}",
-                    flush=True,
+    Returns:
+        int: bytes transferred (approximated by those written, for OPeNDAP)
+    """
+    download_config_dict = settings["download_config_dict"]
+    date_range = file_date_range(url)
+    global_template_fp, _ = remap_template_fps(settings, source_id)
+    source = url
+    nbytes = 0
+    if settings["transfer_engine"] == "https":
+        print(
+            f"\t{date_range}: transferring whole file over https from {replicas.data_node_of(url)}...",
+            flush=True,
+        )
+        source = transfer.download_record(
+            record or {"url": url},
+            get_download_dir(source_id, member_id) / "transferred" / variable_id,
+            connections=settings["transfer_config"].get("connections", 4),
+            block_size=int(
+                settings["transfer_config"].get("block_size_mb", 16) * 2**20
+            ),
+        )
+        nbytes = source.stat().st_size
+
+    if needs_template:
+        with _template_lock:
+            if not global_template_fp.exists():
+                # template describes the global grid, so is generated from the full (lazily-opened) dataset
+                utils.generate_remapping_file(
+                    transfer.open_dataset(source, decode_times=False),
+                    remap_template_fp=global_template_fp,
+                    resolution=settings["resolution"],
+                    out_grid="latlon",
                 )
 
-                save_fp = ind_download_dir / fname_og
+    if save_fps:
+        # seafloor indices depend only on the grid, so are cached alongside the remap template and reused by all
+        # variables, members and runs
+        query = build_query(
+            settings["source_id_dict"], source_id, member_id, variable_id
+        )
+        levs = settings["levs"]
+        seafloor_indices_fp = (
+            config.cmip6_data_dir
+            / source_id
+            / f"{source_id}_{query['grid_label']}_seafloor_indices_levs_{min(levs)}-{max(levs)}.npy"
+        )
+        # OPEN ONCE AND EXTRACT ALL REQUIRED PRESSURE LEVELS
+        # (each read over OPeNDAP occupies a slot of the data node, see transfer.open_dataset)
+        fetch_plevels(
+            source,
+            variable_id,
+            save_fps,
+            levs=levs,
+            lats=settings["lats"] if settings["do_subset_remote"] else None,
+            lons=settings["lons"] if settings["do_subset_remote"] else None,
+            year_range=sorted(download_config_dict["experiment_ids"][experiment_id]),
+            subset_margin=settings["subset_margin"],
+            seafloor_max_memory_mb=settings["seafloor_max_memory_mb"],
+            seafloor_indices_fp=seafloor_indices_fp,
+            encoding_profile=utils.get_encoding_profile(download_config_dict, "og"),
+        )
+        if source == url:
+            # bytes transferred, approximated by those written
+            nbytes = sum(save_fp.stat().st_size for save_fp in save_fps.values())
 
-                if save_fp.exists():
-                    print(
-                        f"\t{i}: skipping download due to existing file: {save_fp}",
-                        flush=True,
-                    )
-                    fpaths_og[i] = save_fp
-                else:
-                    # OPEN AND SELECT CORRECT PRESSURE LEVELS
-                    if not plevel:  # if surface variable: chunk by time
-                        ds = xa.open_dataset(
-                            result, decode_times=True, chunks={"time": "499MB"}
-                        )[variable_id]
-                    else:  # if seafloor or specified pressure, open with limited levels, chunked spatially
-                        ds = xa.open_dataset(
-                            result,
-                            decode_times=True,  # not all times easily decoded
-                            chunks={"i": "499MB"},
-                        ).isel(lev=slice(min(LEVS), max(LEVS)))
-                        if plevel == -1:  # if seafloor
-                            if (
-                                seafloor_indices is None
-                            ):  # if seafloor indices not yet calculated, calculate
-                                print("\tdetermining seafloor indices... ", flush=True)
-                                seafloor_indices = utils.gen_seafloor_indices(
-                                    ds.isel(time=0),
-                                    var=variable_id,
-                                )
-                                seafloor_indices = np.broadcast_to(
-                                    seafloor_indices,
-                                    (
-                                        len(ds.time),
-                                        len(ds.j),
-                                        len(ds.i),
-                                    ),  # these variable names may differ by model
-                                )
-
-                            print("\textracting seafloor values...\n", flush=True)
-                            cmip6_array = utils.extract_seafloor_vals(
-                                ds[variable_id], seafloor_indices
-                            )
-                            ds[variable_id] = (["time", "j", "i"], cmip6_array)
-                        else:  # if surface
-                            print(
-                                f"extracting {plevel / 100:.03f} hPa",
-                                flush=True,
-                            )
-                            ds = ds.sel(lev=plevel)[variable_id]
+    if source != url and not settings["transfer_config"].get("keep_files", False):
+        # everything required has been extracted from the whole file
+        os.remove(source)
+    return nbytes
 
-                    print(
-                        f"\t{i}: saving {fname_og} file: {save_fp}",
-                        flush=True,
-                    )
-                    fpaths_og[i] = save_fp
-                    # TODO: change dtype?
-                    ds.to_netcdf(save_fp)
-
-                if do_regrid:
-                    regrid_dir_fp = download_dir / "regridded" / variable_id
-                    if not regrid_dir_fp.exists():
-                        regrid_dir_fp.mkdir(parents=True, exist_ok=True)
-                    remap_template_fp = (
-                        config.cmip6_data_dir
-                        / source_id
-                        / f"{source_id}_remap_template.txt"
-                    )
-                    if not remap_template_fp.exists():
-                        utils.generate_remapping_file(
-                            ds,
-                            remap_template_fp=remap_template_fp,
-                            resolution=RESOLUTION,
-                            out_grid="latlon",
-                        )
-                    # initialise instance of Cdo for regridding
-                    cdo = Cdo()
-
-                    fname_regrid = utils.FileName(
-                        variable_id=variable_id,
-                        grid_type="latlon",
-                        fname_type="individual",
-                        plevels=plevel,
-                        levs=LEVS,
-                        date_range=date_range,
-                    ).construct_fname()
-                    # add to list of regridded files
-                    fpaths_regridded[i] = regrid_dir_fp / fname_regrid
-
-                    if not fpaths_regridded[i].exists():
-                        print(f"\t{i}: regridding to {fpaths_regridded[i]}...")
-                        try:
-                            cdo.remapbil(  # TODO: different types of regridding. Will have to update filenames
-                                str(remap_template_fp),
-                                input=str(fpaths_og[i]),
-                                output=str(fpaths_regridded[i]),
-                            )
-                        except:  # noqa # TODO: find proper exception
-                            print(
-                                f"regridding failed for {fpaths_og[i]}, skipping...",
-                                flush=True,
-                            )
-                            failed_regrids.append(fpaths_og[i])
-                            continue
-                    else:
-                        print(
-                            f"\t{i}: skipping regrid due to existing file: {fpaths_regridded[i]}",
-                            flush=True,
-                        )
-                        # TODO: process_xa_d on these files then re-waving
-
-                    if do_delete_og:
-                        print(fpaths_og[i])
-                        os.remove(fpaths_og[i])
-
-                    ds = xa.open_dataset(fpaths_regridded[i])
-
-                if do_crop:
-                    cropped_dir_name = f"cropped_{utils.lat_lon_string_from_tuples(INT_LATS, INT_LONS).upper()}"
-                    cropped_dir_fp = (
-                        download_dir / "regridded" / cropped_dir_name / variable_id
-                    )
-                    if not cropped_dir_fp.exists():
-                        cropped_dir_fp.mkdir(parents=True, exist_ok=True)
-
-                    fname_cropped = utils.FileName(
-                        variable_id=variable_id,
-                        grid_type="latlon",
-                        fname_type="individual",
-                        lats=INT_LATS,
-                        lons=INT_LONS,
-                        levs=LEVS,
-                        plevels=plevel,
-                        date_range=date_range,
-                    ).construct_fname()
-
-                    cropped_save_fp = cropped_dir_fp / fname_cropped
-                    if not cropped_save_fp.exists():
-                        # N.B. may be different between models, and may need to include levs
-                        ds = utils.process_xa_d(ds).sel(
-                            latitude=slice(min(LATS), max(LATS)),
-                            longitude=slice(min(LONS), max(LONS)),
-                        )
-                        print(
-                            f"\t{i}: saving {fname_cropped} file: {cropped_save_fp}",
-                            flush=True,
-                        )
-                        # TODO: change dtype?
-                        ds.to_netcdf(cropped_save_fp)
-                    else:
-                        print(
-                            f"\t{i}: skipping cropping due to existing file: {cropped_save_fp}",
-                            flush=True,
-                        )
-
-        download_tic = time.time() - tic
-        actions_undertaken = [
-            action
-            for action, flag in [("regridding", do_regrid), ("cropping", do_crop)]
-            if flag
-        ]
-        message = (
-            f"Downloading/{'/'.join(actions_undertaken)}"
-            if actions_undertaken
-            else "Downloading"
+
+@metrics.measured("fetch")
+def fetch_file(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    file_replicas: list,
+):
+    """Download a file, extracting each of the variable's pressure levels (and the region, if subsetting remotely)
+    to its own file on the native grid.
+
+    The file is fetched from the replica expected to be fastest (see cmipper.replicas), failing over to the others
+    in turn should its transfer fail (see transfer.TransferError). Local failures are raised straight away.
+
+    Args:
+        file_replicas (list): (url, record) of each replica of the file, as returned by search_variable_files.
+            Records (see downloading.file_records_from_docs) are required only for https transfers.
+
+    Returns:
+        dict: mapping each plevel to its file on the native grid
+    """
+    settings = processing_settings(source_id)
+    job_manifest = settings["job_manifest"]
+    date_range = file_date_range(file_replicas[0][0])
+    metrics.label(date_range=date_range)
+    plevels = get_plevels(settings["source_id_dict"], variable_id)
+    units = {
+        plevel: manifest.unit(
+            source_id, member_id, variable_id, experiment_id, plevel, date_range
         )
+        for plevel in plevels
+    }
+    fpaths_og = {
+        plevel: file_paths(
+            settings, source_id, member_id, variable_id, date_range, plevel
+        )["og"]
+        for plevel in plevels
+    }
+    ind_download_dir = fpaths_og[plevels[0]].parent
+    if not ind_download_dir.exists():
+        ind_download_dir.mkdir(parents=True, exist_ok=True)
+
+    print(
+        f"\n{date_range}: handling {replicas.replica_key(file_replicas[0][0])} "
+        f"({len(file_replicas)} replica(s))",
+        flush=True,
+    )
+
+    pending_plevels = []
+    for plevel, save_fp in fpaths_og.items():
+        # the unit key has no region, so the current configuration's final file must be checked for too
+        final_fp = file_paths(
+            settings, source_id, member_id, variable_id, date_range, plevel
+        )[settings["final_stage"]]
+        if manifest.is_done(job_manifest, units[plevel], "og", save_fp):
+            print(
+                f"\t{date_range}: skipping download due to existing file: {save_fp}",
+                flush=True,
+            )
+        elif (
+            job_manifest is not None
+            and settings["final_stage"] != "og"
+            and job_manifest.is_done(units[plevel], settings["final_stage"], final_fp)
+        ):
+            print(
+                f"\t{date_range}: skipping download since {settings['final_stage']} file already complete",
+                flush=True,
+            )
+        else:
+            pending_plevels.append(plevel)
+
+    global_template_fp, _ = remap_template_fps(settings, source_id)
+    needs_template = settings["do_regrid"] and not global_template_fp.exists()
+    if not pending_plevels and not needs_template:
+        return fpaths_og
+
+    for plevel in pending_plevels:
+        manifest.start(job_manifest, units[plevel], "og", fpaths_og[plevel])
+    ranked = replicas.rank(
+        file_replicas, do_probe=settings["replicas_config"].get("enabled", False)
+    )
+    for i, (url, record) in enumerate(ranked):
+        tic = time.time()
+        try:
+            nbytes = fetch_from_replica(
+                settings,
+                source_id,
+                member_id,
+                variable_id,
+                experiment_id,
+                url,
+                record,
+                {plevel: fpaths_og[plevel] for plevel in pending_plevels},
+                needs_template,
+            )
+        except Exception as e:
+            if not transfer.is_transfer_error(e):
+                # e.g. failing to extract or write the data locally, which another replica wouldn't fix
+                for plevel in pending_plevels:
+                    manifest.fail(job_manifest, units[plevel], "og", e)
+                raise
+            replicas.record_failure(url, e)
+            metrics.add(retries=1)
+            if i == len(ranked) - 1:
+                for plevel in pending_plevels:
+                    manifest.fail(job_manifest, units[plevel], "og", e)
+                raise
+            print(
+                f"\t{date_range}: failing over to {replicas.data_node_of(ranked[i + 1][0])}",
+                flush=True,
+            )
+            continue
+        replicas.record_transfer(url, nbytes, time.time() - tic)
+        metrics.add(bytes_in=nbytes)
+        metrics.label(data_node=replicas.data_node_of(url))
+        break
+
+    for plevel in pending_plevels:
+        manifest.complete(job_manifest, units[plevel], "og", fpaths_og[plevel])
+        catalogue.record(settings["holdings"], fpaths_og[plevel])
+    return fpaths_og
+
+
+@metrics.measured("regrid")
+def regrid_file_unit(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    date_range: str,
+    plevel,
+):
+    """Regrid a downloaded file at a single plevel (and crop it, if not keeping intermediates).
+
+    Returns:
+        Path: regridded (or cropped) file. The native grid file if not regridding.
+    """
+    settings = processing_settings(source_id)
+    job_manifest = settings["job_manifest"]
+    unit = manifest.unit(
+        source_id, member_id, variable_id, experiment_id, plevel, date_range
+    )
+    fpaths = file_paths(settings, source_id, member_id, variable_id, date_range, plevel)
+
+    if settings["do_crop"] and manifest.is_done(
+        job_manifest, unit, "cropped", fpaths["cropped"]
+    ):
         print(
-            f"\n{message} took {np.floor(download_tic / 60):.0f}m:{download_tic % 60:.0f}s."
+            f"\t{date_range}: skipping regridding/cropping due to existing file: {fpaths['cropped']}",
+            flush=True,
         )
+        return fpaths["cropped"]
+    if not settings["do_regrid"]:
+        return fpaths["og"]
+
+    global_template_fp, remap_template_fp = remap_template_fps(settings, source_id)
+    with _template_lock:
+        if not remap_template_fp.exists():
+            regridding.generate_regional_remapping_file(
+                global_template_fp,
+                remap_template_fp,
+                settings["lats"],
+                settings["lons"],
+            )
 
+    fpath_regridded = fpaths["regridded"]
+    if not fpath_regridded.parent.exists():
+        fpath_regridded.parent.mkdir(parents=True, exist_ok=True)
+    regrid_stage = "cropped" if settings["chain_crop"] else "regridded"
+    if manifest.is_done(job_manifest, unit, regrid_stage, fpath_regridded):
         print(
-            f"\n{len(failed_regrids)} regrids failed.\n"
-            if len(failed_regrids) == 0
-            else f"\n{len(failed_regrids)} regrids failed. The following are likely corrupted: \n{failed_regrids}\n"
+            f"\t{date_range}: skipping regrid due to existing file: {fpath_regridded}",
+            flush=True,
         )
+        # TODO: process_xa_d on these files then re-waving
+        return fpath_regridded
+
+    print(f"\t{date_range}: regridding to {fpath_regridded}...")
+    metrics.add(bytes_in=fpaths["og"].stat().st_size)
+    manifest.start(job_manifest, unit, regrid_stage, fpath_regridded)
+    try:
+        regridding.regrid_file(
+            fpaths["og"],
+            fpath_regridded,
+            remap_template_fp,
+            backend=settings["regrid_backend"],
+            crop=(
+                (settings["lats"], settings["lons"]) if settings["chain_crop"] else None
+            ),
+            native_crop=(
+                (settings["lats"], settings["lons"], settings["subset_margin"])
+                if settings["do_crop_native"]
+                else None
+            ),
+            encoding_profile=utils.get_encoding_profile(
+                settings["download_config_dict"], regrid_stage
+            ),
+        )
+    except Exception as e:
+        manifest.fail(job_manifest, unit, regrid_stage, e)
+        raise
+    manifest.complete(job_manifest, unit, regrid_stage, fpath_regridded)
+    catalogue.record(settings["holdings"], fpath_regridded)
+
+    if settings["do_delete_og"]:
+        print(fpaths["og"])
+        os.remove(fpaths["og"])
+        catalogue.forget(settings["holdings"], fpaths["og"])
+    return fpath_regridded
+
+
+@metrics.measured("crop")
+def crop_file_unit(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    date_range: str,
+    plevel,
+    input_fp: str | Path,
+):
+    """Crop a (regridded) file at a single plevel to the region.
+
+    Returns:
+        Path: cropped file, or input_fp if not cropping (or already cropped)
+    """
+    settings = processing_settings(source_id)
+    if not settings["do_crop"] or settings["chain_crop"]:
+        return input_fp
+    job_manifest = settings["job_manifest"]
+    unit = manifest.unit(
+        source_id, member_id, variable_id, experiment_id, plevel, date_range
+    )
+    cropped_save_fp = file_paths(
+        settings, source_id, member_id, variable_id, date_range, plevel
+    )["cropped"]
+    if manifest.is_done(job_manifest, unit, "cropped", cropped_save_fp):
+        return cropped_save_fp
+    if not cropped_save_fp.parent.exists():
+        cropped_save_fp.parent.mkdir(parents=True, exist_ok=True)
+
+    # N.B. may be different between models, and may need to include levs
+    metrics.add(bytes_in=Path(input_fp).stat().st_size)
+    ds = utils.process_xa_d(xa.open_dataset(input_fp)).sel(
+        latitude=slice(min(settings["lats"]), max(settings["lats"])),
+        longitude=slice(min(settings["lons"]), max(settings["lons"])),
+    )
+    print(
+        f"\t{date_range}: saving {cropped_save_fp.name} file: {cropped_save_fp}",
+        flush=True,
+    )
+    manifest.start(job_manifest, unit, "cropped", cropped_save_fp)
+    utils.write_netcdf(
+        ds,
+        cropped_save_fp,
+        utils.get_encoding_profile(settings["download_config_dict"], "cropped"),
+    )
+    manifest.complete(job_manifest, unit, "cropped", cropped_save_fp)
+    catalogue.record(settings["holdings"], cropped_save_fp)
+    return cropped_save_fp
+
+
+@metrics.measured("store")
+def store_file_unit(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    date_range: str,
+    plevel,
+    processed_fp: str | Path,
+):
+    """Append a processed file to its variable's group of the zarr store, if using the zarr output backend."""
+    settings = processing_settings(source_id)
+    if settings["output_backend"] != "zarr":
+        return processed_fp
+    job_manifest = settings["job_manifest"]
+    unit = manifest.unit(
+        source_id, member_id, variable_id, experiment_id, plevel, date_range
+    )
+    if job_manifest is not None and job_manifest.is_done(unit, "zarr"):
+        return processed_fp
+    group = zarr_store.variable_group(
+        variable_id,
+        plevel,
+        settings["levs"],
+        lats=settings["int_lats"] if settings["do_crop"] else None,
+        lons=settings["int_lons"] if settings["do_crop"] else None,
+    )
+    metrics.add(bytes_in=Path(processed_fp).stat().st_size)
+    # a previous append of this file which didn't complete may have left its time steps without their values
+    record = job_manifest.get(unit, "zarr") if job_manifest is not None else None
+    manifest.start(job_manifest, unit, "zarr")
+    try:
+        n_appended = zarr_store.append_to_zarr(
+            processed_fp,
+            zarr_store.zarr_store_fp(
+                get_download_dir(source_id, member_id), experiment_id
+            ),
+            group,
+            chunking=settings["zarr_chunking"],
+            rewrite_existing=record is not None,
+        )
+    except Exception as e:
+        manifest.fail(job_manifest, unit, "zarr", e)
+        raise
+    manifest.complete(job_manifest, unit, "zarr")
+    print(
+        f"\t{date_range}: appended {n_appended} time steps to zarr group {group}",
+        flush=True,
+    )
+    return processed_fp
+
+
+def download_cmip_variable_data(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    search_results: dict = None,
+):
+    """
+    This downloads a single variable, for however many experiments are specified in the source_id_dict.
+
+    Each file is processed in turn by fetch_file, regrid_file_unit, crop_file_unit and store_file_unit (see
+    cmipper.scheduler to run these stages concurrently across files and variables).
+
+    search_results (optional) maps experiment_id to (data_node, file urls) as returned by search_variables_batched,
+    in which case no searches are made for this variable.
+    """
+    settings = processing_settings(source_id)
+    throttle.configure(settings["source_id_dict"].get("node_limits", {}))
+    if settings["do_crop"] and not settings["do_regrid"]:
+        print("WARNING: cropping without regridding may lead to unexpected results")
+
+    download_dir = get_download_dir(source_id, member_id)
+    if not download_dir.exists():
+        download_dir.mkdir(parents=True, exist_ok=True)
+
+    tic = time.time()
+
+    print(f"TIME CREATED: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tic))}")
+    print(f"\nProcessing data for {source_id}, {member_id}, {variable_id}\n")
+
+    files = search_variable_files(source_id, member_id, variable_id, search_results)
+
+    failed_regrids = []
+    print("downloading individual files... ", flush=True)
+    for experiment_id, experiment_files in files.items():
+        for file_replicas in experiment_files:
+            date_range = file_date_range(file_replicas[0][0])
+            fpaths_og = fetch_file(
+                source_id, member_id, variable_id, experiment_id, file_replicas
+            )
+            for plevel in fpaths_og:
+                unit_args = (
+                    source_id,
+                    member_id,
+                    variable_id,
+                    experiment_id,
+                    date_range,
+                    plevel,
+                )
+                try:
+                    processed_fp = regrid_file_unit(*unit_args)
+                except Exception:  # TODO: find proper exception
+                    print(
+                        f"regridding failed for {fpaths_og[plevel]}, skipping...",
+                        flush=True,
+                    )
+                    failed_regrids.append(fpaths_og[plevel])
+                    continue
+                processed_fp = crop_file_unit(*unit_args, processed_fp)
+                store_file_unit(*unit_args, processed_fp)
+
+    download_tic = time.time() - tic
+    actions_undertaken = [
+        action
+        for action, flag in [
+            ("regridding", settings["do_regrid"]),
+            ("cropping", settings["do_crop"]),
+        ]
+        if flag
+    ]
+    message = (
+        f"Downloading/{'/'.join(actions_undertaken)}"
+        if actions_undertaken
+        else "Downloading"
+    )
+    print(
+        f"\n{message} took {np.floor(download_tic / 60):.0f}m:{download_tic % 60:.0f}s."
+    )
+
+    print(
+        f"\n{len(failed_regrids)} regrids failed.\n"
+        if len(failed_regrids) == 0
+        else f"\n{len(failed_regrids)} regrids failed. The following are likely corrupted: \n{failed_regrids}\n"
+    )
 
 
 # Processing (concatenation by time, merging by variables) functions
 ################################################################################
 
 
+SOURCE_SLICES_ATTR = "source_date_ranges"
+
+
+def open_time_slices(nc_fps):
+    """Lazily open files to be concatenated by time, with standardised coordinates and calendar."""
+    metrics.add(bytes_in=sum(Path(fp).stat().st_size for fp in nc_fps))
+    # standardise coordinates, since cropped files written directly by cdo retain its lat/lon names
+    concatted = utils.process_xa_d(xa.open_mfdataset(nc_fps))
+    # decode time
+    return concatted.convert_calendar(
+        "gregorian", dim="time"
+    )  # may not be universal for all models
+
+
+def find_concatted_product(conc_var_dir, fname):
+    """Return the concatenated product for fname, or one for the same variable with a different date range."""
+    if (Path(conc_var_dir) / fname).exists():
+        return Path(conc_var_dir) / fname
+    stem = "_".join(fname.split("_")[:-1])  # drop date range
+    candidates = sorted(
+        fp
+        for fp in Path(conc_var_dir).glob(f"{stem}_*-*.nc")
+        if not utils.is_tmp_fp(fp)
+    )
+    return candidates[-1] if candidates else None
+
+
+def write_concatted_product(
+    slice_fps, concatted_fp, existing_fp=None, encoding_profile=None
+):
+    """(Re)write a concatenated product from all its source slices, recording which slices it contains."""
+    concatted = open_time_slices(list(slice_fps.values()))
+    concatted.attrs[SOURCE_SLICES_ATTR] = " ".join(sorted(slice_fps))
+    print(f"saving concatenated file to {concatted_fp}... ", flush=True)
+    # unlimited time dimension allows later slices to be appended in place
+    utils.write_netcdf(
+        concatted, concatted_fp, encoding_profile, unlimited_dims=["time"]
+    )
+    if existing_fp and Path(existing_fp) != concatted_fp:
+        Path(existing_fp).unlink()
+    return concatted_fp
+
+
+@metrics.measured("concat")
 def concat_cmip_files_by_time(source_id, experiment_id, member_id, variable_id):
     download_dir = (
         config.cmip6_data_dir / source_id / member_id / "newtest"
@@ -368,8 +1097,21 @@ def concat_cmip_files_by_time(source_id, experiment_id, member_id, variable_id):
     LEVS = sorted([abs(val) for val in download_config_dict["levs"]])
     YEAR_RANGE = download_config_dict["experiment_ids"][experiment_id]
 
+    if download_config_dict.get("output", {}).get("backend", "netcdf") == "zarr":
+        # files were appended by time to the zarr store as they were processed
+        print(
+            f"{variable_id} already concatenated by time in "
+            f"{zarr_store.zarr_store_fp(download_dir, experiment_id)}",
+            flush=True,
+        )
+        return
+
     # CONCATENATE BY TIME
     tic = time.time()
+    encoding_profile = utils.get_encoding_profile(
+        download_config_dict, "time_concatted"
+    )
+    holdings = catalogue.get_catalogue(download_config_dict)
 
     conc_var_dir = download_dir / "concatted_vars"
     if DO_CROP:
@@ -397,7 +1139,8 @@ def concat_cmip_files_by_time(source_id, experiment_id, member_id, variable_id):
     #     print(f"{variable_dir} does not exist, skipping", flush=True)
     #     continue
 
-    fps = list(variable_dir.glob("*.nc"))
+    # ignoring any files left partially written by interrupted workers
+    fps = [fp for fp in variable_dir.glob("*.nc") if not utils.is_tmp_fp(fp)]
 
     if YEAR_RANGE:
         oldest_date = str(min(YEAR_RANGE)) + "00"
@@ -424,44 +1167,90 @@ def concat_cmip_files_by_time(source_id, experiment_id, member_id, variable_id):
     ).construct_fname()
     concatted_fp = conc_var_dir / fname
 
-    if concatted_fp.exists():
-        print(f"\nconcatenated file already exists at {str(concatted_fp)}", flush=True)
-    else:
-        # fetch all the filepaths of the files containing dates between oldest_date and newest_date
-        nc_fps = [
-            fp
-            for fp in fps
-            if oldest_date <= str(fp.name).split("_")[-1].split("-")[0]
-            and newest_date >= str(fp.name).split("_")[-1].split("-")[1].split(".")[0]
-        ]
+    # fetch all the filepaths of the files containing dates between oldest_date and newest_date, keyed by date range
+    slice_fps = {
+        str(fp.name).split("_")[-1][: -len(".nc")]: fp
+        for fp in fps
+        if oldest_date <= str(fp.name).split("_")[-1].split("-")[0]
+        and newest_date >= str(fp.name).split("_")[-1].split("-")[1].split(".")[0]
+    }
+    if len(slice_fps) == 0:
+        print(
+            f"skipping {variable_id} since no files found between {oldest_date} and {newest_date}..."
+        )
+        return
+
+    # an earlier concatenation of this variable, possibly over a shorter date range
+    existing_fp = find_concatted_product(conc_var_dir, fname)
+    if existing_fp and existing_fp != concatted_fp:
+        # renamed or rewritten to concatted_fp below
+        catalogue.forget(holdings, existing_fp)
+    included_slices, existing_schema, existing_times = [], None, []
+    if existing_fp:
+        with xa.open_dataset(existing_fp) as existing:
+            included_slices = existing.attrs.get(SOURCE_SLICES_ATTR, "").split()
+            existing_schema = utils.time_schema(existing)
+            existing_times = existing["time"].values
+    new_slices = sorted(set(slice_fps) - set(included_slices))
+
+    if included_slices and not new_slices and set(included_slices) <= set(slice_fps):
+        if existing_fp != concatted_fp:
+            os.replace(existing_fp, concatted_fp)
+        catalogue.record(holdings, concatted_fp)
+        print(
+            f"\nconcatenated file already up to date at {str(concatted_fp)}", flush=True
+        )
+        return
 
-        if len(nc_fps) == 0:
-            print(
-                f"skipping {variable_id} since no files found between {oldest_date} and {newest_date}..."
+    all_slices = sorted(set(slice_fps) | set(included_slices))
+    new_slices_ds = open_time_slices(
+        [slice_fps[date_range] for date_range in new_slices]
+    )
+    if (
+        included_slices
+        and set(included_slices) <= set(slice_fps)
+        and utils.time_schema(new_slices_ds) == existing_schema
+    ):
+        # only read and append the missing slices (including any gaps within the concatenated product's range)
+        new_slices_ds = new_slices_ds.sel(
+            time=~new_slices_ds["time"].isin(existing_times)
+        )
+        print(
+            f"appending {len(new_slices)} new files ({new_slices_ds.sizes['time']} time steps) of "
+            f"{variable_id} to {existing_fp}... ",
+            flush=True,
+        )
+        try:
+            utils.append_to_netcdf_by_time(
+                new_slices_ds,
+                existing_fp,
+                attrs={SOURCE_SLICES_ATTR: " ".join(all_slices)},
             )
-            # continue
-        else:
-
-            print(f"concatenating {variable_id} files by time... ", flush=True)
-
-            concatted = xa.open_mfdataset(nc_fps)
-
-            # decode time
-            concatted = concatted.convert_calendar(
-                "gregorian", dim="time"
-            )  # may not be universal for all models
+            if existing_fp != concatted_fp:
+                os.replace(existing_fp, concatted_fp)
+        except ValueError as e:
+            # e.g. product written without an unlimited time dimension
+            print(f"could not append to {existing_fp} ({e}), rewriting", flush=True)
+            existing_fp = write_concatted_product(
+                slice_fps, concatted_fp, existing_fp, encoding_profile
+            )
+    else:
+        if existing_fp:
             print(
-                f"saving concatenated file to {concatted_fp}... ",
+                f"schema of {variable_id} files changed since {existing_fp} was written, rewriting",
                 flush=True,
             )
-            concatted.to_netcdf(concatted_fp)
+        print(f"concatenating {variable_id} files by time... ", flush=True)
+        write_concatted_product(slice_fps, concatted_fp, existing_fp, encoding_profile)
+    catalogue.record(holdings, concatted_fp)
 
-        time_concat_tic = time.time() - tic
-        print(
-            f"\nConcatenating files by time took {np.floor(time_concat_tic / 60):.0f}m:{time_concat_tic % 60:.0f}s.\n"
-        )
+    time_concat_tic = time.time() - tic
+    print(
+        f"\nConcatenating files by time took {np.floor(time_concat_tic / 60):.0f}m:{time_concat_tic % 60:.0f}s.\n"
+    )
 
 
+@metrics.measured("merge")
 def merge_cmip_data_by_variables(source_id, experiment_id, member_id):
     download_dir = (
         config.cmip6_data_dir / source_id / member_id / "newtest"
@@ -477,6 +1266,12 @@ def merge_cmip_data_by_variables(source_id, experiment_id, member_id):
     LEVS = sorted([abs(val) for val in download_config_dict["levs"]])
     YEAR_RANGE = download_config_dict["experiment_ids"][experiment_id]
 
+    if download_config_dict.get("output", {}).get("backend", "netcdf") == "zarr":
+        # merging variable groups is a lazy operation: nothing is rewritten
+        store_fp = zarr_store.zarr_store_fp(download_dir, experiment_id)
+        print(f"opening merged variables from {store_fp}", flush=True)
+        return zarr_store.open_zarr_merged(store_fp)
+
     tic = time.time()
 
     # MERGE VARIABLES
@@ -516,9 +1311,16 @@ def merge_cmip_data_by_variables(source_id, experiment_id, member_id):
             f"\nmerging variable files and saving to {merged_fp}... ",
             flush=True,
         )
-        dss = [xa.open_dataset(fp) for fp in var_nc_fps]
+        # slices may have been appended to concatenated files out of order
+        metrics.add(bytes_in=sum(Path(fp).stat().st_size for fp in var_nc_fps))
+        dss = [xa.open_dataset(fp).sortby("time") for fp in var_nc_fps]
         merged = xa.merge(dss)
-        merged.to_netcdf(merged_fp)
+        utils.write_netcdf(
+            merged,
+            merged_fp,
+            utils.get_encoding_profile(download_config_dict, "merged"),
+        )
+        catalogue.record(catalogue.get_catalogue(download_config_dict), merged_fp)
 
         var_concat_tic = time.time() - tic
         print(
@@ -0,0 +1,513 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from contextlib import contextmanager
+
+import yaml
+
+from cmipper import (
+    catalogue,
+    config,
+    lazy,
+    manifest,
+    metrics,
+    replicas,
+    scheduler,
+    utils,
+)
+from cmipper import parallelised_download_and_process as pdp
+
+xa = lazy.import_module("xarray")
+
+"""
+Delta planner: compares a request (source, member, experiments, variables and their plevels, region, years and levels)
+against the catalogue of local holdings, and plans each (variable, experiment, year, plevel) unit as one of:
+
+- "held": the processed file is already in place;
+- "crop": a local lat/lon product covering the region and year (a wider-region or global regridded file, or a
+  time-concatenated product) is cut to the region, rather than fetched again;
+- "fetch": nothing local covers it, so it is downloaded and processed.
+
+Only the fetched units' files are then searched for and scheduled.
+
+Before fetching, the files to be fetched (and the bytes to be transferred, and time taken, estimated from previous
+runs) may be listed without downloading or opening anything: see `cmipper plan` (cli.py).
+"""
+
+ACTIONS = ["held", "crop", "fetch"]
+# files which may be cropped to make a unit: single-variable, with the unit's plevel
+CROP_SOURCE_TYPES = ["individual", "time_concatted"]
+
+
+def covers_year(date_range, year: int):
+    """Whether a filename's date range (e.g. "195001-195012", or "195000-201412" once concatenated) covers a year."""
+    if isinstance(date_range, str):
+        date_range = date_range.split("-")
+    start, end = (int(str(date)[:6]) for date in date_range)
+    return start <= year * 100 + 1 and end >= year * 100 + 12
+
+
+def unit_date_range(year: int):
+    return f"{year}01-{year}12"
+
+
+def plan_variable(
+    holdings: catalogue.HoldingsCatalogue,
+    settings: dict,
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    year_range: list[int, int],
+):
+    """Plan each (year, plevel) unit of a variable's experiment.
+
+    Returns:
+        list[dict]: units, with their action, target file and (for crops) source file
+    """
+    grid_type = "latlon" if settings["do_regrid"] else "tripolar"
+    region = (
+        {"lats": settings["lats"], "lons": settings["lons"]}
+        if settings["do_crop"]
+        else {}
+    )
+    units = []
+    for plevel in pdp.get_plevels(settings["source_id_dict"], variable_id):
+        plevel_str = utils.FileName(
+            variable_id, grid_type, "individual", levs=settings["levs"], plevels=plevel
+        ).get_plevels()
+        # one query per plevel: files are then matched to years from their date ranges
+        candidates = [
+            (fp, utils.FileName.from_fname(fp.name).date_range)
+            for fp in holdings.find(
+                [variable_id],
+                **region,
+                levs=settings["levs"],
+                source_id=source_id,
+                member_id=member_id,
+                grid_type=grid_type,
+                plevel=plevel_str,
+                fname_types=CROP_SOURCE_TYPES,
+            )
+        ]
+        for year in range(min(year_range), max(year_range)):
+            date_range = unit_date_range(year)
+            target_fp = pdp.file_paths(
+                settings, source_id, member_id, variable_id, date_range, plevel
+            )[settings["final_stage"]]
+            unit = {
+                "source_id": source_id,
+                "member_id": member_id,
+                "variable_id": variable_id,
+                "experiment_id": experiment_id,
+                "year": year,
+                "plevel": plevel,
+                "target_fp": target_fp,
+                "source_fp": None,
+            }
+            covering = [
+                fp
+                for fp, fp_date_range in candidates
+                if fp_date_range and covers_year(fp_date_range, year)
+            ]
+            if any(fp.parent == target_fp.parent for fp in covering):
+                # processed already (possibly as part of a file spanning several years)
+                unit["action"] = "held"
+            elif covering and settings["final_stage"] == "cropped":
+                # smallest covering region first
+                unit["action"], unit["source_fp"] = "crop", covering[0]
+            else:
+                unit["action"] = "fetch"
+            units.append(unit)
+    return units
+
+
+def plan(
+    source_id: str,
+    member_id: str,
+    variable_ids: list[str] = None,
+    experiment_ids: list[str] = None,
+):
+    """Plan the units of a request, as configured in download_config.yaml (see request_download_config).
+
+    Returns:
+        list[dict]: units (see plan_variable)
+    """
+    settings = pdp.processing_settings(source_id)
+    download_config_dict = settings["download_config_dict"]
+    variable_ids = variable_ids or download_config_dict["variable_ids"]
+    experiment_ids = experiment_ids or settings["source_id_dict"]["experiment_ids"]
+
+    holdings = catalogue.get_catalogue(download_config_dict)
+    member_dir = config.cmip6_data_dir / source_id / member_id
+    if holdings is None:
+        # without the pipeline recording files as they're written, holdings must be rescanned each time
+        holdings = catalogue.HoldingsCatalogue()
+        holdings.scan(member_dir)
+    elif not holdings.has_scanned(member_dir):
+        holdings.scan(member_dir)
+
+    units = []
+    for experiment_id in experiment_ids:
+        year_range = download_config_dict["experiment_ids"][experiment_id]
+        for variable_id in variable_ids:
+            units += plan_variable(
+                holdings,
+                settings,
+                source_id,
+                member_id,
+                variable_id,
+                experiment_id,
+                year_range,
+            )
+    return units
+
+
+def fetch_years(units: list[dict]):
+    """Years to fetch of each (variable_id, experiment_id), for scheduler.schedule_downloads."""
+    years = {}
+    for unit in units:
+        key = (unit["variable_id"], unit["experiment_id"])
+        years.setdefault(key, set())
+        if unit["action"] == "fetch":
+            years[key].add(unit["year"])
+    return years
+
+
+def print_plan(units: list[dict]):
+    counts = {}
+    for unit in units:
+        key = (unit["variable_id"], unit["experiment_id"])
+        counts.setdefault(key, dict.fromkeys(ACTIONS, 0))[unit["action"]] += 1
+    print(
+        f"\n{'variable':<12}{'experiment':<18}"
+        + "".join(f"{action:>8}" for action in ACTIONS),
+        flush=True,
+    )
+    for (variable_id, experiment_id), action_counts in sorted(counts.items()):
+        print(
+            f"{variable_id:<12}{experiment_id:<18}"
+            + "".join(f"{action_counts[action]:>8}" for action in ACTIONS),
+            flush=True,
+        )
+
+
+@metrics.measured("crop")
+def crop_from_holding(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    experiment_id: str,
+    date_range: str,
+    plevel,
+    source_fp,
+    target_fp,
+):
+    """Cut a unit's region and year from a local product covering them, in place of fetching it."""
+    settings = pdp.processing_settings(source_id)
+    unit = manifest.unit(
+        source_id, member_id, variable_id, experiment_id, plevel, date_range
+    )
+    metrics.add(bytes_in=source_fp.stat().st_size)
+    ds = utils.process_xa_d(xa.open_dataset(source_fp))[[variable_id]].sel(
+        latitude=slice(min(settings["lats"]), max(settings["lats"])),
+        longitude=slice(min(settings["lons"]), max(settings["lons"])),
+        time=str(date_range[:4]),
+    )
+    print(
+        f"\t{date_range}: cropping {target_fp.name} from {source_fp}",
+        flush=True,
+    )
+    if not target_fp.parent.exists():
+        target_fp.parent.mkdir(parents=True, exist_ok=True)
+    manifest.start(settings["job_manifest"], unit, "cropped", target_fp)
+    utils.write_netcdf(
+        ds,
+        target_fp,
+        utils.get_encoding_profile(settings["download_config_dict"], "cropped"),
+    )
+    manifest.complete(settings["job_manifest"], unit, "cropped", target_fp)
+    catalogue.record(settings["holdings"], target_fp)
+    return target_fp
+
+
+def crop_tasks(units: list[dict]):
+    return [
+        scheduler.Task(
+            "crop",
+            crop_from_holding,
+            (
+                unit["source_id"],
+                unit["member_id"],
+                unit["variable_id"],
+                unit["experiment_id"],
+                unit_date_range(unit["year"]),
+                unit["plevel"],
+                unit["source_fp"],
+                unit["target_fp"],
+            ),
+            name=f"crop {unit['variable_id']} {unit['experiment_id']} {unit['year']} {unit['plevel']} from holdings",
+        )
+        for unit in units
+        if unit["action"] == "crop"
+    ]
+
+
+@contextmanager
+def request_download_config(**overrides):
+    """Run with values of download_config.yaml overridden (e.g. a requested region), in this and worker processes.
+
+    The overridden config is written to the logging directory, and config.download_config (and its environment
+    variable, inherited by worker processes) pointed at it for the duration.
+    """
+    download_config_dict = utils.read_yaml(config.download_config)
+    overrides = {key: value for key, value in overrides.items() if value is not None}
+    if all(download_config_dict.get(key) == value for key, value in overrides.items()):
+        yield download_config_dict
+        return
+    download_config_dict.update(overrides)
+    contents = yaml.safe_dump(download_config_dict)
+    request_fp = (
+        config.logging_dir
+        / "requests"
+        / f"download_config_{hashlib.sha256(contents.encode()).hexdigest()[:12]}.yaml"
+    )
+    if not request_fp.parent.exists():
+        request_fp.parent.mkdir(parents=True, exist_ok=True)
+    request_fp.write_text(contents)
+
+    previous_fp = config.download_config
+    previous_env = os.environ.get("CMIPPER_DOWNLOAD_CONFIG")
+    config.download_config = request_fp
+    os.environ["CMIPPER_DOWNLOAD_CONFIG"] = str(request_fp)
+    try:
+        yield download_config_dict
+    finally:
+        config.download_config = previous_fp
+        if previous_env is None:
+            os.environ.pop("CMIPPER_DOWNLOAD_CONFIG")
+        else:
+            os.environ["CMIPPER_DOWNLOAD_CONFIG"] = previous_env
+
+
+def execute(units: list[dict], source_id: str, member_id: str):
+    """Crop units from local holdings, then fetch (and concatenate and merge) only what is still missing.
+
+    Returns:
+        tuple[dict, dict]: summaries (see scheduler.Scheduler.summary) of the crop and fetch runs
+    """
+    model_info_dict = utils.read_yaml(config.model_info)
+    download_config_dict = utils.read_yaml(config.download_config)
+    variable_ids = sorted({unit["variable_id"] for unit in units})
+
+    crop_scheduler = scheduler.scheduler_from_config(download_config_dict)
+    for task in crop_tasks(units):
+        crop_scheduler.add(task)
+    crop_summary = crop_scheduler.run()
+
+    fetch_scheduler = scheduler.scheduler_from_config(download_config_dict)
+    scheduler.schedule_downloads(
+        fetch_scheduler,
+        model_info_dict,
+        download_config_dict,
+        source_ids=[source_id],
+        member_ids=[member_id],
+        variable_ids=variable_ids,
+        fetch_years=fetch_years(units),
+    )
+    return crop_summary, fetch_scheduler.run()
+
+
+# Estimates
+################################################################################
+
+
+def transferred_fraction(settings: dict, date_range: str, year_range: list[int, int]):
+    """Fraction of a file expected to be transferred: all of it over https or if not subsetting remotely, otherwise
+    only the requested region (plus margin) and years. Levels aren't accounted for, so estimates are upper bounds.
+    """
+    if settings["transfer_engine"] == "https" or not settings["do_subset_remote"]:
+        return 1.0
+    start, end = (int(date[:4]) for date in date_range.split("-"))
+    file_years = range(start, end + 1)
+    years = len(
+        set(file_years).intersection(range(min(year_range), max(year_range)))
+    ) / len(file_years)
+    margin = settings["subset_margin"] * settings["resolution"]
+    lats, lons = settings["lats"], settings["lons"]
+    return (
+        years
+        * min(1.0, (max(lats) - min(lats) + 2 * margin) / 180)
+        * min(1.0, (max(lons) - min(lons) + 2 * margin) / 360)
+    )
+
+
+def fetch_work(units: list[dict], source_id: str, member_id: str):
+    """Files to fetch for a plan's fetched units, as found by a (cached) search, without opening any.
+
+    Returns:
+        list[dict]: a work unit per file, with its plevels, data node (of its preferred replica), size (from the
+            search index) and the bytes expected to be transferred (None if its size is unknown)
+    """
+    settings = pdp.processing_settings(source_id)
+    years = fetch_years(units)
+    work = []
+    for variable_id in sorted(
+        {unit["variable_id"] for unit in units if unit["action"] == "fetch"}
+    ):
+        plevels = pdp.get_plevels(settings["source_id_dict"], variable_id)
+        # records, since the search index's sizes are required whatever the transfer engine
+        files = pdp.search_variable_files(
+            source_id, member_id, variable_id, records=True
+        )
+        for experiment_id, experiment_files in files.items():
+            year_range = settings["download_config_dict"]["experiment_ids"][
+                experiment_id
+            ]
+            for file_replicas in experiment_files:
+                url, record = file_replicas[0]
+                date_range = pdp.file_date_range(url)
+                if not scheduler.is_fetched(
+                    years, variable_id, experiment_id, date_range
+                ):
+                    continue
+                size = float(record["size"]) if record and record.get("size") else None
+                work.append(
+                    {
+                        "source_id": source_id,
+                        "member_id": member_id,
+                        "variable_id": variable_id,
+                        "experiment_id": experiment_id,
+                        "date_range": date_range,
+                        "plevels": plevels,
+                        "fname": replicas.replica_key(url),
+                        "data_node": replicas.data_node_of(url),
+                        "replicas": len(file_replicas),
+                        "size": size,
+                        "bytes": (
+                            size
+                            * transferred_fraction(settings, date_range, year_range)
+                            if size is not None
+                            else None
+                        ),
+                    }
+                )
+    return work
+
+
+def estimate(units: list[dict], work: list[dict], source_id: str):
+    """Estimate the duration of each stage of carrying out a plan, from previous runs (see metrics.read_history).
+
+    Fetches are timed from the mean throughput of a transfer from each data node (nodes not yet measured are assumed
+    to be average), and units of other stages from their mean duration, each stage running as many units at once as
+    its limit (see scheduler). Since files flow between stages, the wall time is that of the slowest per-file stage,
+    after any crops from holdings and before concatenation and merging.
+
+    Returns:
+        dict: mapping each stage, and "wall", to its estimated duration (s), or None if there's no history for it
+    """
+    settings = pdp.processing_settings(source_id)
+    stage_limits = dict(
+        scheduler.DEFAULT_STAGE_LIMITS,
+        **settings["download_config_dict"].get("scheduler", {}).get("stage_limits", {}),
+    )
+    history = metrics.read_history()
+    throughput = metrics.node_throughput(history)
+    unit_s = metrics.unit_durations(history)
+    mean_throughput = sum(throughput.values()) / len(throughput) if throughput else None
+
+    def stage_s(stage: str, n_units: int):
+        if not n_units:
+            return 0.0
+        if stage not in unit_s:
+            return None
+        return n_units * unit_s[stage] / stage_limits[stage]
+
+    fetch_s = 0.0
+    for file_work in work:
+        node_throughput = throughput.get(file_work["data_node"], mean_throughput)
+        if file_work["bytes"] is not None and node_throughput:
+            fetch_s += file_work["bytes"] / node_throughput
+        elif "fetch" in unit_s:
+            fetch_s += unit_s["fetch"]
+        else:
+            fetch_s = None
+            break
+    n_file_units = sum(len(file_work["plevels"]) for file_work in work)
+    estimates = {
+        "crop from holdings": stage_s(
+            "crop", sum(unit["action"] == "crop" for unit in units)
+        ),
+        "fetch": fetch_s / stage_limits["fetch"] if fetch_s is not None else None,
+        "regrid": stage_s("regrid", n_file_units if settings["do_regrid"] else 0),
+        "crop": stage_s(
+            "crop",
+            n_file_units if settings["do_crop"] and not settings["chain_crop"] else 0,
+        ),
+        # files are only stored (rather than left in place) if appended to a zarr store
+        "store": stage_s(
+            "store", n_file_units if settings["output_backend"] == "zarr" else 0
+        ),
+        "concat": stage_s(
+            "concat",
+            len({(unit["variable_id"], unit["experiment_id"]) for unit in units}),
+        ),
+        "merge": stage_s("merge", len({unit["experiment_id"] for unit in units})),
+    }
+    per_file = [estimates[stage] for stage in ["fetch", "regrid", "crop", "store"]]
+    rest = [estimates[stage] for stage in ["crop from holdings", "concat", "merge"]]
+    estimates["wall"] = None if None in per_file + rest else max(per_file) + sum(rest)
+    return estimates
+
+
+def _format_duration(seconds: float):
+    if seconds is None:
+        return "unknown"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds:.0f} s"
+
+
+def _format_bytes(nbytes: float):
+    if nbytes is None:
+        return "? MB"
+    if nbytes >= 1e9:
+        return f"{nbytes / 1e9:.2f} GB"
+    return f"{nbytes / 1e6:.1f} MB"
+
+
+def print_work(units: list[dict], work: list[dict]):
+    """List each crop from holdings and each file to fetch, with the total bytes to transfer."""
+    for unit in units:
+        if unit["action"] == "crop":
+            print(
+                f"crop  {unit['target_fp'].name} from {unit['source_fp']}", flush=True
+            )
+    for file_work in work:
+        print(
+            f"fetch {file_work['fname']} from {file_work['data_node']} ({file_work['replicas']} replica(s)): "
+            f"plevels {file_work['plevels']}, {_format_bytes(file_work['bytes'])}",
+            flush=True,
+        )
+    known = [file_work for file_work in work if file_work["bytes"] is not None]
+    print(
+        f"\n{len(work)} file(s) to fetch: {_format_bytes(sum(w['size'] for w in known))} in the index, "
+        f"{_format_bytes(sum(w['bytes'] for w in known))} to transfer"
+        + (
+            f" (excluding {len(work) - len(known)} file(s) of unknown size)"
+            if len(known) < len(work)
+            else ""
+        ),
+        flush=True,
+    )
+
+
+def print_estimate(estimates: dict):
+    print(f"\n{'stage':<20}{'estimated time':>16}", flush=True)
+    for stage, seconds in estimates.items():
+        print(f"{stage:<20}{_format_duration(seconds):>16}", flush=True)
+    if estimates["wall"] is None:
+        print("(stages without previous runs to estimate from are unknown)", flush=True)
@@ -0,0 +1,541 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+from cmipper import lazy, utils
+
+np = lazy.import_module("numpy")
+sparse = lazy.import_module("scipy.sparse")
+spatial = lazy.import_module("scipy.spatial")
+xa = lazy.import_module("xarray")
+
+"""
+Regridding of individual files from their native (e.g. tripolar) grid onto the regular latitude/longitude grid
+described by a CDO grid description file (see utils.generate_remapping_file).
+
+Two backends are available, selected by `processing: regrid_backend` in download_config.yaml:
+- "cdo": bilinear remapping by a cdo subprocess per file. Weights are generated once per source grid (genbil) and
+reused (remap), and cropping is chained into the same cdo call where requested.
+- "sparse-linear": linear (barycentric, over a triangulation of the source grid) interpolation weights from each
+source grid to the target grid are calculated once, saved as a sparse matrix, and applied in-process to every time step
+by a (dask-chunked) sparse matrix multiplication. These are not bilinear weights, so outputs differ slightly from cdo's.
+"""
+
+REGRID_BACKENDS = ["cdo", "sparse-linear"]
+# former names of backends
+REGRID_BACKEND_ALIASES = {"sparse": "sparse-linear"}
+
+# weights already loaded in this process, by filepath
+_weights = {}
+_weights_lock = threading.Lock()
+
+
+# Target grid
+################################################################################
+
+
+def read_remapping_file(remap_template_fp: str | Path):
+    """Read a CDO grid description file (as written by utils.generate_remapping_file) into a dictionary."""
+    remap_info = {}
+    with open(remap_template_fp, "r") as file:
+        for line in file:
+            if "=" not in line:
+                continue
+            key, value = [part.strip() for part in line.split("=", 1)]
+            remap_info[key] = value if key == "gridtype" else float(value)
+    return remap_info
+
+
+def target_grid_coords(remap_info: dict):
+    """Return 1D (latitude, longitude) cell centres of the regular grid described by remap_info."""
+    lats = (
+        remap_info["yfirst"] + np.arange(int(remap_info["ysize"])) * remap_info["yinc"]
+    )
+    lons = (
+        remap_info["xfirst"] + np.arange(int(remap_info["xsize"])) * remap_info["xinc"]
+    )
+    return lats, lons
+
+
+def generate_regional_remapping_file(
+    remap_template_fp: str | Path,
+    regional_template_fp: str | Path,
+    lats: list[float, float],
+    lons: list[float, float],
+):
+    """Write a grid description covering only lats/lons, with cell centres matching those of the global template."""
+    remap_info = read_remapping_file(remap_template_fp)
+    tgt_lats, tgt_lons = target_grid_coords(remap_info)
+    region_lats = tgt_lats[(tgt_lats >= min(lats)) & (tgt_lats <= max(lats))]
+    region_lons = tgt_lons[(tgt_lons >= min(lons)) & (tgt_lons <= max(lons))]
+    if len(region_lats) == 0 or len(region_lons) == 0:
+        raise ValueError(
+            f"No cells of {remap_template_fp} within latitudes {lats} and longitudes {lons}"
+        )
+
+    print(f"Saving regional regridding info to {regional_template_fp}...")
+    with open(regional_template_fp, "w") as file:
+        file.write(
+            f"gridtype = {remap_info['gridtype']}\n"
+            f"xsize = {len(region_lons)}\n"
+            f"ysize = {len(region_lats)}\n"
+            f"xfirst = {region_lons[0]}\n"
+            f"yfirst = {region_lats[0]}\n"
+            f"xinc = {remap_info['xinc']}\n"
+            f"yinc = {remap_info['yinc']}\n"
+        )
+
+
+def native_box_for_file(
+    og_fp: str | Path,
+    lats: list[float, float],
+    lons: list[float, float],
+    margin: int = 2,
+):
+    """Return the native grid index box of og_fp covering lats/lons (plus margin), or None if this is the whole grid."""
+    with xa.open_dataset(og_fp) as ds:
+        box = utils.native_index_box(ds, lats, lons, margin=margin)
+        full_sizes = [ds.sizes[dim] for dim in box]
+    if all(
+        sl.start == 0 and sl.stop == size for sl, size in zip(box.values(), full_sizes)
+    ):
+        return None
+    return box
+
+
+# Weights
+################################################################################
+
+
+def compute_interpolation_weights(
+    src_lats: np.ndarray,
+    src_lons: np.ndarray,
+    tgt_lats: np.ndarray,
+    tgt_lons: np.ndarray,
+    lon_halo: float = 2,
+):
+    """Calculate linear interpolation weights from a (curvilinear) source grid to a regular target grid.
+
+    The source points are triangulated in longitude/latitude space and each target point is assigned the barycentric
+    weights of the three vertices of its enclosing triangle. For smoothly-varying grids this is close to, but not
+    the same as, bilinear interpolation. Source points within lon_halo degrees of the periodic boundary are duplicated across it
+    so that targets on the boundary are enclosed. Targets outside the source grid have no weights.
+
+    Args:
+        src_lats (np.ndarray): source latitudes (any shape)
+        src_lons (np.ndarray): source longitudes (same shape as src_lats)
+        tgt_lats (np.ndarray): 1D target latitudes
+        tgt_lons (np.ndarray): 1D target longitudes
+        lon_halo (float, optional): width (degrees) of periodic halo. Defaults to 2.
+
+    Returns:
+        scipy.sparse.csr_matrix: (len(tgt_lats) * len(tgt_lons), src_lats.size) weights matrix
+    """
+    src_lats = np.asarray(src_lats, dtype=float).ravel()
+    lon_origin = float(np.min(tgt_lons))
+    # express source longitudes in the target's [origin, origin + 360) range
+    src_lons = (
+        np.asarray(src_lons, dtype=float).ravel() - lon_origin
+    ) % 360 + lon_origin
+    src_inds = np.arange(src_lats.size)
+
+    west_halo = src_lons < lon_origin + lon_halo
+    east_halo = src_lons >= lon_origin + 360 - lon_halo
+    points = np.concatenate(
+        [
+            np.column_stack([src_lons, src_lats]),
+            np.column_stack([src_lons[west_halo] + 360, src_lats[west_halo]]),
+            np.column_stack([src_lons[east_halo] - 360, src_lats[east_halo]]),
+        ]
+    )
+    point_inds = np.concatenate([src_inds, src_inds[west_halo], src_inds[east_halo]])
+
+    valid = np.isfinite(points).all(axis=1)
+    points, point_inds = points[valid], point_inds[valid]
+
+    tgt_lat_grid, tgt_lon_grid = np.meshgrid(tgt_lats, tgt_lons, indexing="ij")
+    targets = np.column_stack([tgt_lon_grid.ravel(), tgt_lat_grid.ravel()])
+
+    tri = spatial.Delaunay(points)
+    simplices = tri.find_simplex(targets)
+    found = simplices >= 0
+    # barycentric coordinates of each target within its triangle
+    transforms = tri.transform[simplices[found]]
+    bary = np.einsum(
+        "ijk,ik->ij", transforms[:, :2, :], targets[found] - transforms[:, 2, :]
+    )
+    bary = np.column_stack([bary, 1 - bary.sum(axis=1)])
+
+    rows = np.repeat(np.nonzero(found)[0], 3)
+    cols = point_inds[tri.simplices[simplices[found]]].ravel()
+    weights = sparse.csr_matrix(
+        (bary.ravel(), (rows, cols)), shape=(len(targets), src_lats.size)
+    )
+    # duplicate entries (e.g. from halo points) are summed on conversion
+    weights.eliminate_zeros()
+    return weights
+
+
+def weights_fp_for_grid(
+    weights_dir: str | Path,
+    src_lats,
+    src_lons,
+    remap_template_fp: str | Path,
+    suffix: str = "npz",
+):
+    """Return path to the weights file for a source grid and target grid.
+
+    The name includes a hash of the source coordinates and target grid description, so different source grids (e.g.
+    global and regionally-subset files) never share weights.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(src_lats, dtype=float).tobytes())
+    hasher.update(np.ascontiguousarray(src_lons, dtype=float).tobytes())
+    hasher.update(Path(remap_template_fp).read_bytes())
+    return (
+        Path(weights_dir)
+        / f"{Path(remap_template_fp).stem}_weights_{hasher.hexdigest()[:12]}.{suffix}"
+    )
+
+
+def load_or_compute_weights(weights_fp: str | Path, src_lats, src_lons, remap_info):
+    """Return interpolation weights, from memory or weights_fp if available, otherwise calculating and saving them."""
+    weights_fp = Path(weights_fp)
+    with _weights_lock:
+        if weights_fp in _weights:
+            return _weights[weights_fp]
+
+        if weights_fp.exists():
+            weights = sparse.load_npz(weights_fp).tocsr()
+        else:
+            tic = time.time()
+            print(
+                f"\tcalculating regridding weights for {weights_fp.name}...", flush=True
+            )
+            tgt_lats, tgt_lons = target_grid_coords(remap_info)
+            weights = compute_interpolation_weights(
+                src_lats, src_lons, tgt_lats, tgt_lons
+            )
+            if not weights_fp.parent.exists():
+                weights_fp.parent.mkdir(parents=True, exist_ok=True)
+            tmp_fp = weights_fp.with_name(f"{weights_fp.stem}.{os.getpid()}.tmp.npz")
+            sparse.save_npz(tmp_fp, weights)
+            os.replace(tmp_fp, weights_fp)
+            print(
+                f"\tsaved regridding weights to {weights_fp} ({time.time() - tic:.1f}s)",
+                flush=True,
+            )
+        _weights[weights_fp] = weights
+        return weights
+
+
+# Backends
+################################################################################
+
+
+def _apply_weights(vals, weights, out_shape):
+    # vals: (..., y, x). Missing (NaN) source values make any target they contribute to missing, as in remapbil
+    lead_shape = vals.shape[:-2]
+    flat = vals.reshape(-1, vals.shape[-2] * vals.shape[-1])
+    missing = np.isnan(flat)
+    interpolated = weights.dot(np.where(missing, 0, flat).T).T
+    contributing = weights.dot((~missing).astype(flat.dtype).T).T
+    total = np.asarray(weights.sum(axis=1)).ravel()
+    interpolated[(contributing < total - 1e-6) | (total == 0)] = np.nan
+    return interpolated.reshape(lead_shape + tuple(out_shape)).astype(vals.dtype)
+
+
+def regrid_sparse(
+    og_fp: str | Path,
+    out_fp: str | Path,
+    remap_template_fp: str | Path,
+    weights_dir: str | Path = None,
+    time_chunk: int = 12,
+    lat_name: str = "latitude",
+    lon_name: str = "longitude",
+    crop: tuple[list[float], list[float]] = None,
+    native_box: dict = None,
+    encoding_profile: dict = None,
+):
+    """Regrid a file onto the grid described by remap_template_fp using cached sparse interpolation weights.
+
+    If crop is specified, only the target cells within the region are interpolated, and the output is processed
+    (coordinates renamed and sorted) as for cropped files.
+
+    Args:
+        og_fp (str | Path): file on native grid, with 2D latitude/longitude coordinates
+        out_fp (str | Path): output filepath
+        remap_template_fp (str | Path): CDO grid description of target grid
+        weights_dir (str | Path, optional): directory in which to cache weights. Defaults to alongside template.
+        time_chunk (int, optional): number of time steps regridded at once. Defaults to 12.
+        lat_name (str, optional): name of source latitude coordinate. Defaults to "latitude".
+        lon_name (str, optional): name of source longitude coordinate. Defaults to "longitude".
+        crop (tuple[list[float], list[float]], optional): (lats, lons) ranges to crop to. Defaults to None.
+        native_box (dict, optional): native grid index box (see utils.native_index_box) to which the file is cut
+            before regridding. Defaults to None.
+        encoding_profile (dict, optional): encoding profile (see utils.netcdf_encoding) of output. Defaults to None.
+    """
+    remap_info = read_remapping_file(remap_template_fp)
+    tgt_lats, tgt_lons = target_grid_coords(remap_info)
+    weights_dir = (
+        Path(remap_template_fp).parent / "regrid_weights"
+        if weights_dir is None
+        else weights_dir
+    )
+
+    ds = xa.open_dataset(og_fp, chunks={"time": time_chunk})
+    if native_box:
+        ds = ds.isel(native_box)
+    src_lats, src_lons = ds[lat_name].values, ds[lon_name].values
+    spatial_dims = list(ds[lat_name].dims)
+    weights = load_or_compute_weights(
+        weights_fp_for_grid(weights_dir, src_lats, src_lons, remap_template_fp),
+        src_lats,
+        src_lons,
+        remap_info,
+    )
+    if crop is not None:
+        # interpolate only the target cells within the region
+        in_lats = (tgt_lats >= min(crop[0])) & (tgt_lats <= max(crop[0]))
+        in_lons = (tgt_lons >= min(crop[1])) & (tgt_lons <= max(crop[1]))
+        lat_inds, lon_inds = np.nonzero(in_lats)[0], np.nonzero(in_lons)[0]
+        weights = weights[(lat_inds[:, None] * len(tgt_lons) + lon_inds).ravel()]
+        tgt_lats, tgt_lons = tgt_lats[lat_inds], tgt_lons[lon_inds]
+
+    regridded = xa.Dataset(attrs=ds.attrs)
+    for var_name, da in ds.data_vars.items():
+        if not set(spatial_dims).issubset(da.dims) or var_name in (lat_name, lon_name):
+            continue  # e.g. cell bounds
+        da = da.chunk({dim: -1 for dim in spatial_dims})
+        regridded[var_name] = xa.apply_ufunc(
+            _apply_weights,
+            da,
+            input_core_dims=[spatial_dims],
+            output_core_dims=[["lat", "lon"]],
+            dask="parallelized",
+            output_dtypes=[da.dtype],
+            dask_gufunc_kwargs={
+                "output_sizes": {"lat": len(tgt_lats), "lon": len(tgt_lons)}
+            },
+            kwargs={"weights": weights, "out_shape": (len(tgt_lats), len(tgt_lons))},
+        ).assign_attrs(da.attrs)
+    regridded = regridded.assign_coords(lat=tgt_lats, lon=tgt_lons)
+    regridded.lat.attrs.update({"standard_name": "latitude", "units": "degrees_north"})
+    regridded.lon.attrs.update({"standard_name": "longitude", "units": "degrees_east"})
+    if crop is not None:
+        regridded = utils.process_xa_d(regridded)
+    regridded, encoding = utils.prepare_for_write(regridded, encoding_profile)
+    regridded.to_netcdf(out_fp, encoding=encoding)
+
+
+def _cdo_input(og_fp: str | Path, native_box: dict = None):
+    if not native_box:
+        return str(og_fp)
+    # selindexbox takes 1-based, inclusive indices in (x, y) order
+    y_slice, x_slice = native_box.values()
+    return (
+        f"-selindexbox,{x_slice.start + 1},{x_slice.stop},{y_slice.start + 1},{y_slice.stop} "
+        f"{og_fp}"
+    )
+
+
+def load_or_generate_cdo_weights(
+    og_fp: str | Path,
+    remap_template_fp: str | Path,
+    weights_dir: str | Path,
+    native_box: dict = None,
+    lat_name: str = "latitude",
+    lon_name: str = "longitude",
+):
+    """Return path to cdo bilinear weights from og_fp's grid (optionally cut to native_box) to the template grid,
+    generating them if necessary."""
+    with xa.open_dataset(og_fp) as ds:
+        if native_box:
+            ds = ds.isel(native_box)
+        weights_fp = weights_fp_for_grid(
+            weights_dir,
+            ds[lat_name].values,
+            ds[lon_name].values,
+            remap_template_fp,
+            suffix="nc",
+        )
+    with _weights_lock:
+        if not weights_fp.exists():
+            # imported on use, so that planning downloads (see planner) neither imports nor requires cdo
+            from cdo import Cdo
+
+            print(f"\tgenerating cdo weights {weights_fp.name}...", flush=True)
+            if not weights_fp.parent.exists():
+                weights_fp.parent.mkdir(parents=True, exist_ok=True)
+            tmp_fp = weights_fp.with_name(f"{weights_fp.stem}.{os.getpid()}.tmp.nc")
+            Cdo().genbil(
+                str(remap_template_fp),
+                input=_cdo_input(og_fp, native_box),
+                output=str(tmp_fp),
+            )
+            os.replace(tmp_fp, weights_fp)
+    return weights_fp
+
+
+def regrid_cdo(
+    og_fp: str | Path,
+    out_fp: str | Path,
+    remap_template_fp: str | Path,
+    weights_fp: str | Path = None,
+    crop: tuple[list[float], list[float]] = None,
+    native_box: dict = None,
+    options: str = "",
+):
+    """Bilinearly regrid og_fp with cdo, reusing precomputed weights and chaining a crop if specified.
+
+    Args:
+        og_fp (str | Path): file on native grid
+        out_fp (str | Path): output filepath
+        remap_template_fp (str | Path): CDO grid description of target grid
+        weights_fp (str | Path, optional): weights generated by cdo genbil. Defaults to None (calculated by remapbil).
+        crop (tuple[list[float], list[float]], optional): (lats, lons) ranges to crop to (sellonlatbox) in the same
+            cdo call. Defaults to None.
+        native_box (dict, optional): native grid index box (see utils.native_index_box) to which the file is cut
+            (selindexbox) before regridding. Defaults to None.
+        options (str, optional): cdo command line options e.g. output compression (see utils.cdo_options).
+            Defaults to "".
+    """
+    from cdo import Cdo
+
+    # initialise instance of Cdo for regridding
+    cdo = Cdo()
+    # TODO: different types of regridding. Will have to update filenames
+    if weights_fp is not None:
+        remap_operator = f"remap,{remap_template_fp},{weights_fp}"
+    else:
+        remap_operator = f"remapbil,{remap_template_fp}"
+
+    if crop is not None:
+        lats, lons = crop
+        # operators are chained, so no regridded file is written
+        cdo.sellonlatbox(
+            f"{min(lons)},{max(lons)},{min(lats)},{max(lats)}",
+            input=f"-{remap_operator} {_cdo_input(og_fp, native_box)}",
+            output=str(out_fp),
+            options=options,
+        )
+    else:
+        operator, args = remap_operator.split(",", 1)
+        getattr(cdo, operator)(
+            args,
+            input=_cdo_input(og_fp, native_box),
+            output=str(out_fp),
+            options=options,
+        )
+
+
+def regrid_file(
+    og_fp: str | Path,
+    out_fp: str | Path,
+    remap_template_fp: str | Path,
+    backend: str = "cdo",
+    crop: tuple[list[float], list[float]] = None,
+    reuse_weights: bool = True,
+    native_crop: tuple[list[float], list[float], int] = None,
+    encoding_profile: dict = None,
+):
+    """Regrid og_fp onto the grid described by remap_template_fp, writing to out_fp, with the specified backend.
+
+    The output is written to a temporary file and renamed once complete (or removed if regridding fails).
+    If crop ((lats, lons) ranges) is specified, the output is also cropped, without writing the regridded file.
+    If native_crop ((lats, lons, margin)) is specified, og_fp is first cut to the native grid cells covering the
+    region, so that regridding (best used with a regional template) scales with the size of the region.
+    encoding_profile (see utils.netcdf_encoding) is applied to the output, as closely as cdo allows for that backend.
+
+    Returns:
+        int: bytes written
+    """
+    tic = time.time()
+    backend = REGRID_BACKEND_ALIASES.get(backend, backend)
+    if backend not in REGRID_BACKENDS:
+        raise ValueError(
+            f"regrid_backend must be one of {REGRID_BACKENDS}. Instead received '{backend}'"
+        )
+    final_fp, out_fp = out_fp, utils.tmp_fp(out_fp)
+    weights_dir = Path(remap_template_fp).parent / "regrid_weights"
+    native_box = native_box_for_file(og_fp, *native_crop) if native_crop else None
+    try:
+        if backend == "cdo":
+            weights_fp = (
+                load_or_generate_cdo_weights(
+                    og_fp, remap_template_fp, weights_dir, native_box=native_box
+                )
+                if reuse_weights
+                else None
+            )
+            regrid_cdo(
+                og_fp,
+                out_fp,
+                remap_template_fp,
+                weights_fp=weights_fp,
+                crop=crop,
+                native_box=native_box,
+                options=utils.cdo_options(encoding_profile),
+            )
+        else:
+            regrid_sparse(
+                og_fp,
+                out_fp,
+                remap_template_fp,
+                weights_dir,
+                crop=crop,
+                native_box=native_box,
+                encoding_profile=encoding_profile,
+            )
+        os.replace(out_fp, final_fp)
+    finally:
+        # don't leave a partial file if regridding failed
+        if out_fp.exists():
+            out_fp.unlink()
+    return utils.report_write([final_fp], time.time() - tic)
+
+
+def benchmark_regrid_backends(
+    og_fp: str | Path,
+    remap_template_fp: str | Path,
+    out_dir: str | Path,
+    backends: list[str] = REGRID_BACKENDS,
+    repeats: int = 2,
+):
+    """Time each backend regridding the same file, and compare their outputs.
+
+    The first sparse-linear run includes calculation of the weights; subsequent runs reuse them.
+
+    Returns:
+        dict: mapping backend name to list of durations (s), plus "max_abs_diff" between backends' outputs
+    """
+    out_dir = Path(out_dir)
+    if not out_dir.exists():
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    timings, out_fps = {}, {}
+    for backend in backends:
+        timings[backend] = []
+        for repeat in range(repeats):
+            out_fps[backend] = out_dir / f"{Path(og_fp).stem}_{backend}_{repeat}.nc"
+            tic = time.time()
+            regrid_file(og_fp, out_fps[backend], remap_template_fp, backend=backend)
+            timings[backend].append(time.time() - tic)
+        print(
+            f"{backend}: {', '.join(f'{dur:.2f}s' for dur in timings[backend])}",
+            flush=True,
+        )
+
+    if len(out_fps) > 1:
+        outputs = [xa.open_dataset(fp) for fp in out_fps.values()]
+        common_vars = set.intersection(*[set(out.data_vars) for out in outputs])
+        timings["max_abs_diff"] = max(
+            float(np.nanmax(np.abs(outputs[0][var].values - outputs[1][var].values)))
+            for var in common_vars
+        )
+        print(f"maximum absolute difference: {timings['max_abs_diff']}", flush=True)
+    return timings
@@ -0,0 +1,214 @@
+import threading
+import time
+
+from cmipper import downloading, throttle
+
+"""
+Replica selection: the same file is often published on several data nodes. Rather than taking every file from the
+first node on which any are found, all copies of each file (identified by its filename) are gathered, and each file
+is fetched from the replica expected to be fastest:
+
+- each node's latency is probed (with a small request) when first used and periodically thereafter;
+- its bandwidth is measured from completed transfers;
+- a node which fails is skipped for a cool-down period, so later files fail over to other replicas. A failing file is
+  retried immediately on the next replica (for https transfers, resuming from the blocks already downloaded).
+
+Nodes which haven't yet been measured are assumed fast, so that each is tried.
+"""
+
+PROBE_TTL = 600  # seconds before a node's latency is probed again
+FAILURE_COOLDOWN = 300  # seconds for which a failed node is avoided (doubling with consecutive failures)
+ASSUMED_FILE_SIZE = 100e6  # bytes, for ranking replicas of files of unknown size
+BANDWIDTH_SMOOTHING = 0.3  # weight of each new measurement in moving averages
+PROBE_TIMEOUT = (5, 10)  # (connect, read) seconds
+
+
+class NodeStats:
+    def __init__(self):
+        self.latency = None  # s
+        self.bandwidth = None  # bytes/s
+        self.probed = 0.0
+        self.failures = 0  # consecutive
+        self.unhealthy_until = 0.0
+        self.transfers = 0
+
+    def is_healthy(self):
+        return time.time() >= self.unhealthy_until
+
+
+_node_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _stats(data_node: str):
+    with _stats_lock:
+        return _node_stats.setdefault(data_node, NodeStats())
+
+
+def data_node_of(url: str):
+    return throttle.host_of(url)
+
+
+def replica_key(url: str):
+    """Replicas are identified by filename, which is the same on every node."""
+    return url.split("/")[-1]
+
+
+def group_replicas(results: list, records: dict = None, data_nodes: list[str] = ()):
+    """Group file urls (from any number of nodes) into replicas of each file.
+
+    Args:
+        results (list): file urls
+        records (dict, optional): mapping url to file record (see downloading.file_records_from_docs).
+            Defaults to None.
+        data_nodes (list[str], optional): preferred order of nodes, used to order each file's replicas before any
+            measurements. Defaults to ().
+
+    Returns:
+        dict: mapping filename to list of (url, record) of each replica
+    """
+    records = records or {}
+    order = {node: i for i, node in enumerate(data_nodes)}
+    grouped = {}
+    for url in results:
+        # urls found by more than one search (e.g. distributed and per-node) are only included once
+        grouped.setdefault(replica_key(url), {})[url] = records.get(url)
+    return {
+        fname: sorted(
+            replicas.items(),
+            key=lambda replica: order.get(data_node_of(replica[0]), len(order)),
+        )
+        for fname, replicas in sorted(grouped.items())
+    }
+
+
+def probe(url: str):
+    """Measure the latency of url's node with a small request: an OPeNDAP dataset descriptor, or the first byte."""
+    stats = _stats(data_node_of(url))
+    if "/dodsC/" in url:
+        probe_url, headers = f"{url}.dds", {}
+    else:
+        probe_url, headers = url, {"Range": "bytes=0-0"}
+    tic = time.time()
+    try:
+        with throttle.request(url, latency_signal=False):
+            r = downloading.get_session().get(
+                probe_url, headers=headers, timeout=PROBE_TIMEOUT
+            )
+            r.raise_for_status()
+    except Exception as e:
+        record_failure(url, e)
+        return None
+    latency = time.time() - tic
+    with _stats_lock:
+        stats.latency = (
+            latency
+            if stats.latency is None
+            else (1 - BANDWIDTH_SMOOTHING) * stats.latency
+            + BANDWIDTH_SMOOTHING * latency
+        )
+        stats.probed = time.time()
+    return latency
+
+
+def record_transfer(url: str, nbytes: int, duration: float):
+    """Record a successful transfer from url's node, updating its bandwidth and restoring its health."""
+    stats = _stats(data_node_of(url))
+    with _stats_lock:
+        bandwidth = nbytes / max(duration, 1e-6)
+        stats.bandwidth = (
+            bandwidth
+            if stats.bandwidth is None
+            else (1 - BANDWIDTH_SMOOTHING) * stats.bandwidth
+            + BANDWIDTH_SMOOTHING * bandwidth
+        )
+        stats.failures = 0
+        stats.transfers += 1
+
+
+def record_failure(url: str, error: Exception = None):
+    """Avoid url's node for a cool-down period, doubling with each consecutive failure."""
+    stats = _stats(data_node_of(url))
+    with _stats_lock:
+        stats.failures += 1
+        stats.unhealthy_until = time.time() + FAILURE_COOLDOWN * 2 ** min(
+            stats.failures - 1, 4
+        )
+    print(
+        f"\t{data_node_of(url)} marked unhealthy for "
+        f"{stats.unhealthy_until - time.time():.0f}s: {error}",
+        flush=True,
+    )
+
+
+def expected_duration(url: str, size: float = None):
+    """Expected time (s) to fetch a file of size bytes from url's node. Unmeasured nodes are assumed fast."""
+    stats = _stats(data_node_of(url))
+    latency = stats.latency or 0.0
+    if stats.bandwidth is None:
+        return latency
+    return latency + (size or ASSUMED_FILE_SIZE) / stats.bandwidth
+
+
+def rank(replicas: list, do_probe: bool = True):
+    """Order a file's replicas (list of (url, record)) by expected fetch time, healthy nodes first.
+
+    Unhealthy nodes are kept (last), as a last resort.
+    """
+    if do_probe:
+        for url, _ in replicas:
+            stats = _stats(data_node_of(url))
+            with _stats_lock:
+                # claim probe, so that concurrent fetches don't all probe the same node
+                due = stats.is_healthy() and time.time() - stats.probed > PROBE_TTL
+                if due:
+                    stats.probed = time.time()
+            if due:
+                probe(url)
+
+    def score(replica):
+        url, record = replica
+        stats = _stats(data_node_of(url))
+        size = record.get("size") if record else None
+        return (
+            not stats.is_healthy(),
+            expected_duration(url, float(size) if size else None),
+        )
+
+    return sorted(replicas, key=score)
+
+
+def node_states():
+    """Latency, bandwidth and health of each node seen."""
+    with _stats_lock:
+        return {
+            node: {
+                "latency_s": stats.latency,
+                "bandwidth_mb_s": stats.bandwidth / 1e6 if stats.bandwidth else None,
+                "healthy": stats.is_healthy(),
+                "failures": stats.failures,
+                "transfers": stats.transfers,
+            }
+            for node, stats in _node_stats.items()
+        }
+
+
+def print_node_states(states: dict = None):
+    states = node_states() if states is None else states
+    if not states:
+        return
+    print(
+        f"\n{'data node':<32}{'latency (s)':>12}{'MB/s':>8}{'healthy':>9}{'transfers':>11}",
+        flush=True,
+    )
+    for node, state in sorted(states.items()):
+        latency = f"{state['latency_s']:.2f}" if state["latency_s"] is not None else "-"
+        bandwidth = (
+            f"{state['bandwidth_mb_s']:.1f}"
+            if state["bandwidth_mb_s"] is not None
+            else "-"
+        )
+        print(
+            f"{node:<32}{latency:>12}{bandwidth:>8}{str(state['healthy']):>9}{state['transfers']:>11}",
+            flush=True,
+        )
@@ -0,0 +1,557 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from cmipper import parallelised_download_and_process as pdp, throttle
+
+"""
+Stage-aware scheduler: the configured sources, members, variables and experiments are expanded into a DAG of tasks
+per file (search → fetch → regrid → crop → store), per variable (concat) and per experiment (merge).
+
+Each stage has its own concurrency limit. I/O-bound stages run in threads, and CPU-bound ones (whose decoding,
+sorting and compression would otherwise contend for the GIL) in a pool of processes shared between them, sized to the
+number of cores. Tasks hand off their outputs by file path, so no arrays are pickled between processes. A task is
+started as soon as the tasks it depends on are complete, subject to its stage's limit and to a global worker budget.
+A variable is concatenated once all its files have finished, without any which failed (which are reported).
+Later stages are preferred when choosing between ready tasks, so that files flow through the pipeline rather than
+accumulating between stages.
+"""
+
+STAGES = ["search", "fetch", "regrid", "crop", "store", "concat", "merge"]
+DEFAULT_STAGE_LIMITS = {
+    "search": 4,
+    "fetch": 8,
+    "regrid": 4,
+    "crop": 4,
+    "store": 2,
+    "concat": 2,
+    "merge": 1,
+}
+DEFAULT_PROCESS_STAGES = ["regrid", "crop", "concat"]
+PROCESS_EXECUTOR = "processes"
+
+
+class Task:
+    def __init__(
+        self,
+        stage: str,
+        func,
+        args: tuple = (),
+        deps=(),
+        then=None,
+        name=None,
+        after=(),
+    ):
+        """
+        Args:
+            stage (str): stage of pipeline, determining executor and concurrency limit
+            func (callable): function to run. Must be picklable (module-level) if stage runs in processes.
+            args (tuple, optional): arguments to func. Any Task is replaced by its result. Defaults to ().
+            deps (iterable, optional): tasks which must complete first, in addition to any in args. Defaults to ().
+            then (callable, optional): called with func's result once complete, returning any new tasks to schedule.
+                Defaults to None.
+            name (str, optional): name for reporting. Defaults to stage and function name.
+            after (iterable, optional): tasks which must finish first, whether or not they succeed (e.g. the files
+                to be concatenated, which are concatenated without any that failed). Defaults to ().
+        """
+        self.stage = stage
+        self.func = func
+        self.args = tuple(args)
+        self.deps = list(deps) + [arg for arg in self.args if isinstance(arg, Task)]
+        self.after = list(after)
+        self.then = then
+        self.name = name or f"{stage} {getattr(func, '__name__', func)}"
+        self.state = "waiting"  # waiting, running, done, failed, skipped
+        self.result = None
+        self.error = None
+        self.duration = None
+
+    def resolved_args(self):
+        return tuple(arg.result if isinstance(arg, Task) else arg for arg in self.args)
+
+
+class Scheduler:
+    """Runs a DAG of Tasks with per-stage concurrency limits and a global worker budget."""
+
+    def __init__(
+        self,
+        stage_limits: dict = DEFAULT_STAGE_LIMITS,
+        max_workers: int = 16,
+        process_stages: list[str] = DEFAULT_PROCESS_STAGES,
+        process_workers: int = None,
+    ):
+        """
+        Args:
+            stage_limits (dict, optional): maximum number of concurrent tasks of each stage.
+                Defaults to DEFAULT_STAGE_LIMITS.
+            max_workers (int, optional): maximum number of concurrent tasks across all stages. Defaults to 16.
+            process_stages (list[str], optional): stages run in processes rather than threads. Their functions must
+                return file paths (or other small values) rather than data. Defaults to DEFAULT_PROCESS_STAGES.
+            process_workers (int, optional): size of the pool of processes shared by process stages. Defaults to None
+                (the number of cores).
+        """
+        self.stage_limits = dict(DEFAULT_STAGE_LIMITS, **(stage_limits or {}))
+        self.max_workers = max_workers
+        self.process_stages = set(process_stages or [])
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.tasks = []
+        self._running = {stage: 0 for stage in self.stage_limits}
+        self._executor_stats = {}
+        self._cond = threading.Condition()
+
+    def add(self, task: Task):
+        with self._cond:
+            self.tasks.append(task)
+            self._cond.notify()
+        return task
+
+    def _ready(self):
+        """Waiting tasks whose dependencies are complete (marking as skipped those whose dependencies failed)."""
+        ready = []
+        for task in self.tasks:
+            if task.state != "waiting":
+                continue
+            if any(dep.state in ("failed", "skipped") for dep in task.deps):
+                task.state = "skipped"
+                print(f"skipping {task.name} since a dependency failed", flush=True)
+            elif all(dep.state == "done" for dep in task.deps) and all(
+                prior.state in ("done", "failed", "skipped") for prior in task.after
+            ):
+                ready.append(task)
+        # prefer later stages, so that files flow through the pipeline
+        return sorted(ready, key=lambda task: -STAGES.index(task.stage))
+
+    def executor_of(self, stage: str):
+        """Name of the executor running a stage's tasks."""
+        return PROCESS_EXECUTOR if stage in self.process_stages else f"{stage} threads"
+
+    def _submit(self, task: Task, executors: dict):
+        unfinished = [prior.name for prior in task.after if prior.state != "done"]
+        if unfinished:
+            print(
+                f"{task.name} proceeding without {len(unfinished)} failed or skipped task(s): {', '.join(unfinished)}",
+                flush=True,
+            )
+        task.state = "running"
+        self._running[task.stage] += 1
+        tic = time.time()
+        stats = self._executor_stats[self.executor_of(task.stage)]
+        stats["start"] = min(stats["start"] or tic, tic)
+        future = executors[task.stage].submit(
+            _timed_call, task.func, *task.resolved_args()
+        )
+        future.add_done_callback(lambda f: self._complete(task, f, tic))
+
+    def _complete(self, task: Task, future, tic: float):
+        new_tasks = []
+        error = future.exception()
+        # timed where run, so excluding any wait for a worker of a shared pool
+        result, duration = (
+            future.result() if error is None else (None, time.time() - tic)
+        )
+        if error is None and task.then is not None:
+            try:
+                new_tasks = list(task.then(result) or [])
+            except Exception as e:
+                error = e
+        with self._cond:
+            task.duration = duration
+            # new tasks are added before the task is marked done, so that dependents see them
+            self.tasks.extend(new_tasks)
+            if error is None:
+                task.result = result
+                task.state = "done"
+            else:
+                task.error = error
+                task.state = "failed"
+                print(f"{task.name} failed: {error}", flush=True)
+            self._running[task.stage] -= 1
+            stats = self._executor_stats[self.executor_of(task.stage)]
+            stats[task.state] += 1
+            stats["task_s"] += task.duration
+            stats["end"] = max(stats["end"] or 0.0, time.time())
+            if error is None:
+                stats["bytes"] += _result_bytes(task.result)
+            self._cond.notify()
+
+    def _make_executors(self):
+        executors = {}
+        process_pool = None
+        # no more processes than could ever be busy at once
+        process_workers = min(
+            self.process_workers,
+            self.max_workers,
+            sum(self.stage_limits.get(stage, 0) for stage in self.process_stages),
+        )
+        if process_workers:
+            # spawn, since forking a process with running threads is unsafe. Each process's dask computations are
+            # limited to its share of the cores, rather than every process using them all
+            process_pool = ProcessPoolExecutor(
+                max_workers=process_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker_process,
+                initargs=(max(1, (os.cpu_count() or 1) // process_workers),),
+            )
+            self._executor_stats.setdefault(
+                PROCESS_EXECUTOR, _executor_stats(process_workers)
+            )
+        for stage, limit in self.stage_limits.items():
+            if stage in self.process_stages:
+                executors[stage] = process_pool
+            else:
+                executors[stage] = ThreadPoolExecutor(
+                    max_workers=limit, thread_name_prefix=stage
+                )
+                self._executor_stats.setdefault(
+                    self.executor_of(stage), _executor_stats(limit)
+                )
+        return executors
+
+    def run(self):
+        """Run all tasks (including any added while running) to completion.
+
+        Returns:
+            dict: mapping each stage to counts of tasks in each final state, and their total duration (s)
+        """
+        executors = self._make_executors()
+        try:
+            with self._cond:
+                while True:
+                    for task in self._ready():
+                        if sum(self._running.values()) >= self.max_workers:
+                            break
+                        if self._running[task.stage] < self.stage_limits[task.stage]:
+                            self._submit(task, executors)
+                    if not any(self._running.values()):
+                        if not self._ready():
+                            break
+                        # skipping a task can ready one which runs after it, with nothing left running to notify
+                        continue
+                    self._cond.wait()
+        finally:
+            for executor in set(executors.values()):
+                executor.shutdown(wait=True)
+        return self.summary()
+
+    def summary(self):
+        """
+        Returns:
+            dict: mapping each stage to counts of tasks in each final state, their total duration (s), and the names
+                of any failed tasks ("failed_tasks")
+        """
+        summary = {}
+        for task in self.tasks:
+            stage_summary = summary.setdefault(
+                task.stage, {"duration": 0.0, "failed_tasks": []}
+            )
+            stage_summary[task.state] = stage_summary.get(task.state, 0) + 1
+            stage_summary["duration"] += task.duration or 0
+            if task.state == "failed":
+                stage_summary["failed_tasks"].append(task.name)
+        return summary
+
+    def executor_summary(self):
+        """
+        Returns:
+            dict: mapping each executor (the process pool, and each stage's threads) which ran any tasks to its
+                workers, counts of tasks done and failed, total task time (s), span from first start to last
+                completion (s), and bytes of files output
+        """
+        return {
+            executor: dict(
+                {
+                    key: value
+                    for key, value in stats.items()
+                    if key not in ("start", "end")
+                },
+                span_s=stats["end"] - stats["start"],
+            )
+            for executor, stats in self._executor_stats.items()
+            if stats["end"] is not None
+        }
+
+
+def _executor_stats(workers: int):
+    return {
+        "workers": workers,
+        "done": 0,
+        "failed": 0,
+        "task_s": 0.0,
+        "bytes": 0,
+        "start": None,
+        "end": None,
+    }
+
+
+def _timed_call(func, *args):
+    tic = time.perf_counter()
+    return func(*args), time.perf_counter() - tic
+
+
+def _init_worker_process(dask_threads: int):
+    # read by dask on import, which is deferred until first used (see cmipper.lazy)
+    os.environ["DASK_NUM_WORKERS"] = str(dask_threads)
+
+
+def _result_bytes(result):
+    """Size of any files output by a task (which hand off their outputs by path)."""
+    if isinstance(result, dict):
+        return sum(_result_bytes(value) for value in result.values())
+    if isinstance(result, Path) and result.is_file():
+        return result.stat().st_size
+    return 0
+
+
+def print_summary(summary: dict):
+    print(
+        f"\n{'stage':<8}{'done':>6}{'failed':>8}{'skipped':>9}{'task time':>12}",
+        flush=True,
+    )
+    for stage in STAGES:
+        if stage in summary:
+            counts = summary[stage]
+            print(
+                f"{stage:<8}{counts.get('done', 0):>6}{counts.get('failed', 0):>8}"
+                f"{counts.get('skipped', 0):>9}{counts['duration']:>11.0f}s",
+                flush=True,
+            )
+    failed_tasks = [
+        name
+        for stage in STAGES
+        for name in summary.get(stage, {}).get("failed_tasks", [])
+    ]
+    if failed_tasks:
+        # variables are concatenated without the files which failed, so these are missing from their products
+        print(f"\nfailed: {', '.join(failed_tasks)}", flush=True)
+
+
+def print_executor_summary(summary: dict):
+    """Print each executor's throughput, as returned by Scheduler.executor_summary."""
+    print(
+        f"\n{'executor':<18}{'workers':>8}{'tasks':>7}{'failed':>8}{'task time':>11}{'span':>9}"
+        f"{'tasks/min':>11}{'MB/s out':>10}",
+        flush=True,
+    )
+    for executor, stats in summary.items():
+        span_s = max(stats["span_s"], 1e-6)
+        print(
+            f"{executor:<18}{stats['workers']:>8}{stats['done']:>7}{stats['failed']:>8}"
+            f"{stats['task_s']:>10.0f}s{stats['span_s']:>8.0f}s"
+            f"{(stats['done'] + stats['failed']) / span_s * 60:>11.1f}{stats['bytes'] / 1e6 / span_s:>10.2f}",
+            flush=True,
+        )
+
+
+# Pipeline
+################################################################################
+
+
+def _batched_variable_results(batched_results: dict, variable_id: str):
+    return batched_results[variable_id]
+
+
+def is_fetched(
+    fetch_years: dict, variable_id: str, experiment_id: str, date_range: str
+):
+    """Whether a file is fetched, given the years to fetch of each (variable_id, experiment_id) (all if None)."""
+    if fetch_years is None:
+        return True
+    start, end = (int(date[:4]) for date in date_range.split("-"))
+    wanted = fetch_years.get((variable_id, experiment_id), set())
+    return bool(wanted.intersection(range(start, end + 1)))
+
+
+def _variable_tasks(
+    source_id: str,
+    member_id: str,
+    variable_id: str,
+    files: dict,
+    merge_tasks: dict,
+    fetch_years: dict = None,
+):
+    """Tasks processing each of a variable's files, and concatenating them by time, given search results.
+
+    If fetch_years (mapping (variable_id, experiment_id) to years) is given, only files covering any of those years
+    are fetched.
+    """
+    plevels = pdp.get_plevels(
+        pdp.processing_settings(source_id)["source_id_dict"], variable_id
+    )
+    tasks = []
+    for experiment_id, experiment_files in files.items():
+        store_tasks = []
+        for file_replicas in experiment_files:
+            date_range = pdp.file_date_range(file_replicas[0][0])
+            if not is_fetched(fetch_years, variable_id, experiment_id, date_range):
+                continue
+            fetch_task = Task(
+                "fetch",
+                pdp.fetch_file,
+                (source_id, member_id, variable_id, experiment_id, file_replicas),
+                name=f"fetch {variable_id} {experiment_id} {date_range}",
+            )
+            tasks.append(fetch_task)
+            for plevel in plevels:
+                unit_args = (
+                    source_id,
+                    member_id,
+                    variable_id,
+                    experiment_id,
+                    date_range,
+                    plevel,
+                )
+                unit_name = f"{variable_id} {experiment_id} {date_range} {plevel}"
+                regrid_task = Task(
+                    "regrid",
+                    pdp.regrid_file_unit,
+                    unit_args,
+                    deps=[fetch_task],
+                    name=f"regrid {unit_name}",
+                )
+                crop_task = Task(
+                    "crop",
+                    pdp.crop_file_unit,
+                    unit_args + (regrid_task,),
+                    name=f"crop {unit_name}",
+                )
+                store_task = Task(
+                    "store",
+                    pdp.store_file_unit,
+                    unit_args + (crop_task,),
+                    name=f"store {unit_name}",
+                )
+                tasks.extend([regrid_task, crop_task, store_task])
+                store_tasks.append(store_task)
+        concat_task = Task(
+            "concat",
+            pdp.concat_cmip_files_by_time,
+            (source_id, experiment_id, member_id, variable_id),
+            # concatenates the files available, as when run sequentially, so doesn't wait on all files succeeding
+            after=store_tasks,
+            name=f"concat {source_id} {member_id} {experiment_id} {variable_id}",
+        )
+        tasks.append(concat_task)
+        if experiment_id in merge_tasks:
+            merge_tasks[experiment_id].deps.append(concat_task)
+    return tasks
+
+
+def schedule_downloads(
+    scheduler: Scheduler,
+    model_info_dict: dict,
+    download_config_dict: dict,
+    source_ids: list[str] = None,
+    member_ids: list[str] = None,
+    variable_ids: list[str] = None,
+    fetch_years: dict = None,
+):
+    """Add the tasks downloading and processing all configured variables to scheduler.
+
+    Search tasks are added directly. Once each variable's files are found, its per-file and concatenation tasks are
+    added, and the experiment's merge task made to depend on them.
+
+    Args:
+        source_ids, member_ids, variable_ids (list[str], optional): subsets to download. Defaults to None (all
+            configured).
+        fetch_years (dict, optional): mapping (variable_id, experiment_id) to the years to fetch, as planned by
+            planner.fetch_years. Variables with none are not searched, only concatenated. Defaults to None (all).
+    """
+    source_ids = list(model_info_dict) if source_ids is None else source_ids
+    variable_ids = (
+        download_config_dict["variable_ids"] if variable_ids is None else variable_ids
+    )
+    do_batched_search = download_config_dict.get("search", {}).get("batched", False)
+
+    for source_id in source_ids:
+        throttle.configure(model_info_dict[source_id].get("node_limits", {}))
+        experiment_ids = model_info_dict[source_id]["experiment_ids"]
+        for member_id in member_ids or model_info_dict[source_id]["member_ids"]:
+            held_variable_ids = set()
+            if fetch_years is not None:
+                held_variable_ids = {
+                    variable_id
+                    for variable_id in variable_ids
+                    if not any(
+                        fetch_years.get((variable_id, experiment_id))
+                        for experiment_id in experiment_ids
+                    )
+                }
+            batched_task = None
+            if do_batched_search and set(variable_ids) - held_variable_ids:
+                batched_task = scheduler.add(
+                    Task(
+                        "search",
+                        pdp.search_variables_batched,
+                        (
+                            source_id,
+                            member_id,
+                            [v for v in variable_ids if v not in held_variable_ids],
+                        ),
+                        name=f"search {source_id} {member_id}",
+                    )
+                )
+            search_tasks = []
+            merge_tasks = {}
+            for variable_id in variable_ids:
+                if variable_id in held_variable_ids:
+                    # already held: only concatenated (and merged), without searching
+                    concat_tasks = _variable_tasks(
+                        source_id,
+                        member_id,
+                        variable_id,
+                        dict.fromkeys(experiment_ids, ()),
+                        merge_tasks,
+                    )
+                    search_tasks.extend(scheduler.add(task) for task in concat_tasks)
+                    continue
+                variable_results = (
+                    Task(
+                        "search",
+                        _batched_variable_results,
+                        (batched_task, variable_id),
+                        name=f"batched results {variable_id}",
+                    )
+                    if batched_task
+                    else None
+                )
+                if variable_results is not None:
+                    scheduler.add(variable_results)
+                search_tasks.append(
+                    scheduler.add(
+                        Task(
+                            "search",
+                            pdp.search_variable_files,
+                            (source_id, member_id, variable_id, variable_results),
+                            # bound as defaults, since each member has its own merge tasks
+                            then=lambda files, s=source_id, m=member_id, v=variable_id, mt=merge_tasks: _variable_tasks(
+                                s, m, v, files, mt, fetch_years
+                            ),
+                            name=f"search {source_id} {member_id} {variable_id}",
+                        )
+                    )
+                )
+            for experiment_id in experiment_ids:
+                # concat tasks are added as dependencies as each variable's files are found
+                merge_tasks[experiment_id] = scheduler.add(
+                    Task(
+                        "merge",
+                        pdp.merge_cmip_data_by_variables,
+                        (source_id, experiment_id, member_id),
+                        deps=search_tasks,
+                        name=f"merge {source_id} {member_id} {experiment_id}",
+                    )
+                )
+    return scheduler
+
+
+def scheduler_from_config(download_config_dict: dict):
+    scheduler_config = download_config_dict.get("scheduler", {})
+    return Scheduler(
+        stage_limits=scheduler_config.get("stage_limits", DEFAULT_STAGE_LIMITS),
+        max_workers=scheduler_config.get("max_workers", 16),
+        process_stages=scheduler_config.get("process_stages", DEFAULT_PROCESS_STAGES),
+        process_workers=scheduler_config.get("process_workers"),
+    )
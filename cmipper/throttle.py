@@ -0,0 +1,322 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+from cmipper import config, lazy
+
+requests = lazy.import_module("requests")
+
+"""
+Per-host concurrency and rate limits, so that many workers share each ESGF node politely rather than each hammering it.
+
+Every request to a host (search page, OPeNDAP file, or HTTPS block) is made within a slot of that host's limiter:
+- concurrency adapts by AIMD: the limit grows by one per window of successful requests and halves on errors (timeouts,
+  connection failures, 429 or 5xx responses) or when request latency rises well above the fastest seen, indicating the
+  node is saturated;
+- an optional token bucket caps the rate at which requests start.
+
+Limits are configured per node under `node_limits` of each source in model_info.yaml, with `default` applying to any
+node not listed. The state of each host is written periodically to config.host_state_fp and returned by host_states().
+"""
+
+DEFAULT_LIMITS = {
+    "max_concurrency": 8,  # ceiling on concurrent requests
+    "min_concurrency": 1,
+    "initial_concurrency": 2,
+    "rate": None,  # requests per second (None for unlimited)
+    "burst": None,  # requests which may start at once under the rate limit (defaults to max_concurrency)
+    "latency_factor": 3.0,  # back off once typical latency exceeds this multiple of the fastest seen
+}
+THROUGHPUT_WINDOW = 30  # seconds over which throughput is reported
+LATENCY_SMOOTHING = 0.2  # weight of each new latency in moving average
+STATE_WRITE_INTERVAL = 5  # seconds between writes of host state
+DAP_SERVER_ERROR = "NetCDF: DAP server error"
+
+
+class TokenBucket:
+    """Blocks callers so that requests start at no more than rate per second, with bursts of up to burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_congestion_error(error: Exception):
+    """Whether an error indicates an overloaded node: a timeout, connection failure, or 429 or 5xx response (rather
+    than e.g. a missing file, or a failure to process or write data locally)."""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    if isinstance(error, RuntimeError):
+        # netCDF-C reports a 5xx response to an OPeNDAP request without its status
+        return DAP_SERVER_ERROR in str(error)
+    return isinstance(
+        error,
+        (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError),
+    )
+
+
+class HostLimiter:
+    """Adaptive concurrency limit and rate limit for requests to a single host."""
+
+    def __init__(
+        self,
+        host: str,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        initial_concurrency: int = 2,
+        rate: float = None,
+        burst: int = None,
+        latency_factor: float = 3.0,
+    ):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(
+            min(max(initial_concurrency, min_concurrency), max_concurrency)
+        )
+        self.bucket = TokenBucket(rate, burst or max_concurrency) if rate else None
+        self.latency_factor = latency_factor
+
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.latency = None  # moving average (s)
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.recent = deque()  # (finish time, bytes) within THROUGHPUT_WINDOW
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def _decrease(self, now: float):
+        # at most once per typical request duration, so that one burst of failures halves the limit only once
+        if now - self.last_decrease > (self.latency or 1.0):
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.last_decrease = now
+
+    def release(
+        self,
+        latency: float,
+        nbytes: int = 0,
+        error: Exception = None,
+        latency_signal: bool = True,
+    ):
+        """Record a finished request and adapt the concurrency limit.
+
+        Args:
+            latency (float): duration of request (s)
+            nbytes (int, optional): bytes transferred. Defaults to 0.
+            error (Exception, optional): error raised by request, if any. Defaults to None.
+            latency_signal (bool, optional): whether latency is comparable between requests (e.g. fixed-size blocks),
+                so may be used to detect saturation. Defaults to True.
+        """
+        now = time.monotonic()
+        with self.cond:
+            self.in_flight -= 1
+            self.requests += 1
+            self.nbytes += nbytes
+            self.recent.append((now, nbytes))
+            if error is not None:
+                self.errors += 1
+                if is_congestion_error(error):
+                    self._decrease(now)
+            else:
+                if latency_signal:
+                    # the fastest latency drifts upwards slowly, so that a single lucky request isn't a permanent
+                    # baseline
+                    self.min_latency = min(
+                        (self.min_latency or latency) * (1 + LATENCY_SMOOTHING / 20),
+                        latency,
+                    )
+                    self.latency = (
+                        latency
+                        if self.latency is None
+                        else (1 - LATENCY_SMOOTHING) * self.latency
+                        + LATENCY_SMOOTHING * latency
+                    )
+                if (
+                    latency_signal
+                    and self.latency > self.latency_factor * self.min_latency
+                ):
+                    self._decrease(now)
+                else:
+                    # additive increase: one more slot per limit's worth of successful requests
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    @contextmanager
+    def request(self, latency_signal: bool = True):
+        """Context in which to make a request. Yields a dict in which to record "nbytes" transferred."""
+        self.acquire()
+        tic = time.monotonic()
+        transfer = {"nbytes": 0}
+        try:
+            yield transfer
+        except Exception as e:
+            self.release(
+                time.monotonic() - tic,
+                transfer["nbytes"],
+                error=e,
+                latency_signal=latency_signal,
+            )
+            raise
+        self.release(
+            time.monotonic() - tic, transfer["nbytes"], latency_signal=latency_signal
+        )
+
+    def state(self):
+        with self.cond:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0][0] > THROUGHPUT_WINDOW:
+                self.recent.popleft()
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes": self.nbytes,
+                "throughput_mb_s": sum(nbytes for _, nbytes in self.recent)
+                / 1e6
+                / THROUGHPUT_WINDOW,
+                "requests_per_s": len(self.recent) / THROUGHPUT_WINDOW,
+                "latency_s": self.latency,
+            }
+
+
+_limiters = {}
+_node_limits = {}
+_limiters_lock = threading.Lock()
+_last_state_write = 0.0
+
+
+def configure(node_limits: dict):
+    """Set limits of nodes (as under `node_limits` in model_info.yaml), including `default` for unlisted nodes.
+
+    Limiters already created keep their current adaptive state and tokens, but take the new bounds and rate. Called
+    once per source when scheduling downloads, rather than by each task.
+    """
+    with _limiters_lock:
+        _node_limits.update(node_limits or {})
+        for host, limiter in _limiters.items():
+            limits = _limits_for(host)
+            limiter.max_concurrency = limits["max_concurrency"]
+            limiter.min_concurrency = limits["min_concurrency"]
+            limiter.limit = min(
+                max(limiter.limit, limiter.min_concurrency), limiter.max_concurrency
+            )
+            limiter.latency_factor = limits["latency_factor"]
+            burst = limits["burst"] or limits["max_concurrency"]
+            if not limits["rate"]:
+                limiter.bucket = None
+            elif limiter.bucket is None:
+                limiter.bucket = TokenBucket(limits["rate"], burst)
+            else:
+                # the bucket's tokens are kept (rather than refilled), so that reconfiguring doesn't lift the rate
+                with limiter.bucket.lock:
+                    limiter.bucket.rate = limits["rate"]
+                    limiter.bucket.burst = burst
+                    limiter.bucket.tokens = min(limiter.bucket.tokens, burst)
+
+
+def _limits_for(host: str):
+    return dict(
+        DEFAULT_LIMITS, **_node_limits.get("default", {}), **_node_limits.get(host, {})
+    )
+
+
+def host_of(url: str):
+    """Host of a url, or the argument itself if it is already a bare host (e.g. a data_node)."""
+    return urlparse(url).hostname or url
+
+
+def get_limiter(url: str):
+    host = host_of(url)
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, **_limits_for(host))
+        return _limiters[host]
+
+
+@contextmanager
+def request(url: str, latency_signal: bool = True):
+    """Context in which to make a request to url's host, within its concurrency and rate limits.
+
+    Yields a dict in which to record the number of bytes transferred ("nbytes").
+    """
+    with get_limiter(url).request(latency_signal=latency_signal) as transfer:
+        yield transfer
+    _maybe_write_states()
+
+
+def host_states():
+    """Current limit, in-flight requests, totals and recent throughput of each host."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.host: limiter.state() for limiter in limiters}
+
+
+def write_host_states(fp=config.host_state_fp):
+    fp = Path(fp)
+    if not fp.parent.exists():
+        fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+    tmp_fp.write_text(json.dumps(host_states(), indent=2))
+    os.replace(tmp_fp, fp)
+
+
+def _maybe_write_states():
+    global _last_state_write
+    now = time.monotonic()
+    if now - _last_state_write < STATE_WRITE_INTERVAL:
+        return
+    _last_state_write = now
+    try:
+        write_host_states()
+    except OSError:  # state is informational: never interrupt downloads over it
+        pass
+
+
+def print_host_states(states: dict = None):
+    states = host_states() if states is None else states
+    if not states:
+        return
+    print(
+        f"\n{'host':<32}{'limit':>6}{'in flight':>10}{'requests':>10}{'errors':>8}{'GB':>8}{'MB/s':>8}",
+        flush=True,
+    )
+    for host, state in sorted(states.items()):
+        print(
+            f"{host:<32}{state['limit']:>6}{state['in_flight']:>10}{state['requests']:>10}"
+            f"{state['errors']:>8}{state['bytes'] / 1e9:>8.2f}{state['throughput_mb_s']:>8.1f}",
+            flush=True,
+        )
@@ -0,0 +1,350 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from cmipper import downloading, lazy, metrics, throttle, utils
+
+dask_array = lazy.import_module("dask.array")
+np = lazy.import_module("numpy")
+requests = lazy.import_module("requests")
+xa = lazy.import_module("xarray")
+
+"""
+Direct HTTPS transfer engine: an alternative to OPeNDAP for nodes which serve data well only over HTTPServer.
+
+Whole files are downloaded in fixed-size blocks, fetched with HTTP Range requests over several parallel connections
+and written in place into a preallocated `.part` file. Completed blocks are recorded alongside (`.part.json`), so an
+interrupted transfer resumes with only the missing blocks. Once complete, the file's size and checksum are verified
+against those in the ESGF Solr document before it's renamed into place. Servers which don't support ranges are
+downloaded in a single stream.
+
+Selected by `transfer: engine: https` in download_config.yaml.
+
+Files read over OPeNDAP (the default engine) are opened with open_dataset, which makes each read of the remote data
+within a slot of its data node (see throttle), so that processing and writing the data locally doesn't occupy the node.
+"""
+
+TRANSFER_ENGINES = ["opendap", "https"]
+TRANSFER_TIMEOUT = (10, 300)  # (connect, read) seconds
+DEFAULT_BLOCK_SIZE = 16 * 2**20
+STREAM_CHUNK_SIZE = 2**20
+BLOCK_RETRIES = 3
+
+
+class TransferError(IOError):
+    """Failure of a request to a data node, or of the data it returned (e.g. a checksum mismatch), rather than of
+    processing or writing the data locally. Another replica of the file may succeed."""
+
+
+def is_transfer_error(error: Exception):
+    """Whether an error is the failure of a data node (see TransferError), so that another replica may be tried."""
+    return isinstance(error, (TransferError, requests.RequestException))
+
+
+def split_records(search_results: list):
+    """Split search results (file urls, or file records as returned by esgf_search(records=True)) into a list of
+    urls and a dict mapping each url to its record (empty for plain urls)."""
+    urls, records = [], {}
+    for result in search_results:
+        if isinstance(result, dict):
+            urls.append(result["url"])
+            records[result["url"]] = result
+        else:
+            urls.append(result)
+    return urls, records
+
+
+def is_remote(source) -> bool:
+    return "://" in str(source)
+
+
+class _RemoteArray:
+    """Array-like view of a variable of a remote (OPeNDAP) dataset, each read of which is a request made within a
+    slot of its data node."""
+
+    def __init__(self, variable, url: str):
+        self.variable = variable
+        self.url = url
+        self.shape = variable.shape
+        self.dtype = variable.dtype
+        self.ndim = variable.ndim
+
+    def __getitem__(self, key):
+        try:
+            # reads vary in size, so their latency isn't used to detect saturation
+            with throttle.request(self.url, latency_signal=False) as transfer:
+                values = np.asarray(self.variable[key].values)
+                transfer["nbytes"] = values.nbytes
+        except Exception as e:
+            raise TransferError(f"reading {self.url} failed: {e}") from e
+        return values
+
+
+def open_dataset(source, chunks: dict = None, chunk_mb: float = None, **kwargs):
+    """Lazily open a local file, or a remote (OPeNDAP) dataset whose reads are each made within a slot of its data
+    node, rather than one slot being held while the data is also processed and written locally.
+
+    Args:
+        source (str | Path): local filepath, or OPeNDAP url
+        chunks (dict, optional): chunk size of each dimension (see dask.array.from_array), with any others in a
+            single chunk. Defaults to None (each variable in a single chunk).
+        chunk_mb (float, optional): ceiling on the size of each chunk of a variable with a time dimension not given
+            in chunks, which is chunked by time to fit (see utils.time_chunk). Defaults to None (time in a single
+            chunk).
+        kwargs: passed to xa.open_dataset
+
+    Returns:
+        xa.Dataset: dataset, with dask-backed variables
+    """
+    remote = is_remote(source)
+    try:
+        with (
+            throttle.request(source, latency_signal=False)
+            if remote
+            else contextlib.nullcontext()
+        ):
+            ds = xa.open_dataset(source, cache=False, **kwargs)
+    except Exception as e:
+        if not remote:
+            raise
+        raise TransferError(f"opening {source} failed: {e}") from e
+    chunked = ds.copy()
+    for name, variable in chunked.variables.items():
+        if name in chunked.indexes:  # loaded on opening
+            continue
+        var_chunks = dict(chunks or {})
+        if chunk_mb and "time" in variable.dims and "time" not in var_chunks:
+            var_chunks["time"] = utils.time_chunk(variable, chunk_mb)
+        var_chunks = {dim: var_chunks.get(dim, -1) for dim in variable.dims}
+        if not remote:
+            variable.data = ds.variables[name].chunk(var_chunks).data
+            continue
+        variable.data = dask_array.from_array(
+            _RemoteArray(ds.variables[name], source),
+            chunks=tuple(var_chunks.values()),
+            name=False,
+            meta=np.array((), dtype=variable.dtype),
+        )
+    return chunked
+
+
+def _part_fps(fp: Path):
+    return fp.with_name(f"{fp.name}.part"), fp.with_name(f"{fp.name}.part.json")
+
+
+def probe(url: str, session=None):
+    """Return (size in bytes, whether the server accepts range requests) for url. Size is None if not reported."""
+    session = downloading.get_session() if session is None else session
+    # request the first byte, since not all servers respond to HEAD
+    with throttle.request(url, latency_signal=False):
+        r = session.get(
+            url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TRANSFER_TIMEOUT
+        )
+    with r:
+        r.raise_for_status()
+        if r.status_code == 206 and "/" in r.headers.get("Content-Range", ""):
+            total = r.headers["Content-Range"].split("/")[-1]
+            return (int(total) if total != "*" else None), True
+        length = r.headers.get("Content-Length")
+        return (int(length) if length else None), False
+
+
+def _load_done_blocks(state_fp: Path, size: int, block_size: int):
+    """Blocks already written to the .part file, if it was started with the same size and block size."""
+    if not state_fp.exists():
+        return set()
+    try:
+        state = json.loads(state_fp.read_text())
+    except ValueError:  # partially-written state
+        return set()
+    if state.get("size") != size or state.get("block_size") != block_size:
+        return set()
+    return set(state["done"])
+
+
+def _save_done_blocks(state_fp: Path, size: int, block_size: int, done: set):
+    tmp_fp = state_fp.with_name(f"{state_fp.name}.{os.getpid()}.tmp")
+    tmp_fp.write_text(
+        json.dumps({"size": size, "block_size": block_size, "done": sorted(done)})
+    )
+    os.replace(tmp_fp, state_fp)
+
+
+def _fetch_block(
+    session, url: str, part_fp: Path, start: int, end: int, measurement=None
+):
+    """Fetch bytes start to end (inclusive) of url, writing them at the same offset of part_fp. Retries are added
+    to measurement (see metrics.measure), since blocks are fetched in other threads."""
+    for attempt in range(BLOCK_RETRIES):
+        if attempt:
+            metrics.add(measurement, retries=1)
+        try:
+            # blocks are of equal size, so their latency indicates how loaded the node is
+            with throttle.request(url) as transfer, session.get(
+                url,
+                headers={"Range": f"bytes={start}-{end}"},
+                stream=True,
+                timeout=TRANSFER_TIMEOUT,
+            ) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise TransferError(f"server ignored range request for {url}")
+                fd = os.open(part_fp, os.O_WRONLY)
+                try:
+                    offset = start
+                    for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        transfer["nbytes"] += len(chunk)
+                finally:
+                    os.close(fd)
+            if offset != end + 1:
+                raise TransferError(
+                    f"received {offset - start} of {end + 1 - start} bytes from {url}"
+                )
+            return end + 1 - start
+        except IOError:  # including requests' exceptions
+            if attempt == BLOCK_RETRIES - 1:
+                raise
+            time.sleep(2**attempt)
+
+
+def _stream_whole(session, url: str, part_fp: Path):
+    """Download url in a single stream (for servers without range support)."""
+    with throttle.request(url, latency_signal=False) as transfer, session.get(
+        url, stream=True, timeout=TRANSFER_TIMEOUT
+    ) as r:
+        r.raise_for_status()
+        with open(part_fp, "wb") as f:
+            for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                f.write(chunk)
+                transfer["nbytes"] += len(chunk)
+    return transfer["nbytes"]
+
+
+def verify_file(
+    fp: str | Path, size: int = None, checksum: str = None, checksum_type: str = None
+):
+    """Raise ValueError if fp doesn't have the expected size or checksum (either may be None, to skip)."""
+    fp = Path(fp)
+    if size is not None and fp.stat().st_size != int(size):
+        raise ValueError(
+            f"{fp} has size {fp.stat().st_size}, but {size} bytes were expected"
+        )
+    if checksum:
+        digest = hashlib.new((checksum_type or "sha256").lower())
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                digest.update(block)
+        if digest.hexdigest().lower() != checksum.lower():
+            raise ValueError(f"{fp} failed {checksum_type or 'sha256'} verification")
+
+
+def download_file(
+    url: str,
+    fp: str | Path,
+    size: int = None,
+    checksum: str = None,
+    checksum_type: str = None,
+    connections: int = 4,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+):
+    """Download url to fp with parallel range requests, resuming any previous partial transfer.
+
+    Args:
+        url (str): HTTPServer url of file
+        fp (str | Path): local filepath, which only exists once the transfer is complete and verified
+        size (int, optional): expected size (bytes), e.g. from the Solr document. Defaults to None (from server).
+        checksum (str, optional): expected checksum, e.g. from the Solr document. Defaults to None (not verified).
+        checksum_type (str, optional): hash algorithm of checksum e.g. "SHA256", "MD5". Defaults to None (sha256).
+        connections (int, optional): number of parallel connections. Defaults to 4.
+        block_size (int, optional): size (bytes) of each range request. Defaults to 16 MiB.
+
+    Returns:
+        Path: fp
+    """
+    fp = Path(fp)
+    if fp.exists():
+        return fp
+    if not fp.parent.exists():
+        fp.parent.mkdir(parents=True, exist_ok=True)
+    part_fp, state_fp = _part_fps(fp)
+    session = downloading.get_session()
+
+    tic = time.time()
+    server_size, accepts_ranges = probe(url, session)
+    size = int(size) if size is not None else server_size
+    if server_size is not None and size != server_size:
+        raise TransferError(
+            f"{url} has size {server_size}, but {size} bytes were expected"
+        )
+
+    if accepts_ranges and size:
+        blocks = {
+            i: (start, min(start + block_size, size) - 1)
+            for i, start in enumerate(range(0, size, block_size))
+        }
+        done = _load_done_blocks(state_fp, size, block_size)
+        if not done or not part_fp.exists():
+            done = set()
+            with open(part_fp, "wb") as f:
+                # preallocate (sparse) so that blocks can be written in any order
+                f.truncate(size)
+        pending = [i for i in blocks if i not in done]
+        if done:
+            print(
+                f"\tresuming {fp.name}: {len(done)} of {len(blocks)} blocks already downloaded",
+                flush=True,
+            )
+        lock = threading.Lock()
+        measurement = metrics.current()
+
+        def fetch(i):
+            nbytes = _fetch_block(
+                session, url, part_fp, *blocks[i], measurement=measurement
+            )
+            with lock:
+                done.add(i)
+                _save_done_blocks(state_fp, size, block_size, done)
+            return nbytes
+
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            nbytes = sum(executor.map(fetch, pending))
+    else:
+        nbytes = _stream_whole(session, url, part_fp)
+
+    try:
+        verify_file(part_fp, size, checksum, checksum_type)
+    except ValueError as e:
+        # corrupt: start again next time
+        part_fp.unlink()
+        state_fp.unlink(missing_ok=True)
+        raise TransferError(str(e)) from e
+    os.replace(part_fp, fp)
+    state_fp.unlink(missing_ok=True)
+
+    dur = time.time() - tic
+    print(
+        f"\ttransferred {nbytes / 1e6:.1f} MB of {fp.name} in {dur:.1f}s "
+        f"({nbytes / 1e6 / max(dur, 1e-6):.1f} MB/s)",
+        flush=True,
+    )
+    return fp
+
+
+def download_record(record: dict, download_dir: str | Path, **kwargs):
+    """Download a file record (see downloading.file_records_from_docs) into download_dir, verifying it against
+    the record's size and checksum. kwargs are passed to download_file."""
+    return download_file(
+        record["url"],
+        Path(download_dir) / record["url"].split("/")[-1],
+        size=record.get("size"),
+        checksum=record.get("checksum"),
+        checksum_type=record.get("checksum_type"),
+        **kwargs,
+    )
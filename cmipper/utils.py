@@ -1,11 +1,22 @@
-import xarray as xa
-import numpy as np
+from __future__ import annotations
+
+import os
+import re
+import shutil
 
 import yaml
 from pathlib import Path
 
 import concurrent.futures
 import sys
+import time
+from contextlib import closing
+
+from cmipper import lazy, metrics
+
+dask = lazy.import_module("dask")
+np = lazy.import_module("numpy")
+xa = lazy.import_module("xarray")
 
 
 def lat_lon_string_from_tuples(
@@ -41,6 +52,50 @@ def gen_seafloor_indices(xa_da: xa.Dataset, var: str, dim: str = "lev"):
     return indices_array
 
 
+def load_or_generate_seafloor_indices(
+    xa_da: xa.Dataset, var: str, indices_fp: str | Path = None, dim: str = "lev"
+):
+    """Return seafloor indices for a grid, reading them from indices_fp if already calculated.
+
+    Indices depend only on the grid and level range (not on variable, member or time), so are calculated once and
+    saved as a .npy file which is subsequently memory-mapped. Saved indices are checked against the grid's shape and
+    regenerated if they don't match.
+
+    Args:
+        xa_da (xa.Dataset): dataset on the full native grid, with dimensions (time, dim, y, x)
+        var (str): name of variable from which to determine seafloor
+        indices_fp (str | Path, optional): path to .npy cache. Defaults to None (no caching).
+        dim (str, optional): dimension along which to search for seafloor values. Defaults to "lev".
+
+    Returns:
+        np.ndarray: 2D (y, x) array of seafloor indices
+    """
+    grid_shape = tuple(
+        size for d, size in xa_da[var].sizes.items() if d not in ("time", dim)
+    )
+    if indices_fp is not None and Path(indices_fp).exists():
+        indices_array = np.load(indices_fp, mmap_mode="r")
+        if indices_array.shape == grid_shape:
+            return indices_array
+        print(
+            f"\tcached seafloor indices at {indices_fp} have shape {indices_array.shape}, "
+            f"but grid has shape {grid_shape}. Regenerating...",
+            flush=True,
+        )
+
+    indices_array = gen_seafloor_indices(xa_da.isel(time=0), var=var, dim=dim)
+    if indices_fp is not None:
+        indices_fp = Path(indices_fp)
+        if not indices_fp.parent.exists():
+            indices_fp.parent.mkdir(parents=True, exist_ok=True)
+        # write to temporary file first so that no partially-written cache can be read
+        tmp_indices_fp = tmp_fp(indices_fp)
+        np.save(tmp_indices_fp, indices_array)
+        os.replace(tmp_indices_fp, indices_fp)
+        print(f"\tsaved seafloor indices to {indices_fp}", flush=True)
+    return indices_array
+
+
 def extract_seafloor_vals(xa_da, indices_array):
     vals_array = xa_da.values
     t, j, i = indices_array.shape
@@ -50,6 +105,153 @@ def extract_seafloor_vals(xa_da, indices_array):
     return vals_array[t_grid, indices_array, j_grid, i_grid]
 
 
+def native_index_box(
+    xa_d: xa.Dataset | xa.DataArray,
+    lats: list[float, float],
+    lons: list[float, float],
+    margin: int = 2,
+    lat_name: str = "latitude",
+    lon_name: str = "longitude",
+):
+    """Find the smallest index box of a (curvilinear) native grid covering a latitude/longitude region.
+
+    Only the coordinate arrays are read, so this is cheap to call on a lazily-opened remote dataset.
+
+    Args:
+        xa_d (xa.Dataset | xa.DataArray): dataset on native grid, with 2D latitude and longitude coordinates
+        lats (list[float, float]): latitude range
+        lons (list[float, float]): longitude range
+        margin (int, optional): number of extra cells to include on each side e.g. to support bilinear
+            interpolation at the region edges. Defaults to 2.
+        lat_name (str, optional): name of latitude coordinate. Defaults to "latitude".
+        lon_name (str, optional): name of longitude coordinate. Defaults to "longitude".
+
+    Returns:
+        dict: mapping each native grid dimension name (e.g. "j", "i") to the slice covering the region
+    """
+    lat_vals = np.asarray(xa_d[lat_name].values)
+    lon_vals = np.asarray(xa_d[lon_name].values)
+    if lat_vals.ndim == 1:  # rectilinear grid
+        lat_vals, lon_vals = np.meshgrid(lat_vals, lon_vals, indexing="ij")
+        dims = [xa_d[lat_name].dims[0], xa_d[lon_name].dims[0]]
+    else:
+        dims = list(xa_d[lat_name].dims)
+
+    # modular comparison handles both [0, 360] and [-180, 180] conventions, and regions crossing the antimeridian
+    lon_span = (max(lons) - min(lons)) % 360 if max(lons) - min(lons) < 360 else 360
+    in_lons = ((lon_vals - min(lons)) % 360) <= lon_span
+    in_lats = (lat_vals >= min(lats)) & (lat_vals <= max(lats))
+    j_inds, i_inds = np.nonzero(in_lats & in_lons)
+    if len(j_inds) == 0:
+        raise ValueError(
+            f"No grid cells found within latitudes {lats} and longitudes {lons}"
+        )
+
+    box = {}
+    for dim, inds, size in zip(dims, [j_inds, i_inds], lat_vals.shape):
+        if inds.min() == 0 and inds.max() == size - 1:
+            # region may wrap around the periodic boundary: keep the whole dimension
+            box[dim] = slice(0, size)
+        else:
+            box[dim] = slice(
+                int(max(inds.min() - margin, 0)),
+                int(min(inds.max() + margin + 1, size)),
+            )
+    return box
+
+
+def subset_native_grid(
+    xa_d: xa.Dataset | xa.DataArray,
+    lats: list[float, float],
+    lons: list[float, float],
+    year_range: list[int, int] = None,
+    margin: int = 2,
+    box: dict = None,
+):
+    """Lazily select the native grid cells (and time steps) needed for a region.
+
+    Applied to a lazily-opened OPeNDAP dataset, the selection is passed to the server as index constraints so that only
+    the region of interest is transferred.
+
+    Args:
+        xa_d (xa.Dataset | xa.DataArray): dataset on native grid
+        lats (list[float, float]): latitude range
+        lons (list[float, float]): longitude range
+        year_range (list[int, int], optional): [first year, year after last] of time steps to keep. Defaults to None
+            (all times).
+        margin (int, optional): number of extra cells to include on each side. Defaults to 2.
+        box (dict, optional): precomputed output of native_index_box. Defaults to None (calculated).
+
+    Returns:
+        xa.Dataset | xa.DataArray: subset of xa_d
+    """
+    if box is None:
+        box = native_index_box(xa_d, lats, lons, margin=margin)
+    subset = xa_d.isel(box)
+    if year_range and "time" in subset.dims:
+        subset = subset.sel(time=slice(str(min(year_range)), str(max(year_range) - 1)))
+    return subset
+
+
+def _take_seafloor(vals, indices):
+    # vals: (..., lev, j, i), indices: (j, i). Gather a single level per water column
+    gather_indices = np.broadcast_to(indices, vals.shape[:-3] + (1,) + indices.shape)
+    return np.take_along_axis(vals, gather_indices, axis=-3)[..., 0, :, :]
+
+
+def dask_workers():
+    """Number of threads (or processes) dask computes with."""
+    return dask.config.get("num_workers", None) or os.cpu_count() or 1
+
+
+def time_chunk(xa_da: xa.DataArray | xa.Variable, chunk_mb: float):
+    """Number of time steps of xa_da (whole in its other dimensions) in a chunk of at most chunk_mb (and at least one
+    time step)."""
+    step_bytes = xa_da.dtype.itemsize * xa_da.size / max(xa_da.sizes["time"], 1)
+    return max(1, int(chunk_mb * 2**20 / max(step_bytes, 1)))
+
+
+def extract_seafloor_vals_lazy(
+    xa_da: xa.DataArray,
+    indices_array: np.ndarray,
+    max_memory_mb: float = 1024,
+    dim: str = "lev",
+):
+    """Lazily extract seafloor values, one block of time steps at a time.
+
+    Unlike extract_seafloor_vals, the full (time, lev, j, i) array is never loaded: each block is gathered along dim
+    using the 2D indices, and the result is a dask-backed array which may be written straight to disk.
+
+    Args:
+        xa_da (xa.DataArray): variable with dimensions (time, dim, y, x)
+        indices_array (np.ndarray): 2D array (y, x) of seafloor indices, as generated by gen_seafloor_indices
+        max_memory_mb (float, optional): ceiling on memory used by the blocks being processed at any one time (split
+            between dask's workers). Defaults to 1024.
+        dim (str, optional): dimension along which to gather seafloor values. Defaults to "lev".
+
+    Returns:
+        xa.DataArray: dask-backed array of seafloor values with dimensions (time, y, x)
+    """
+    spatial_dims = [d for d in xa_da.dims if d not in ("time", dim)]
+    da = xa_da.chunk(
+        {
+            "time": time_chunk(xa_da, max_memory_mb / dask_workers()),
+            dim: -1,
+            **{d: -1 for d in spatial_dims},
+        }
+    )
+    indices = xa.DataArray(np.asarray(indices_array), dims=spatial_dims)
+    return xa.apply_ufunc(
+        _take_seafloor,
+        da,
+        indices,
+        input_core_dims=[[dim, *spatial_dims], spatial_dims],
+        output_core_dims=[spatial_dims],
+        dask="parallelized",
+        output_dtypes=[da.dtype],
+    ).transpose("time", *spatial_dims)
+
+
 def generate_remap_info(eg_nc, resolution=0.25, out_grid: str = "latlon"):
     # [-180, 180] longitudinal range
     xfirst = float(np.min(eg_nc.longitude).values) - 180
@@ -153,6 +355,295 @@ def process_xa_d(
     return temp_xa_d.sortby(list(temp_xa_d.dims))
 
 
+def time_schema(xa_d: xa.Dataset, time_dim: str = "time"):
+    """Everything about a dataset except its time steps: variables, dims, dtypes and non-time coordinates.
+
+    Datasets with the same schema can be appended to one another along time_dim.
+    """
+    schema = {}
+    for name, da in xa_d.variables.items():
+        if name == time_dim:
+            continue
+        schema[name] = (da.dims, str(da.dtype))
+        if time_dim not in da.dims:  # static coordinates must match exactly
+            schema[name] += (tuple(np.asarray(da.values).ravel().tolist()),)
+    return schema
+
+
+def append_to_netcdf_by_time(
+    xa_d: xa.Dataset, fp: str | Path, time_dim: str = "time", attrs: dict = None
+):
+    """Append the time steps of xa_d to an existing netcdf file with an unlimited time dimension.
+
+    Only the new values are written, to a temporary copy of the file which then atomically replaces it, so that an
+    interrupted append leaves the file as it was (rather than with some variables' new time steps missing). Time steps
+    are written in the order received, so readers should sort by time.
+
+    Args:
+        xa_d (xa.Dataset): dataset with the same schema (see time_schema) as the file
+        fp (str | Path): netcdf file to append to
+        time_dim (str, optional): unlimited dimension to append along. Defaults to "time".
+        attrs (dict, optional): global attributes to set once the values are written. Defaults to None.
+
+    Returns:
+        int: number of time steps appended
+    """
+    size_before = Path(fp).stat().st_size
+    tmp = tmp_fp(fp)
+    shutil.copyfile(fp, tmp)
+    try:
+        appended = _append_to_netcdf_by_time(xa_d, tmp, fp, time_dim, attrs)
+        os.replace(tmp, fp)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    metrics.add(bytes_out=max(0, Path(fp).stat().st_size - size_before))
+    return appended
+
+
+def _append_to_netcdf_by_time(
+    xa_d: xa.Dataset, fp: Path, original_fp: Path, time_dim: str, attrs: dict
+):
+    import netCDF4
+
+    with netCDF4.Dataset(fp, "a") as nc:
+        if not nc.dimensions[time_dim].isunlimited():
+            raise ValueError(f"{original_fp} has no unlimited '{time_dim}' dimension")
+        for name, da in xa_d.data_vars.items():
+            # values beyond the range of packed (scaled integer) variables can't be represented
+            nc_var = nc.variables[name]
+            if "scale_factor" in nc_var.ncattrs() and time_dim in da.dims:
+                info = np.iinfo(nc_var.dtype)
+                offset = getattr(nc_var, "add_offset", 0)
+                lo = (info.min + 1) * nc_var.scale_factor + offset
+                hi = info.max * nc_var.scale_factor + offset
+                if np.nanmin(da.values) < lo or np.nanmax(da.values) > hi:
+                    raise ValueError(
+                        f"values of '{name}' are outside the packed range [{lo}, {hi}] of {original_fp}"
+                    )
+        start = len(nc.dimensions[time_dim])
+        stop = start + xa_d.sizes[time_dim]
+        for name, da in xa_d.variables.items():
+            if time_dim not in da.dims:
+                continue
+            nc_var = nc.variables[name]
+            values = da.values
+            if np.issubdtype(values.dtype, np.datetime64) or values.dtype == object:
+                values, _, _ = xa.coding.times.encode_cf_datetime(
+                    values, nc_var.units, getattr(nc_var, "calendar", "standard")
+                )
+            elif np.issubdtype(values.dtype, np.floating):
+                # masked values are written as the fill value (NaNs can't be cast to packed integers)
+                missing = np.isnan(values)
+                values = np.ma.array(np.where(missing, 0, values), mask=missing)
+            index = tuple(
+                slice(start, stop) if dim == time_dim else slice(None)
+                for dim in da.dims
+            )
+            nc_var[index] = values
+        if attrs:
+            nc.setncatts(attrs)
+    return stop - start
+
+
+# chunk layouts: "time" chunks contiguous in time, for time series access. "map" one time step per chunk, for maps
+CHUNKINGS = {
+    "time": {"time": 120, "spatial": 64},
+    "map": {"time": 1, "spatial": -1},
+}
+SPATIAL_DIMS = ["latitude", "longitude", "lat", "lon", "j", "i", "y", "x"]
+
+
+def chunk_shape(da: xa.DataArray, chunking: str = "time"):
+    """Chunk shape of da according to the named chunking. Non-spatial dims other than time (e.g. bounds) are whole."""
+    if chunking not in CHUNKINGS:
+        raise ValueError(
+            f"chunking must be one of {list(CHUNKINGS)}. Instead received '{chunking}'"
+        )
+    chunk_sizes = CHUNKINGS[chunking]
+    chunks = []
+    for dim, size in da.sizes.items():
+        if dim == "time":
+            chunk = chunk_sizes["time"]
+        elif dim in SPATIAL_DIMS:
+            chunk = chunk_sizes["spatial"]
+        else:
+            chunk = -1
+        chunks.append(size if chunk == -1 else max(min(chunk, size), 1))
+    return tuple(chunks)
+
+
+def get_encoding_profile(download_config_dict: dict, stage: str):
+    """Return the encoding profile (see download_config.yaml) applied to files written at a stage of the pipeline.
+
+    Args:
+        download_config_dict (dict): download configuration
+        stage (str): one of "og", "regridded", "cropped", "time_concatted" or "merged"
+
+    Returns:
+        dict: encoding profile. Empty if files are to be written with default encoding.
+    """
+    encoding_config = download_config_dict.get("encoding", {})
+    name = encoding_config.get("stages", {}).get(
+        stage, encoding_config.get("profile", "default")
+    )
+    profiles = encoding_config.get("profiles", {})
+    if name == "default" and name not in profiles:
+        return {}
+    if name not in profiles:
+        raise ValueError(
+            f"encoding profile must be one of {list(profiles)}. Instead received '{name}'"
+        )
+    return profiles[name] or {}
+
+
+def netcdf_encoding(xa_d: xa.Dataset, profile: dict):
+    """Encoding of each data variable of xa_d according to an encoding profile.
+
+    Profiles may specify:
+        dtype: e.g. float32, or int16 to pack values with a scale factor and offset calculated from their range
+        compression: zlib or zstd (or none)
+        complevel: compression level
+        shuffle: whether to apply the shuffle filter before compression
+        chunking: chunk layout, one of CHUNKINGS
+    """
+    encoding = {}
+    for var_name, da in xa_d.data_vars.items():
+        if not np.issubdtype(da.dtype, np.number):
+            continue
+        var_encoding = {}
+        dtype = profile.get("dtype")
+        if dtype and np.issubdtype(np.dtype(dtype), np.integer):
+            # pack into integer range (reserving its minimum for missing values). Requires a pass over the data
+            info = np.iinfo(dtype)
+            vmin, vmax = (float(val) for val in dask.compute(da.min(), da.max()))
+            if np.isnan(vmin):  # all missing
+                vmin, vmax = 0.0, 0.0
+            var_encoding.update(
+                {
+                    "dtype": dtype,
+                    "scale_factor": (vmax - vmin) / (info.max - info.min - 1) or 1.0,
+                    "add_offset": (vmax + vmin) / 2,
+                    "_FillValue": info.min,
+                }
+            )
+        elif dtype:
+            var_encoding["dtype"] = dtype
+        compression = profile.get("compression")
+        if compression and compression != "none":
+            var_encoding["compression"] = compression
+            var_encoding["complevel"] = profile.get("complevel", 4)
+            var_encoding["shuffle"] = profile.get("shuffle", True)
+        if profile.get("chunking"):
+            var_encoding["chunksizes"] = chunk_shape(da, profile["chunking"])
+        encoding[var_name] = var_encoding
+    return encoding
+
+
+def prepare_for_write(xa_d: xa.Dataset | xa.DataArray, profile: dict = None):
+    """Return (dataset, encoding) to write xa_d with an encoding profile.
+
+    Encoding inherited from source files is dropped from the data variables so that it can't conflict with the profile.
+    """
+    if isinstance(xa_d, xa.DataArray):
+        xa_d = xa_d.to_dataset()
+    if not profile:
+        return xa_d, None
+    xa_d = xa_d.copy()
+    for var_name in xa_d.data_vars:
+        xa_d[var_name].encoding = {}
+    return xa_d, netcdf_encoding(xa_d, profile)
+
+
+def cdo_options(profile: dict = None):
+    """CDO command line options writing files as close to an encoding profile as cdo allows.
+
+    Values are written as 32-bit floats if packing is requested, since cdo can't calculate scale factors.
+    """
+    if not profile:
+        return ""
+    options = ["-f nc4"]
+    dtype = profile.get("dtype")
+    if dtype == "float64":
+        options.append("-b F64")
+    elif dtype:
+        options.append("-b F32")
+    compression = profile.get("compression")
+    if compression == "zlib":
+        options.append(f"-z zip_{profile.get('complevel', 4)}")
+    elif compression == "zstd":
+        options.append(f"-z zstd_{profile.get('complevel', 4)}")
+    if profile.get("chunking") == "map":
+        options.append("-k grid")
+    elif profile.get("chunking"):
+        options.append("-k auto")
+    return " ".join(options)
+
+
+def report_write(fps: list[str | Path], dur: float):
+    """Print (and return) the total bytes written to fps and the write throughput."""
+    nbytes = sum(Path(fp).stat().st_size for fp in fps if Path(fp).exists())
+    metrics.add(bytes_out=nbytes)
+    print(
+        f"\twrote {nbytes / 1e6:.1f} MB to {len(fps)} file(s) in {dur:.1f}s "
+        f"({nbytes / 1e6 / max(dur, 1e-6):.1f} MB/s)",
+        flush=True,
+    )
+    return nbytes
+
+
+class CommittingConnection:
+    """Context manager committing (or rolling back) and then closing an sqlite3 connection, as used by the search
+    cache, job manifest and catalogue."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        with closing(self.conn):
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+
+
+def tmp_fp(fp: str | Path):
+    """Temporary path alongside fp (with the same suffix), to be written and then renamed to fp."""
+    fp = Path(fp)
+    return fp.with_name(f"{fp.stem}.{os.getpid()}.tmp{fp.suffix}")
+
+
+def is_tmp_fp(fp: str | Path):
+    return ".tmp." in Path(fp).name
+
+
+def write_netcdf(
+    xa_d: xa.Dataset | xa.DataArray, fp: str | Path, profile: dict = None, **kwargs
+):
+    """Write xa_d to fp with an encoding profile, reporting bytes written and throughput.
+
+    The file is written to a temporary path and atomically renamed, so that fp only ever exists complete. The
+    temporary file is removed if writing fails.
+
+    Returns:
+        int: bytes written
+    """
+    xa_d, encoding = prepare_for_write(xa_d, profile)
+    tic = time.time()
+    tmp = tmp_fp(fp)
+    try:
+        xa_d.to_netcdf(tmp, encoding=encoding, **kwargs)
+        os.replace(tmp, fp)
+    finally:
+        # don't leave a partial file if writing failed
+        if tmp.exists():
+            tmp.unlink()
+    return report_write([fp], time.time() - tic)
+
+
 class FileName:
     def __init__(
         self,
@@ -262,6 +753,95 @@ class FileName:
 
         return f"{self.fname}.nc"
 
+    @classmethod
+    def from_fname(cls, fname: str, fname_type: str = None):
+        """Inverse of construct_fname: parse a filename into a FileName.
+
+        Fields are read from the right, since only the variable ids (of which merged files have several) vary in
+        number: date range, grid type, plevels, then spatial range.
+
+        Args:
+            fname (str): filename, with or without its directory and ".nc" suffix
+            fname_type (str, optional): type of file, which can't always be told from the name (e.g. time-concatted
+                files). Defaults to None: "var_concatted" if several variables, otherwise "individual".
+
+        Returns:
+            FileName: with construct_fname() equal to fname
+
+        Raises:
+            ValueError: if fname wasn't constructed by FileName
+        """
+        tokens = Path(fname).name.removesuffix(".nc").split("_")
+
+        date_range = None
+        if re.fullmatch(r"\d{6}-\d{6}", tokens[-1]):
+            date_range = tokens.pop()
+
+        grid_types = {"tp": "tripolar", "ll": "latlon"}
+        if not tokens or tokens[-1] not in grid_types:
+            raise ValueError(f"no grid type in filename '{fname}'")
+        grid_type = grid_types[tokens.pop()]
+
+        levs = None
+        plevel_token = tokens.pop() if tokens else ""
+        if plevel_token == "sfc":
+            plevels = None
+        elif match := re.fullmatch(r"sfl-(\d+)", plevel_token):
+            # only the deepest level is recorded
+            plevels, levs = -1, [0, int(match.group(1))]
+        elif tokens and tokens[-1] == "levs" and re.fullmatch(r"\d+-\d+", plevel_token):
+            tokens.pop()
+            levs = [int(lev) for lev in plevel_token.split("-")]
+            plevels = levs
+        elif re.fullmatch(r"\d+", plevel_token):  # pressure level, in hPa
+            plevels = float(plevel_token) * 100
+        else:
+            raise ValueError(f"no plevels in filename '{fname}'")
+
+        lats = lons = None
+        if tokens and tokens[-1] == "uncropped":
+            tokens.pop()
+        elif len(tokens) >= 4 and (
+            match := re.fullmatch(
+                r"N(-?[\d.]+)_S(-?[\d.]+)_W(-?[\d.]+)_E(-?[\d.]+)",
+                "_".join(tokens[-4:]),
+                re.IGNORECASE,
+            )
+        ):
+            del tokens[-4:]
+            north, south, west, east = (float(val) for val in match.groups())
+            lats, lons = [south, north], [west, east]
+        else:
+            raise ValueError(f"no spatial range in filename '{fname}'")
+
+        if not tokens:
+            raise ValueError(f"no variable in filename '{fname}'")
+        variable_id = tokens if len(tokens) > 1 else tokens[0]
+        if fname_type is None:
+            fname_type = "var_concatted" if len(tokens) > 1 else "individual"
+        if date_range and fname_type in ("time_concatted", "var_concatted"):
+            date_range = date_range.split("-")
+
+        return cls(
+            variable_id=variable_id,
+            grid_type=grid_type,
+            fname_type=fname_type,
+            date_range=date_range,
+            lats=lats,
+            lons=lons,
+            levs=levs,
+            plevels=plevels,
+        )
+
+    def get_year_range(self):
+        """First and last (inclusive) years covered, or None if the filename has no date range."""
+        if not self.date_range:
+            return None
+        date_range = self.date_range
+        if isinstance(date_range, str):
+            date_range = date_range.split("-")
+        return [int(str(date_range[0])[:4]), int(str(date_range[1])[:4])]
+
 
 def read_yaml(yaml_path: str | Path):
     with open(yaml_path, "r") as file:
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+
+from cmipper import lazy, utils
+
+np = lazy.import_module("numpy")
+xa = lazy.import_module("xarray")
+
+"""
+Zarr output backend: rather than concatenating per-file netCDFs by time (and then merging by variable) once all files
+are downloaded, each processed file is appended along time to a zarr store as soon as it is ready. There is one store
+per experiment, holding a group (with consolidated metadata) per variable/level, so that concatenation and merging
+become lazy operations on open.
+
+Selected by `output: backend: zarr` in download_config.yaml.
+"""
+
+OUTPUT_BACKENDS = ["netcdf", "zarr"]
+ZARR_CHUNKINGS = utils.CHUNKINGS
+
+_group_locks = {}
+_group_locks_lock = threading.Lock()
+
+
+def _group_lock(store_fp: Path, group: str):
+    with _group_locks_lock:
+        return _group_locks.setdefault((str(store_fp), group), threading.Lock())
+
+
+def zarr_store_fp(download_dir: str | Path, experiment_id: str):
+    return Path(download_dir) / "zarr" / f"{experiment_id}.zarr"
+
+
+def variable_group(
+    variable_id: str,
+    plevel,
+    levs: list[int, int],
+    lats: list[float, float] = None,
+    lons: list[float, float] = None,
+):
+    """Name of the group holding a variable/level, constructed as for concatenated files (without dates)."""
+    return utils.FileName(
+        variable_id=variable_id,
+        grid_type="latlon",
+        fname_type="time_concatted",
+        lats=lats,
+        lons=lons,
+        levs=levs,
+        plevels=plevel,
+    ).construct_fname()[: -len(".nc")]
+
+
+def zarr_encoding(xa_d: xa.Dataset, chunking: str = "time"):
+    """Chunk encoding for each data variable of xa_d, according to the named chunking (see utils.CHUNKINGS)."""
+    return {
+        var_name: {"chunks": utils.chunk_shape(da, chunking)}
+        for var_name, da in xa_d.data_vars.items()
+    }
+
+
+def _normalise_calendar(xa_d: xa.Dataset):
+    # as for concatenated netcdf files (see open_time_slices), so that time steps compare equal whatever the calendar
+    return xa_d.convert_calendar("gregorian", dim="time")
+
+
+def append_to_zarr(
+    xa_d: xa.Dataset | xa.DataArray | str | Path,
+    store_fp: str | Path,
+    group: str,
+    chunking: str = "time",
+    rewrite_existing: bool = False,
+):
+    """Append a processed file (or dataset) along time to a group of a zarr store, creating it if necessary.
+
+    Time steps already in the group are not appended again, so files may be re-appended after an interruption. An
+    interrupted append may however leave time steps in the group without (all of) their values, so if the file's
+    earlier append didn't complete (see the job manifest's "zarr" stage), rewrite_existing writes its time steps
+    already in the group in place.
+
+    Returns:
+        int: number of time steps appended
+    """
+    if isinstance(xa_d, (str, Path)):
+        xa_d = xa.open_dataset(xa_d)
+    if isinstance(xa_d, xa.DataArray):
+        xa_d = xa_d.to_dataset()
+    # standardise coordinates and load (small, cropped) slice so that writes needn't align with zarr chunks
+    xa_d = _normalise_calendar(utils.process_xa_d(xa_d)).load()
+
+    store_fp = Path(store_fp)
+    with _group_lock(store_fp, group):
+        try:
+            # not from consolidated metadata, which an interrupted append may have left stale
+            existing_times = _normalise_calendar(
+                xa.open_zarr(store_fp, group=group, consolidated=False)
+            )["time"].values
+        except (FileNotFoundError, KeyError, OSError):
+            existing_times = None
+
+        if existing_times is None:
+            if not store_fp.parent.exists():
+                store_fp.parent.mkdir(parents=True, exist_ok=True)
+            xa_d.to_zarr(
+                store_fp,
+                group=group,
+                mode="a",
+                consolidated=True,
+                encoding=zarr_encoding(xa_d, chunking),
+            )
+            return len(xa_d.time)
+
+        new_times = ~np.isin(xa_d["time"].values, existing_times)
+        if rewrite_existing and not new_times.all():
+            _rewrite_times(xa_d.isel(time=~new_times), store_fp, group, existing_times)
+        if not new_times.any():
+            return 0
+        xa_d.isel(time=new_times).to_zarr(
+            store_fp, group=group, append_dim="time", consolidated=True
+        )
+        return int(new_times.sum())
+
+
+def _rewrite_times(xa_d: xa.Dataset, store_fp: Path, group: str, existing_times):
+    """Write the time steps of xa_d over those already in a group, one region (of consecutive time steps) at a time."""
+    # variables without a time dim (e.g. lat/lon) can't be written to a region of time
+    xa_d = xa_d.drop_vars(
+        [name for name, da in xa_d.variables.items() if "time" not in da.dims]
+    )
+    positions = np.searchsorted(np.sort(existing_times), xa_d["time"].values)
+    indices = np.argsort(existing_times)[positions]
+    start = 0
+    for stop in range(1, len(indices) + 1):
+        if stop == len(indices) or indices[stop] != indices[stop - 1] + 1:
+            xa_d.isel(time=slice(start, stop)).to_zarr(
+                store_fp,
+                group=group,
+                region={"time": slice(int(indices[start]), int(indices[stop - 1]) + 1)},
+                consolidated=True,
+            )
+            start = stop
+
+
+def open_zarr_variable(store_fp: str | Path, group: str):
+    """Lazily open a variable group, sorted by time (slices may have been appended out of order)."""
+    return xa.open_zarr(store_fp, group=group, consolidated=True).sortby("time")
+
+
+def list_groups(store_fp: str | Path):
+    """Names of the variable groups in a store."""
+    store_fp = Path(store_fp)
+    if not store_fp.exists():
+        return []
+    return sorted(
+        fp.name
+        for fp in store_fp.iterdir()
+        if fp.is_dir() and not fp.name.startswith(".")
+    )
+
+
+def open_zarr_merged(store_fp: str | Path, groups: list[str] = None):
+    """Lazily merge variable groups of a store (all groups if None) into a single dataset."""
+    groups = list_groups(store_fp) if groups is None else groups
+    return xa.merge([open_zarr_variable(store_fp, group) for group in groups])
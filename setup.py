@@ -6,4 +6,5 @@ setup(
     author="Orlando Timmerman",
     packages=["cmipper"],
     description="Automating download of CMIP6 data",
+    entry_points={"console_scripts": ["cmipper=cmipper.cli:main"]},
 )